@@ -0,0 +1,82 @@
+from availability import MINUTES_PER_DAY, now_minute
+
+# Retention: appointments, and notifications about appointments, from before
+# a cutoff move out of the main database into the history database (see
+# repository.HISTORY_SCHEMA). Rows are moved in batches, each its own short
+# transaction, so the app keeps booking while a large archive runs; the walk
+# goes up the id column and so reads each table once however many batches
+# it takes. Archived rows keep their ids, and a rerun after an interrupted
+# batch simply overwrites the copies it had already made.
+
+ARCHIVE_AFTER_DAYS = 365
+BATCH_SIZE = 10000
+
+APPOINTMENT_COLUMNS = "id, patient_id, doctor_id, date, time, slot, start_minute"
+NOTIFICATION_COLUMNS = "id, doctor_id, message, date, time, start_minute, recipient_id"
+
+
+class ArchiveReport:
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.appointments = 0
+        self.notifications = 0
+
+
+def cutoff_minute(days=ARCHIVE_AFTER_DAYS):
+    # Midnight `days` days ago
+    return (now_minute() // MINUTES_PER_DAY - days) * MINUTES_PER_DAY
+
+
+def archive(pool, cutoff, batch_size=BATCH_SIZE):
+    # Moves everything with start_minute before `cutoff`. Returns an
+    # ArchiveReport.
+    report = ArchiveReport(cutoff)
+    conn = pool.history()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)")
+    report.appointments = _move(pool, 'appointments', APPOINTMENT_COLUMNS, cutoff, batch_size, _keep_counts)
+    report.notifications = _move(pool, 'notifications', NOTIFICATION_COLUMNS, cutoff, batch_size)
+    return report
+
+
+def _move(pool, table, columns, cutoff, batch_size, before_delete=None):
+    moved = 0
+    last_id = 0
+    while True:
+        with pool.transaction(immediate=True) as conn:
+            conn.execute("DELETE FROM temp.archive_batch")
+            conn.execute(f'''
+                INSERT INTO temp.archive_batch
+                SELECT id FROM main.{table} WHERE id > ? AND start_minute < ? ORDER BY id LIMIT ?
+            ''', (last_id, cutoff, batch_size))
+            count, last = conn.execute("SELECT count(*), max(id) FROM temp.archive_batch").fetchone()
+            if not count:
+                return moved
+            conn.execute(f'''
+                INSERT OR REPLACE INTO history.{table} ({columns})
+                SELECT {columns} FROM main.{table} WHERE id IN (SELECT id FROM temp.archive_batch)
+            ''')
+            if before_delete is not None:
+                before_delete(conn)
+            conn.execute(f"DELETE FROM main.{table} WHERE id IN (SELECT id FROM temp.archive_batch)")
+        moved += count
+        last_id = last
+
+
+def _keep_counts(conn):
+    # Archiving isn't cancelling: put back what the delete trigger is about
+    # to take off daily_stats, so reports still count archived bookings.
+    conn.execute(f'''
+        INSERT INTO main.daily_stats (doctor_id, day, booked)
+        SELECT doctor_id, start_minute / {MINUTES_PER_DAY}, count(*) FROM main.appointments
+        WHERE id IN (SELECT id FROM temp.archive_batch)
+        GROUP BY doctor_id, start_minute / {MINUTES_PER_DAY}
+        ON CONFLICT (doctor_id, day) DO UPDATE SET booked = booked + excluded.booked
+    ''')
+
+
+def compact(pool):
+    # Give the space freed by archiving back to the file system, so the
+    # main database shrinks to what is still live. Needs no other writers.
+    conn = pool.connection()
+    conn.execute("VACUUM main")
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
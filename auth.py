@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import os
+import secrets
+
+# Passwords are stored as "scrypt$n$r$p$salt$hash" (salt and hash in hex).
+# Older databases hold unsalted SHA-256 hex digests; those still verify, and
+# UserRepo.authenticate replaces them with a scrypt hash on the next login.
+# Raising the cost below makes existing hashes get upgraded the same way.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# Where a "keep me signed in" session token is kept between runs
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".doctor_appointment_session")
+SESSION_DAYS = 30
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p + 2), dklen=KEY_BYTES)
+
+
+# Hash password
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = os.urandom(SALT_BYTES)
+    return f"scrypt${n}${r}${p}${salt.hex()}${_scrypt(password, salt, n, r, p).hex()}"
+
+
+def legacy_hash(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def verify_password(password, stored):
+    # Returns (matches, needs_rehash)
+    if stored.startswith("scrypt$"):
+        try:
+            _, n, r, p, salt, expected = stored.split("$")
+            n, r, p = int(n), int(r), int(p)
+            expected = bytes.fromhex(expected)
+            actual = _scrypt(password, bytes.fromhex(salt), n, r, p)
+        except ValueError:
+            return False, False
+        matches = hmac.compare_digest(actual, expected)
+        return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    # As bytes: compare_digest refuses str with non-ASCII characters
+    return hmac.compare_digest(legacy_hash(password).encode(), stored.encode()), True
+
+
+# Checked against when the username doesn't exist, so that a miss takes as
+# long as a wrong password and doesn't give away which usernames are real.
+_DUMMY_HASH = None
+
+
+def verify_nobody(password):
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password("")
+    verify_password(password, _DUMMY_HASH)
+    return False
+
+
+def new_session_token():
+    return secrets.token_urlsafe(32)
+
+
+def token_digest(token):
+    # Tokens are random and long, so a plain hash is enough: the database
+    # only ever holds digests, never a token that could be replayed.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def load_session_token(path=SESSION_FILE):
+    try:
+        with open(path, encoding='utf-8') as handle:
+            return handle.read().strip() or None
+    except OSError:
+        return None
+
+
+def save_session_token(token, path=SESSION_FILE):
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w', encoding='utf-8') as handle:
+        handle.write(token)
+
+
+def clear_session_token(path=SESSION_FILE):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,147 @@
+import calendar
+from datetime import datetime, timedelta
+
+# Working hours used to lay out bookable slots. Times are minutes after
+# midnight; a day is cut into SLOT_MINUTES-long slots numbered from 0, so
+# slot 18 is 09:00 AM with 30 minute slots.
+DAY_START = 9 * 60
+DAY_END = 17 * 60
+SLOT_MINUTES = 30
+WORKING_WEEKDAYS = (0, 1, 2, 3, 4)  # Monday to Friday
+
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%I:%M %p"
+MINUTES_PER_DAY = 24 * 60
+EPOCH = datetime(1970, 1, 1)
+
+
+# Appointment times are stored as start_minute: whole minutes since the Unix
+# epoch. The app has no notion of timezones, so the wall-clock date and time
+# a user enters are encoded as if they were UTC, and the date/time text
+# columns are rendered back from the integer.
+def encode(date_text, time_text):
+    parsed = datetime.strptime(f"{date_text} {time_text}", f"{DATE_FORMAT} {TIME_FORMAT}")
+    return calendar.timegm(parsed.timetuple()) // 60
+
+
+def decode(minute):
+    moment = EPOCH + timedelta(minutes=minute)
+    return moment.strftime(DATE_FORMAT), moment.strftime(TIME_FORMAT)
+
+
+def now_minute():
+    # The current wall-clock time, encoded the same way as encode()
+    return calendar.timegm(datetime.now().timetuple()) // 60
+
+
+def midnight_of(date_text):
+    return calendar.timegm(datetime.strptime(date_text, DATE_FORMAT).timetuple()) // 60
+
+
+def working_slots(day, day_start=DAY_START, day_end=DAY_END, weekdays=WORKING_WEEKDAYS):
+    # How many slots one doctor can have booked on `day` (days since the
+    # epoch, start_minute // MINUTES_PER_DAY): the capacity utilization is
+    # measured against. The epoch was a Thursday.
+    if (day + 3) % 7 not in weekdays:
+        return 0
+    return day_end // SLOT_MINUTES - -(-day_start // SLOT_MINUTES)
+
+
+def slot_of(time_text):
+    # Any time inside a slot occupies that slot, so 09:10 AM and 09:00 AM clash.
+    parsed = datetime.strptime(time_text, TIME_FORMAT)
+    return (parsed.hour * 60 + parsed.minute) // SLOT_MINUTES
+
+
+def time_of(slot):
+    minutes = slot * SLOT_MINUTES
+    return datetime(2000, 1, 1, minutes // 60, minutes % 60).strftime(TIME_FORMAT)
+
+
+# Repeat rules for series bookings: days between occurrences, or "monthly"
+# for the same day each month (the last day in shorter months).
+RECURRENCES = {'weekly': 7, 'biweekly': 14, 'monthly': None}
+MAX_OCCURRENCES = 52
+
+
+def recurrence(start_minute, frequency, count=None, until=None):
+    # Lazily yields the start_minute of each occurrence, the first being
+    # start_minute itself. Stops after `count` occurrences, after the date
+    # `until` (inclusive), or at MAX_OCCURRENCES, whichever comes first.
+    step = RECURRENCES[frequency]
+    limit = min(count or MAX_OCCURRENCES, MAX_OCCURRENCES)
+    end = midnight_of(until) + MINUTES_PER_DAY if until else None
+    first = EPOCH + timedelta(minutes=start_minute)
+    for index in range(limit):
+        if step is not None:
+            minute = start_minute + index * step * MINUTES_PER_DAY
+        else:
+            year, month = divmod(first.month - 1 + index, 12)
+            year += first.year
+            day = min(first.day, calendar.monthrange(year, month + 1)[1])
+            minute = calendar.timegm(first.replace(year=year, month=month + 1, day=day).timetuple()) // 60
+        if end is not None and minute >= end:
+            return
+        yield minute
+
+
+class Availability:
+    # Free/busy slots per doctor per day. Each day's bookings are folded into
+    # an integer bitmap (bit n set = slot n of the day taken), and a run of
+    # days is read with one range query on (doctor_id, start_minute).
+    def __init__(self, pool, day_start=DAY_START, day_end=DAY_END, weekdays=WORKING_WEEKDAYS):
+        self.pool = pool
+        self.weekdays = weekdays
+        self.first_slot = -(-day_start // SLOT_MINUTES)
+        self.last_slot = day_end // SLOT_MINUTES  # exclusive
+        self.working_mask = 0
+        for slot in range(self.first_slot, self.last_slot):
+            self.working_mask |= 1 << slot
+
+    def occupancy(self, doctor_id, first_day, last_day):
+        # {date text: bitmap} for the days between first_day and last_day
+        # (inclusive) that have at least one booking.
+        rows = self.pool.connection().execute('''
+            SELECT start_minute FROM appointments
+            WHERE doctor_id = ? AND start_minute >= ? AND start_minute < ?
+        ''', (doctor_id, midnight_of(first_day), midnight_of(last_day) + MINUTES_PER_DAY)).fetchall()
+        by_day = {}
+        for (minute,) in rows:
+            day, minute_of_day = divmod(minute, MINUTES_PER_DAY)
+            by_day[day] = by_day.get(day, 0) | (1 << (minute_of_day // SLOT_MINUTES))
+        return {decode(day * MINUTES_PER_DAY)[0]: bitmap for day, bitmap in by_day.items()}
+
+    def free_slots(self, doctor_id, day):
+        if datetime.strptime(day, DATE_FORMAT).weekday() not in self.weekdays:
+            return []
+        taken = self.occupancy(doctor_id, day, day).get(day, 0)
+        return [time_of(slot) for slot in self._free(taken)]
+
+    def next_available(self, doctor_id, after=None, horizon_days=90, window_days=14):
+        # Earliest free (date, time) strictly after `after` (default: now),
+        # looking no more than horizon_days ahead. Returns None if fully booked.
+        after = after or datetime.now()
+        first_day = after.date()
+        after_slot = (after.hour * 60 + after.minute) // SLOT_MINUTES
+        for offset in range(0, horizon_days, window_days):
+            start = first_day + timedelta(days=offset)
+            end = first_day + timedelta(days=min(offset + window_days, horizon_days) - 1)
+            bitmaps = self.occupancy(doctor_id, start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+            day = start
+            while day <= end:
+                if day.weekday() in self.weekdays:
+                    key = day.strftime(DATE_FORMAT)
+                    taken = bitmaps.get(key, 0)
+                    if day == first_day:
+                        # Slots up to and including the current one are gone
+                        taken |= (1 << (after_slot + 1)) - 1
+                    for slot in self._free(taken):
+                        return key, time_of(slot)
+                day += timedelta(days=1)
+        return None
+
+    def _free(self, taken):
+        free = self.working_mask & ~taken
+        for slot in range(self.first_slot, self.last_slot):
+            if free >> slot & 1:
+                yield slot
@@ -0,0 +1,128 @@
+import itertools
+
+import pytest
+
+from availability import MINUTES_PER_DAY, SLOT_MINUTES, decode, midnight_of, recurrence
+from benchmarks.generate import PASSWORD
+
+# One benchmark per repository operation the GUI performs. Run with
+#   python -m pytest benchmarks/bench_repository.py --scale 1m --benchmark-json=bench-1m.json
+# and compare saved runs with pytest-benchmark's --benchmark-compare.
+
+# Bookings made by the write benchmarks go well past the generated data, so
+# they never clash with it or with each other.
+future_minutes = itertools.count(midnight_of("2040-01-01"), SLOT_MINUTES)
+# Series get a range of their own, one twelve-week block per round
+series_starts = itertools.count(midnight_of("2400-01-03") + 9 * 60, 12 * 7 * MINUTES_PER_DAY)
+
+
+def test_login(bench, users):
+    assert bench(users.authenticate, "patient500", PASSWORD) is not None
+
+
+def test_login_unknown_user(bench, users):
+    assert bench(users.authenticate, "nobody", PASSWORD) is None
+
+
+def test_resume_session(bench, users):
+    token = users.create_session(users.authenticate("patient500", PASSWORD)[0])
+    assert bench(users.resume, token) is not None
+
+
+def test_doctor_list(bench, doctors):
+    assert bench(doctors.all)
+
+
+def test_doctor_directory(bench, directory):
+    assert bench(directory.all)
+
+
+def test_doctor_search(bench, doctors):
+    assert bench(doctors.search, "card", 20)
+
+
+def test_patient_appointments(bench, appointments, patient_id):
+    assert bench(appointments.page_for_patient, patient_id)
+
+
+def test_patient_upcoming_appointments(bench, appointments, patient_id):
+    bench(appointments.page_for_patient, patient_id, date_from="2025-01-01")
+
+
+def test_doctor_appointments(bench, appointments, doctor_id):
+    assert bench(appointments.page_for_doctor, doctor_id)
+
+
+def test_doctor_appointments_newest_first(bench, appointments, doctor_id):
+    assert bench(appointments.page_for_doctor, doctor_id, descending=True)
+
+
+def test_doctor_appointments_with_history(bench, appointments, doctor_id):
+    assert bench(appointments.page_for_doctor, doctor_id, include_history=True)
+
+
+def test_book(bench, appointments, patient_id, doctor_id):
+    bench(lambda: appointments.book(patient_id, doctor_id, next(future_minutes)))
+
+
+def test_book_series(bench, appointments, patient_id, doctor_id):
+    # Twelve weekly appointments
+    def book_series():
+        return appointments.book_series(patient_id, doctor_id, recurrence(next(series_starts), 'weekly', 12))
+
+    assert len(bench(book_series)) == 12
+
+
+def test_cancel(bench, appointments, patient_id, doctor_id):
+    def setup():
+        appointment_id = appointments.book(patient_id, doctor_id, next(future_minutes))
+        return (appointment_id, "Benchmark", patient_id), {}
+
+    bench.pedantic(appointments.cancel, setup=setup, rounds=200)
+
+
+def test_cancel_with_waitlist(bench, appointments, waitlist, patient_id, doctor_id):
+    # The freed slot goes straight to a waiting patient
+    def setup():
+        start_minute = next(future_minutes)
+        appointment_id = appointments.book(patient_id, doctor_id, start_minute)
+        date = decode(start_minute)[0]
+        waitlist.join(patient_id, doctor_id, date, date)
+        return (appointment_id, "Benchmark", patient_id), {}
+
+    bench.pedantic(appointments.cancel, setup=setup, rounds=200)
+
+
+def test_notifications_recent(bench, notifications, recipient_id):
+    assert bench(notifications.recent, recipient_id, 200)
+
+
+def test_notifications_since(bench, notifications, recipient_id):
+    bench(notifications.since, recipient_id, 0)
+
+
+def test_unread_count(bench, notifications, recipient_id):
+    bench(notifications.unread_count, recipient_id)
+
+
+def test_report_doctor_days(bench, stats, doctor_id):
+    assert len(bench(stats.by_day, doctor_id, "2024-01-01", "2024-12-31")) == 366
+
+
+def test_report_by_doctor(bench, stats):
+    assert bench(stats.by_doctor, "2024-01-01", "2024-03-31")
+
+
+def test_report_by_speciality(bench, stats):
+    assert bench(stats.by_speciality, "2024-01-01", "2024-03-31")
+
+
+def test_calendar_month(bench, appointments, doctor_id):
+    # The doctor's Calendar tab: one range query, then the matrix summary
+    schedule = pytest.importorskip('schedule')
+    first_day, days = schedule.view_range('month', midnight_of("2024-03-01") // MINUTES_PER_DAY)
+
+    def month():
+        return schedule.ScheduleGrid(first_day, days, appointments.doctor_schedule(doctor_id, first_day, days)).totals()
+
+    assert bench(month)['capacity'] > 0
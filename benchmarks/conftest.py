@@ -0,0 +1,109 @@
+import os
+import shutil
+import statistics
+
+import pytest
+
+from benchmarks.generate import SCALES, generate
+from repository import AppointmentRepo, ConnectionPool, DoctorDirectory, DoctorRepo, NotificationRepo, StatsRepo, UserRepo, WaitlistRepo
+
+# Generated databases are cached here, one per scale, since the larger ones
+# take minutes to build. Each session benchmarks a fresh copy, so the write
+# benchmarks never change the cached data.
+DATA_DIR = os.path.join(os.path.dirname(__file__), '.data')
+
+
+def pytest_addoption(parser):
+    parser.addoption('--scale', choices=SCALES, default='10k', help="synthetic data size to benchmark against")
+
+
+@pytest.fixture(scope='session')
+def scale(request):
+    return request.config.getoption('--scale')
+
+
+@pytest.fixture(scope='session')
+def pool(scale, tmp_path_factory):
+    cached = os.path.join(DATA_DIR, f'{scale}.db')
+    if not os.path.exists(cached):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        generate(cached + '.partial', *SCALES[scale])
+        os.replace(cached + '.partial', cached)
+    path = tmp_path_factory.mktemp('bench') / 'bench.db'
+    shutil.copyfile(cached, path)
+    pool = ConnectionPool(str(path), size=1)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture(scope='session')
+def users(pool):
+    return UserRepo(pool)
+
+
+@pytest.fixture(scope='session')
+def doctors(pool):
+    return DoctorRepo(pool)
+
+
+@pytest.fixture(scope='session')
+def directory(pool):
+    return DoctorDirectory(pool)
+
+
+@pytest.fixture(scope='session')
+def appointments(pool):
+    return AppointmentRepo(pool)
+
+
+@pytest.fixture(scope='session')
+def notifications(pool):
+    return NotificationRepo(pool)
+
+
+@pytest.fixture(scope='session')
+def stats(pool):
+    return StatsRepo(pool)
+
+
+@pytest.fixture(scope='session')
+def waitlist(pool):
+    return WaitlistRepo(pool)
+
+
+@pytest.fixture(scope='session', params=['busiest', 'typical'])
+def doctor_id(request, pool):
+    return _by_activity(pool, 'doctor_id', request.param)
+
+
+@pytest.fixture(scope='session', params=['busiest', 'typical'])
+def patient_id(request, pool):
+    return _by_activity(pool, 'patient_id', request.param)
+
+
+@pytest.fixture(scope='session', params=['busiest', 'typical'])
+def recipient_id(request, pool):
+    return _by_activity(pool, 'recipient_id', request.param, table='notifications')
+
+
+def _by_activity(pool, column, which, table='appointments'):
+    # The id with the most rows, or the median one
+    ids = [row[0] for row in pool.connection().execute(
+        f"SELECT {column} FROM {table} GROUP BY {column} ORDER BY count(*) DESC, {column}"
+    )]
+    return ids[0] if which == 'busiest' else ids[len(ids) // 2]
+
+
+@pytest.fixture
+def bench(benchmark, scale):
+    # pytest-benchmark reports mean/median/min/max; tail latency is what the
+    # GUI user feels, so p50 and p99 are added to every result (and to the
+    # --benchmark-json output, for comparing runs).
+    benchmark.group = benchmark.name.split('[')[0]
+    benchmark.extra_info['scale'] = scale
+    yield benchmark
+    stats = getattr(benchmark.stats, 'stats', None)
+    if stats is not None and len(stats.data) >= 2:
+        cuts = statistics.quantiles(stats.data, n=100)
+        benchmark.extra_info['p50'] = cuts[49]
+        benchmark.extra_info['p99'] = cuts[98]
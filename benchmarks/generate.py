@@ -0,0 +1,172 @@
+import argparse
+import calendar
+import random
+import sys
+from datetime import date, timedelta
+
+import bulk
+from auth import hash_password
+from availability import DAY_END, DAY_START, MINUTES_PER_DAY, SLOT_MINUTES, WORKING_WEEKDAYS, decode
+from repository import DB_PATH, ConnectionPool
+
+# Reproducible synthetic data for benchmarking. The same arguments and seed
+# always produce the same database. Activity is skewed the way a real clinic's
+# is: doctor and patient popularity follow a Zipf-like curve, so a few doctors
+# carry full diaries while most see a handful of patients.
+#
+#   python -m benchmarks.generate --db /tmp/bench.db --scale 1m
+
+# name: (users, doctors, appointments, notifications)
+SCALES = {
+    '10k': (1000, 50, 10000, 2000),
+    '1m': (50000, 500, 1000000, 100000),
+    '10m': (500000, 5000, 10000000, 1000000),
+}
+
+SPECIALITIES = [
+    "Cardiology", "Dermatology", "Pediatrics", "Neurology", "Orthopedics",
+    "General Practice", "Psychiatry", "Ophthalmology", "Oncology", "Gynecology",
+]
+PASSWORD = "password"
+FIRST_DAY = date(2023, 1, 2)  # appointments run from here over `years` years
+
+
+def zipf_weights(count, exponent):
+    return [1 / rank ** exponent for rank in range(1, count + 1)]
+
+
+def working_days(first_day, years):
+    # Midnight (epoch minutes) of every working day in the span
+    days = []
+    day, end = first_day, first_day.replace(year=first_day.year + years)
+    while day < end:
+        if day.weekday() in WORKING_WEEKDAYS:
+            days.append(calendar.timegm(day.timetuple()) // 60)
+        day += timedelta(days=1)
+    return days
+
+
+def share_out(total, weights, capacity):
+    # Split `total` bookings across doctors in proportion to their weights,
+    # never giving anyone more than `capacity`; what the busiest can't take
+    # goes to whoever still has room.
+    scale = total / sum(weights)
+    counts = [min(int(weight * scale), capacity) for weight in weights]
+    left = total - sum(counts)
+    while left > 0:
+        room = [index for index, count in enumerate(counts) if count < capacity]
+        if not room:
+            break
+        for index in room[:left]:
+            counts[index] += 1
+        left = total - sum(counts)
+    return counts
+
+
+def generate(path, users, doctors, appointments, notifications, seed=1, years=3, batch_size=bulk.BATCH_SIZE):
+    rng = random.Random(seed)
+    pool = ConnectionPool(path, size=1)
+    conn = pool.connection()
+    try:
+        password_hash = hash_password(PASSWORD)
+        patient_records = (
+            (n, {'username': f'patient{n}', 'password_hash': password_hash, 'role': 'patient'})
+            for n in range(users)
+        )
+        doctor_records = (
+            (n, {'username': f'doctor{n}', 'password_hash': password_hash, 'role': 'doctor',
+                 'speciality': SPECIALITIES[n % len(SPECIALITIES)], 'email': f'doctor{n}@example.com'})
+            for n in range(doctors)
+        )
+        bulk.import_users(conn, patient_records, batch_size=batch_size)
+        bulk.import_users(conn, doctor_records, batch_size=batch_size)
+
+        # Ids in popularity order: patient0 and doctor0 are the busiest
+        ids = dict(conn.execute("SELECT username, id FROM users"))
+        patient_ids = [ids[f'patient{n}'] for n in range(users)]
+        doctor_ids = [ids[f'doctor{n}'] for n in range(doctors)]
+        user_ids = patient_ids + doctor_ids
+        patient_weights = list(_cumulative(zipf_weights(users, 0.8)))
+        user_weights = list(_cumulative(zipf_weights(len(user_ids), 0.8)))
+
+        days = working_days(FIRST_DAY, years)
+        first_slot = -(-DAY_START // SLOT_MINUTES)
+        per_day = DAY_END // SLOT_MINUTES - first_slot
+        capacity = len(days) * per_day
+        counts = share_out(appointments, zipf_weights(doctors, 1.0), capacity)
+
+        def appointment_rows():
+            for doctor_id, count in zip(doctor_ids, counts):
+                patients = rng.choices(patient_ids, cum_weights=patient_weights, k=count)
+                for patient_id, index in zip(patients, rng.sample(range(capacity), count)):
+                    start_minute = days[index // per_day] + (first_slot + index % per_day) * SLOT_MINUTES
+                    yield (patient_id, doctor_id) + decode(start_minute) + (start_minute, start_minute // SLOT_MINUTES)
+
+        def notification_rows():
+            span = days[-1] + MINUTES_PER_DAY - days[0]
+            for _ in range(notifications):
+                recipient_id = rng.choices(user_ids, cum_weights=user_weights)[0]
+                doctor_id = rng.choice(doctor_ids)
+                start_minute = days[0] + rng.randrange(span) // SLOT_MINUTES * SLOT_MINUTES
+                date_text, time_text = decode(start_minute)
+                message = (
+                    f"Patient patient{rng.randrange(users)} has cancelled the appointment on {date_text} at {time_text}.\n"
+                    f"Reason: {rng.choice(['Feeling better', 'Travelling', 'Clashes with work', 'Rebooked'])}"
+                )
+                yield recipient_id, doctor_id, message, date_text, time_text, start_minute
+
+        # Historical notifications aren't mailed, so the outbox trigger is off
+        with bulk.deferred_indexes(conn, ['appointments', 'notifications']), bulk.deferred_statistics(conn), \
+                bulk.suspended_triggers(conn, 'outbox_'):
+            for batch in bulk.batched(appointment_rows(), batch_size):
+                with conn:
+                    conn.executemany('''
+                        INSERT INTO appointments (patient_id, doctor_id, date, time, start_minute, slot)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', batch)
+            for batch in bulk.batched(notification_rows(), batch_size):
+                with conn:
+                    conn.executemany('''
+                        INSERT INTO notifications (recipient_id, doctor_id, message, date, time, start_minute)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', batch)
+        return sum(counts)
+    finally:
+        pool.close()
+
+
+def _cumulative(weights):
+    total = 0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.generate", description="Fill a database with synthetic data")
+    parser.add_argument('--db', default=DB_PATH, help="database to fill (default: %(default)s)")
+    parser.add_argument('--scale', choices=SCALES, default='10k', help="preset sizes (default: %(default)s)")
+    parser.add_argument('--users', type=int, help="patients to create")
+    parser.add_argument('--doctors', type=int)
+    parser.add_argument('--appointments', type=int)
+    parser.add_argument('--notifications', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--years', type=int, default=3, help="span of appointment dates")
+    args = parser.parse_args(argv)
+
+    users, doctors, appointments, notifications = SCALES[args.scale]
+    created = generate(
+        args.db,
+        args.users if args.users is not None else users,
+        args.doctors if args.doctors is not None else doctors,
+        args.appointments if args.appointments is not None else appointments,
+        args.notifications if args.notifications is not None else notifications,
+        seed=args.seed,
+        years=args.years,
+    )
+    print(f"Generated {created} appointments in {args.db}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
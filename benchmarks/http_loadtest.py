@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from availability import DAY_END, DAY_START, SLOT_MINUTES, decode, midnight_of
+from benchmarks.generate import PASSWORD, SCALES, generate
+from benchmarks.loadtest import histogram, percentile
+from repository import ConnectionPool
+from shards import ShardRouter
+
+# Load test for the HTTP service (server.py), entirely on localhost: starts
+# the server on a temporary copy of a database, then runs many concurrent
+# keep-alive clients, each signed in as a patient, through a mix of
+# requests. Reports requests per second, latency per endpoint and any
+# double bookings.
+#
+#   python -m benchmarks.http_loadtest --clients 64 --duration 20
+#   python -m benchmarks.http_loadtest --mix book=1 --max-batch 1   # without group commit
+#   python -m benchmarks.http_loadtest --mix book=1 --clinics 4     # hot doctors spread over 4 shards
+
+OPERATIONS = ('doctors', 'slots', 'book', 'view', 'cancel', 'notifications')
+DEFAULT_MIX = 'doctors=2,slots=2,book=3,view=3,cancel=1,notifications=2'
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Client:
+    # One keep-alive connection
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.token = None
+        self.reader = self.writer = None
+
+    async def request(self, method, path, payload=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode() if payload is not None else b''
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(body)}"]
+        if self.token:
+            head.append(f"Authorization: Bearer {self.token}")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Session:
+    def __init__(self, client, rng, doctor_ids, minutes, stats):
+        self.client = client
+        self.rng = rng
+        self.doctor_ids = doctor_ids
+        self.minutes = minutes
+        self.stats = stats
+        self.mine = []
+
+    async def run(self, username, deadline, mix):
+        status, body = await self.timed('login', 'POST', '/login', {'username': username, 'password': PASSWORD})
+        if status != 200:
+            raise RuntimeError(f"login failed: {body}")
+        self.client.token = body['token']
+        names, weights = list(mix), list(mix.values())
+        while time.monotonic() < deadline:
+            await getattr(self, 'do_' + self.rng.choices(names, weights)[0])()
+
+    async def timed(self, name, method, path, payload=None):
+        began = time.perf_counter()
+        status, body = await self.client.request(method, path, payload)
+        self.stats['latencies'][name].append(time.perf_counter() - began)
+        self.stats['outcomes'][f"{name}:{status}"] += 1
+        return status, body
+
+    async def do_doctors(self):
+        await self.timed('doctors', 'GET', f"/doctors?q={self.rng.choice(['card', 'derm', 'neuro', 'ped', ''])}")
+
+    async def do_slots(self):
+        date_text = decode(self.rng.choice(self.minutes))[0]
+        await self.timed('slots', 'GET', f"/doctors/{self.rng.choice(self.doctor_ids)}/slots?date={date_text}")
+
+    async def do_book(self):
+        date_text, time_text = decode(self.rng.choice(self.minutes))
+        doctor_id = self.rng.choice(self.doctor_ids)
+        status, body = await self.timed('book', 'POST', '/appointments',
+                                        {'doctor_id': doctor_id, 'date': date_text, 'time': time_text})
+        if status == 201:
+            self.mine.append((body['clinic'], body['id']))
+            self.stats['booked'].append((doctor_id, date_text, time_text, (body['clinic'], body['id']), time.time()))
+
+    async def do_view(self):
+        await self.timed('view', 'GET', '/appointments?limit=50')
+
+    async def do_cancel(self):
+        if not self.mine:
+            return
+        clinic, appointment_id = key = self.mine.pop(self.rng.randrange(len(self.mine)))
+        self.stats['cancelled'][key] = time.time()
+        await self.timed('cancel', 'POST', f"/appointments/{appointment_id}/cancel",
+                         {'reason': "Load test", 'clinic': clinic})
+
+    async def do_notifications(self):
+        await self.timed('notifications', 'GET', '/notifications')
+
+
+def start_server(path, readers, max_batch):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'server', '--db', path, '--port', '0', '--readers', str(readers),
+         '--max-batch', str(max_batch)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = process.stdout.readline()
+    if not line.startswith("Serving on"):
+        process.kill()
+        raise RuntimeError(f"server did not start: {line!r}")
+    return process, int(line.rsplit(':', 1)[1])
+
+
+async def load(port, usernames, doctor_ids, minutes, clients, duration, mix, seed):
+    stats = {'latencies': defaultdict(list), 'outcomes': Counter(), 'booked': [], 'cancelled': {}}
+    deadline = time.monotonic() + duration
+    connections = [Client('127.0.0.1', port) for _ in range(clients)]
+    sessions = [
+        Session(client, random.Random(seed * 1000 + index), doctor_ids, minutes, stats)
+        for index, client in enumerate(connections)
+    ]
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(
+            session.run(usernames[index % len(usernames)], deadline, mix) for index, session in enumerate(sessions)
+        ))
+    finally:
+        for client in connections:
+            client.close()
+    return stats, time.monotonic() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.http_loadtest", description="HTTP service load test")
+    parser.add_argument('--clients', type=int, default=32, help="concurrent connections (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default: %(default)s)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"weights (default: {DEFAULT_MIX})")
+    parser.add_argument('--db', help="database to copy as the starting point (default: generate one)")
+    parser.add_argument('--scale', choices=SCALES, default='10k', help="size of the generated starting point")
+    parser.add_argument('--readers', type=int, default=8, help="server read threads (default: %(default)s)")
+    parser.add_argument('--max-batch', type=int, default=64, help="server group commit size (default: %(default)s)")
+    parser.add_argument('--hot-doctors', type=int, default=5, help="doctors that bookings compete for")
+    parser.add_argument('--hot-days', type=int, default=5, help="days that bookings compete for")
+    parser.add_argument('--clinics', type=int, default=0, help="clinic shards to spread the hot doctors over")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='http-loadtest-')
+    path = os.path.join(directory, 'loadtest.db')
+    server = None
+    try:
+        if args.db:
+            shutil.copyfile(args.db, path)
+        else:
+            generate(path, *SCALES[args.scale], seed=args.seed)
+        conn = sqlite3.connect(path)
+        usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE role = 'patient' LIMIT ?", (args.clients,))]
+        doctor_ids = [row[0] for row in conn.execute("SELECT id FROM doctors ORDER BY id LIMIT ?", (args.hot_doctors,))]
+        conn.close()
+        paths = [path] + split_clinics(path, doctor_ids, args.clinics)
+        first_day = midnight_of((date.today() + timedelta(days=3650)).isoformat())
+        minutes = [
+            first_day + day * 24 * 60 + slot * SLOT_MINUTES
+            for day in range(args.hot_days)
+            for slot in range(-(-DAY_START // SLOT_MINUTES), DAY_END // SLOT_MINUTES)
+        ]
+
+        server, port = start_server(path, args.readers, args.max_batch)
+        stats, elapsed = asyncio.run(load(port, usernames, doctor_ids, minutes, args.clients, args.duration, args.mix, args.seed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    try:
+        return report(stats, elapsed, paths, args, first_day)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def split_clinics(path, doctor_ids, clinics):
+    # Moves the doctors round robin into `clinics` new shards beside path;
+    # returns the shard files
+    pool = ConnectionPool(path, size=1)
+    router = ShardRouter(pool, size=1, workers=1)
+    try:
+        clinic_ids = [router.add_clinic(f"Clinic {index + 1}", f"clinic{index + 1}.db") for index in range(clinics)]
+        for index, doctor_id in enumerate(doctor_ids if clinics else ()):
+            router.assign(doctor_id, clinic_ids[index % clinics])
+        return [router.pool(clinic_id).path for clinic_id in clinic_ids]
+    finally:
+        router.close()
+        pool.close()
+
+
+def report(stats, elapsed, paths, args, first_day):
+    latencies = stats['latencies']
+    total = sum(len(values) for name, values in latencies.items() if name != 'login')
+    print(f"{args.clients} clients, {elapsed:.1f}s, readers={args.readers} max_batch={args.max_batch} "
+          f"clinics={args.clinics}")
+    print(f"Throughput: {total / elapsed:,.0f} requests/s ({total} requests, logins not counted)")
+
+    # A slot confirmed to two clients at once, or stored twice
+    holds = defaultdict(list)
+    for doctor_id, date_text, time_text, appointment_id, booked_at in stats['booked']:
+        holds[doctor_id, date_text, time_text].append((booked_at, stats['cancelled'].get(appointment_id, float('inf'))))
+    told_twice = sum(
+        any(later[0] < earlier[1] for earlier, later in zip(sorted(windows), sorted(windows)[1:]))
+        for windows in holds.values()
+    )
+    stored_twice = 0
+    for path in paths:
+        conn = sqlite3.connect(path)
+        stored_twice += conn.execute(f'''
+            SELECT count(*) FROM (
+                SELECT 1 FROM appointments WHERE start_minute >= ?
+                GROUP BY doctor_id, start_minute / {SLOT_MINUTES} HAVING count(*) > 1
+            )
+        ''', (first_day,)).fetchone()[0]
+        conn.close()
+    print(f"Double bookings: {told_twice} slots confirmed twice, {stored_twice} slots stored twice")
+
+    for name in ('login',) + OPERATIONS:
+        values = sorted(latencies.get(name, []))
+        if not values:
+            continue
+        statuses = ', '.join(f"{outcome.split(':', 1)[1]}: {count}" for outcome, count in sorted(stats['outcomes'].items())
+                             if outcome.startswith(name + ':'))
+        print(f"\n{name}: {len(values)} requests ({statuses}), {len(values) / elapsed:,.0f}/s")
+        print(f"    p50 {percentile(values, 0.5) * 1000:.2f} ms, p90 {percentile(values, 0.9) * 1000:.2f} ms, "
+              f"p99 {percentile(values, 0.99) * 1000:.2f} ms, max {values[-1] * 1000:.2f} ms")
+        for line in histogram(values):
+            print(line)
+    failed = sum(count for outcome, count in stats['outcomes'].items() if outcome.split(':')[1] >= '500')
+    return 1 if told_twice or stored_twice or failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from availability import DAY_END, DAY_START, SLOT_MINUTES, midnight_of
+from benchmarks.generate import PASSWORD, SCALES, generate
+from repository import AppointmentRepo, ConnectionPool, NotificationRepo, SlotTakenError, UserRepo
+
+# Several front-desk instances sharing one database file, simulated by
+# headless worker processes that replay a mix of logins, bookings,
+# appointment views and cancellations against a temporary copy.
+#
+#   python -m benchmarks.loadtest --workers 8 --duration 20 --mix login=1,book=4,view=4,cancel=1
+#   python -m benchmarks.loadtest --journal-mode DELETE --synchronous FULL --busy-timeout 0
+#
+# Bookings are aimed at a small set of doctors and days so that workers
+# really do race for the same slots. Lock waits that outlast busy_timeout
+# surface as SQLITE_BUSY errors; the worker backs off and retries, and the
+# retries are counted. With --busy-timeout 0 every lock wait shows up there.
+
+OPERATIONS = ('login', 'book', 'view', 'cancel', 'notifications')
+DEFAULT_MIX = 'login=1,book=4,view=4,cancel=1,notifications=2'
+HISTOGRAM_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+class Worker:
+    def __init__(self, index, options):
+        self.options = options
+        self.rng = random.Random(options['seed'] * 1000 + index)
+        self.pool = ConnectionPool(
+            options['path'], size=1,
+            busy_timeout=options['busy_timeout'],
+            journal_mode=options['journal_mode'],
+            synchronous=options['synchronous'],
+        )
+        self.user_repo = UserRepo(self.pool)
+        self.appointment_repo = AppointmentRepo(self.pool)
+        self.notification_repo = NotificationRepo(self.pool)
+        self.latencies = defaultdict(list)
+        self.outcomes = Counter()
+        self.busy_retries = 0
+        # Every booking this worker was told it got, as (doctor_id, slot,
+        # appointment_id, wall-clock time the booking returned), and when it
+        # started cancelling any of them.
+        self.booked = []
+        self.cancelled = {}
+        self.mine = []  # (appointment_id, patient_id) still available to cancel
+
+    def run(self, start, deadline):
+        conn = self.pool.connection()
+        patients = conn.execute("SELECT id, username FROM users WHERE role = 'patient' LIMIT 5000").fetchall()
+        self.patient_ids = [patient_id for patient_id, _ in patients]
+        self.usernames = [username for _, username in patients]
+        self.doctor_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM doctors ORDER BY id LIMIT ?", (self.options['hot_doctors'],)
+        )]
+        first_day = midnight_of(self.options['first_day'])
+        first_slot = -(-DAY_START // SLOT_MINUTES)
+        self.minutes = [
+            first_day + day * 24 * 60 + slot * SLOT_MINUTES
+            for day in range(self.options['hot_days'])
+            for slot in range(first_slot, DAY_END // SLOT_MINUTES)
+        ]
+        names = list(self.options['mix'])
+        weights = list(self.options['mix'].values())
+        start.wait()
+        while time.monotonic() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            operation = getattr(self, 'do_' + name)
+            began = time.perf_counter()
+            self.outcomes[f"{name}:{self.attempt(operation)}"] += 1
+            self.latencies[name].append(time.perf_counter() - began)
+        self.pool.close()
+        return {
+            'latencies': dict(self.latencies),
+            'outcomes': self.outcomes,
+            'busy_retries': self.busy_retries,
+            'booked': self.booked,
+            'cancelled': self.cancelled,
+        }
+
+    def attempt(self, operation):
+        delay = 0.001
+        while True:
+            try:
+                return operation()
+            except sqlite3.OperationalError as error:
+                if not _is_busy(error):
+                    raise
+                self.busy_retries += 1
+                time.sleep(delay * self.rng.random())
+                delay = min(delay * 2, 0.1)
+
+    def do_login(self):
+        found = self.user_repo.authenticate(self.rng.choice(self.usernames), PASSWORD)
+        return 'ok' if found else 'failed'
+
+    def do_book(self):
+        patient_id = self.rng.choice(self.patient_ids)
+        doctor_id = self.rng.choice(self.doctor_ids)
+        start_minute = self.rng.choice(self.minutes)
+        try:
+            appointment_id = self.appointment_repo.book(patient_id, doctor_id, start_minute)
+        except SlotTakenError:
+            return 'slot taken'
+        self.booked.append((doctor_id, start_minute // SLOT_MINUTES, appointment_id, time.time()))
+        self.mine.append((appointment_id, patient_id))
+        return 'ok'
+
+    def do_view(self):
+        if self.rng.random() < 0.5:
+            self.appointment_repo.page_for_patient(self.rng.choice(self.patient_ids))
+        else:
+            self.appointment_repo.page_for_doctor(self.rng.choice(self.doctor_ids))
+        return 'ok'
+
+    def do_cancel(self):
+        if not self.mine:
+            return 'nothing to cancel'
+        appointment_id, patient_id = self.mine.pop(self.rng.randrange(len(self.mine)))
+        self.cancelled[appointment_id] = time.time()
+        if self.appointment_repo.cancel(appointment_id, "Load test", patient_id) is None:
+            return 'gone'
+        return 'ok'
+
+    def do_notifications(self):
+        self.notification_repo.recent(self.rng.choice(self.doctor_ids), 50)
+        return 'ok'
+
+
+def _worker_main(index, options, start, deadline, results):
+    try:
+        results.put((index, Worker(index, options).run(start, deadline)))
+    except Exception as error:
+        results.put((index, error))
+
+
+def run(options, workers, duration):
+    # spawn, not fork: each worker starts cold like a separate app instance
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    results = context.Queue()
+    spawn_allowance = 5 + workers * 0.5
+    deadline = time.monotonic() + spawn_allowance + duration
+    processes = [
+        context.Process(target=_worker_main, args=(index, options, start, deadline, results))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Give every process time to import and open the database, then let them
+    # all go at once.
+    time.sleep(max(0, deadline - duration - time.monotonic()))
+    started = time.monotonic()
+    start.set()
+    collected = [results.get() for _ in processes]
+    elapsed = time.monotonic() - started
+    for process in processes:
+        process.join()
+    failures = [(index, result) for index, result in collected if isinstance(result, Exception)]
+    if failures:
+        raise RuntimeError(f"worker {failures[0][0]} failed: {failures[0][1]!r}")
+    return [result for _, result in collected], elapsed
+
+
+def double_bookings(path, reports, first_day):
+    # Two kinds of violation: two workers both told they got the same slot,
+    # and two rows holding the same doctor and slot in the database (only
+    # the load test's own window is checked, legacy clashes don't count).
+    # A slot can legitimately be booked again once cancelled. A worker holds
+    # its slot from the moment its booking returned until it began
+    # cancelling; those windows are inside the real commit-to-commit ones,
+    # so any overlap between two of them is a true double booking.
+    cancelled = {}
+    for report in reports:
+        cancelled.update(report['cancelled'])
+    holds = defaultdict(list)
+    for report in reports:
+        for doctor_id, slot, appointment_id, booked_at in report['booked']:
+            holds[doctor_id, slot].append((booked_at, cancelled.get(appointment_id, float('inf'))))
+    told_twice = 0
+    for windows in holds.values():
+        windows.sort()
+        if any(later[0] < earlier[1] for earlier, later in zip(windows, windows[1:])):
+            told_twice += 1
+    conn = sqlite3.connect(path)
+    try:
+        stored_twice = conn.execute(f'''
+            SELECT count(*) FROM (
+                SELECT 1 FROM appointments
+                WHERE start_minute >= ?
+                GROUP BY doctor_id, start_minute / {SLOT_MINUTES}
+                HAVING count(*) > 1
+            )
+        ''', (midnight_of(first_day),)).fetchone()[0]
+    finally:
+        conn.close()
+    return told_twice, stored_twice
+
+
+def histogram(latencies, width=40):
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for seconds in latencies:
+        milliseconds = seconds * 1000
+        bucket = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if milliseconds <= bound), len(HISTOGRAM_BUCKETS_MS))
+        counts[bucket] += 1
+    peak = max(counts) or 1
+    lines = []
+    for i, count in enumerate(counts):
+        if not count:
+            continue
+        label = f"<= {HISTOGRAM_BUCKETS_MS[i]:g} ms" if i < len(HISTOGRAM_BUCKETS_MS) else f"> {HISTOGRAM_BUCKETS_MS[-1]:g} ms"
+        lines.append(f"    {label:>12} {count:>8} {'#' * max(1, round(count / peak * width))}")
+    return lines
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(reports, elapsed, path, options):
+    latencies = defaultdict(list)
+    outcomes = Counter()
+    busy_retries = 0
+    for result in reports:
+        for name, values in result['latencies'].items():
+            latencies[name].extend(values)
+        outcomes.update(result['outcomes'])
+        busy_retries += result['busy_retries']
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{len(reports)} workers, {elapsed:.1f}s, journal_mode={options['journal_mode']} "
+          f"synchronous={options['synchronous']} busy_timeout={options['busy_timeout']}ms")
+    print(f"Throughput: {total / elapsed:,.0f} ops/s ({total} operations)")
+    print(f"SQLITE_BUSY retries: {busy_retries}")
+    told_twice, stored_twice = double_bookings(path, reports, options['first_day'])
+    print(f"Double bookings: {told_twice} slots confirmed to two workers, {stored_twice} slots stored twice")
+    for name in OPERATIONS:
+        values = sorted(latencies.get(name, []))
+        if not values:
+            continue
+        results = ', '.join(f"{outcome.split(':', 1)[1]} {count}" for outcome, count in sorted(outcomes.items())
+                            if outcome.startswith(name + ':'))
+        print(f"\n{name}: {len(values)} ops ({results}), {len(values) / elapsed:,.0f}/s")
+        print(f"    p50 {percentile(values, 0.5) * 1000:.2f} ms, p90 {percentile(values, 0.9) * 1000:.2f} ms, "
+              f"p99 {percentile(values, 0.99) * 1000:.2f} ms, max {values[-1] * 1000:.2f} ms")
+        for line in histogram(values):
+            print(line)
+    return 1 if told_twice or stored_twice else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadtest", description="Concurrent booking load test")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default: %(default)s)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"weights (default: {DEFAULT_MIX})")
+    parser.add_argument('--db', help="database to copy as the starting point (default: generate one)")
+    parser.add_argument('--scale', choices=SCALES, default='10k', help="size of the generated starting point")
+    parser.add_argument('--hot-doctors', type=int, default=5, help="doctors that bookings compete for")
+    parser.add_argument('--hot-days', type=int, default=5, help="days that bookings compete for")
+    parser.add_argument('--busy-timeout', type=int, default=5000, help="ms (default: %(default)s)")
+    parser.add_argument('--journal-mode', default='WAL', choices=['WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY'])
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help="keep the temporary database")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    path = os.path.join(directory, 'loadtest.db')
+    try:
+        if args.db:
+            shutil.copyfile(args.db, path)
+        else:
+            generate(path, *SCALES[args.scale], seed=args.seed)
+        # The journal mode is a property of the file in WAL's case, so set it
+        # once up front rather than having workers fight over it.
+        conn = sqlite3.connect(path)
+        conn.execute(f"PRAGMA journal_mode={args.journal_mode}")
+        conn.close()
+
+        options = {
+            'path': path,
+            'mix': args.mix,
+            'seed': args.seed,
+            'busy_timeout': args.busy_timeout,
+            'journal_mode': args.journal_mode,
+            'synchronous': args.synchronous,
+            'hot_doctors': args.hot_doctors,
+            'hot_days': args.hot_days,
+            # Well clear of any generated appointments
+            'first_day': (date.today() + timedelta(days=3650)).isoformat(),
+        }
+        reports, elapsed = run(options, args.workers, args.duration)
+        return report(reports, elapsed, path, options)
+    finally:
+        if args.keep:
+            print(f"\nDatabase kept at {path}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
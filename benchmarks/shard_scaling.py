@@ -0,0 +1,195 @@
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from availability import DAY_END, DAY_START, SLOT_MINUTES, midnight_of
+from benchmarks.generate import SCALES, generate
+from benchmarks.http_loadtest import split_clinics
+from benchmarks.loadtest import _is_busy, percentile
+from repository import ConnectionPool, SlotTakenError
+from shards import ShardRouter
+
+# Booking throughput as clinics move into shards of their own. Worker
+# processes, like separate app instances, book through shards.ShardRouter
+# for doctors spread round robin over N clinic shards; with one "clinic"
+# everything stays in the main database, as before sharding.
+#
+#   python -m benchmarks.shard_scaling --workers 8 --clinics 1,2,4,8
+#   python -m benchmarks.shard_scaling --synchronous FULL     # an fsync per commit
+#   python -m benchmarks.shard_scaling --hold-ms 2
+#
+# Each round starts from a fresh copy of the same generated database.
+# --hold-ms keeps each booking's write lock that much longer, standing in
+# for a slow disk: on fast storage with few cores, bookings are bound by CPU
+# rather than by the lock, and sharding has little to win.
+
+PATIENTS = "SELECT id FROM users WHERE role = 'patient' ORDER BY id LIMIT 1000"
+
+
+def enlist(path):
+    # Patients' first booking at a clinic copies them into its shard; do
+    # that up front, so the rounds time bookings alone
+    pool = ConnectionPool(path, size=1)
+    router = ShardRouter(pool, size=1, workers=1)
+    try:
+        patient_ids = [row[0] for row in pool.connection().execute(PATIENTS)]
+        clinic_ids = [row[0] for row in router.clinics()]
+        with pool.transaction():
+            for clinic_id in clinic_ids:
+                for patient_id in patient_ids:
+                    router.enlist(patient_id, clinic_id)
+    finally:
+        router.close()
+        pool.close()
+
+
+def _worker_main(index, options, start, deadline, results):
+    try:
+        results.put(run_worker(index, options, start, deadline))
+    except Exception as error:
+        results.put(error)
+
+
+def run_worker(index, options, start, deadline):
+    rng = random.Random(options['seed'] * 1000 + index)
+    pool = ConnectionPool(options['path'], size=1, synchronous=options['synchronous'])
+    router = ShardRouter(pool, size=1, workers=1)
+    conn = pool.connection()
+    patient_ids = [row[0] for row in conn.execute(PATIENTS)]
+    doctor_ids = [row[0] for row in conn.execute("SELECT id FROM doctors ORDER BY id LIMIT ?", (options['doctors'],))]
+    for doctor_id in doctor_ids:
+        router.pool(router.clinic_of(doctor_id)).connection().execute(f"PRAGMA synchronous={options['synchronous']}")
+    first_day = midnight_of(options['first_day'])
+    minutes = [
+        first_day + day * 24 * 60 + slot * SLOT_MINUTES
+        for day in range(options['days'])
+        for slot in range(-(-DAY_START // SLOT_MINUTES), DAY_END // SLOT_MINUTES)
+    ]
+    latencies, booked, taken, busy_retries = [], 0, 0, 0
+    start.wait()
+    try:
+        while time.monotonic() < deadline:
+            began = time.perf_counter()
+            delay = 0.001
+            while True:
+                try:
+                    book(router, rng.choice(patient_ids), rng.choice(doctor_ids), rng.choice(minutes),
+                         options['hold'])
+                    booked += 1
+                except SlotTakenError:
+                    taken += 1
+                except sqlite3.OperationalError as error:
+                    if not _is_busy(error):
+                        raise
+                    busy_retries += 1
+                    time.sleep(delay * rng.random())
+                    delay = min(delay * 2, 0.1)
+                    continue
+                break
+            latencies.append(time.perf_counter() - began)
+    finally:
+        router.close()
+        pool.close()
+    return {'latencies': latencies, 'booked': booked, 'taken': taken, 'busy_retries': busy_retries}
+
+
+def book(router, patient_id, doctor_id, start_minute, hold):
+    if not hold:
+        return router.book(patient_id, doctor_id, start_minute)
+    clinic_id = router.clinic_of(doctor_id)
+    with router.pool(clinic_id).transaction(immediate=True):
+        time.sleep(hold)
+        return router.book(patient_id, doctor_id, start_minute)
+
+
+def run_round(options, workers, duration):
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    results = context.Queue()
+    deadline = time.monotonic() + 5 + workers * 0.5 + duration
+    processes = [
+        context.Process(target=_worker_main, args=(index, options, start, deadline, results))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(max(0, deadline - duration - time.monotonic()))
+    started = time.monotonic()
+    start.set()
+    collected = [results.get() for _ in processes]
+    elapsed = time.monotonic() - started
+    for process in processes:
+        process.join()
+    failures = [result for result in collected if isinstance(result, Exception)]
+    if failures:
+        raise RuntimeError(f"a worker failed: {failures[0]!r}")
+    return collected, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.shard_scaling", description="Booking throughput per clinic count")
+    parser.add_argument('--workers', type=int, default=8, help="booking processes (default: %(default)s)")
+    parser.add_argument('--clinics', default='1,2,4,8', help="clinic counts to compare (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per round (default: %(default)s)")
+    parser.add_argument('--db', help="database to copy as the starting point (default: generate one)")
+    parser.add_argument('--scale', choices=SCALES, default='10k', help="size of the generated starting point")
+    parser.add_argument('--doctors', type=int, default=16, help="doctors booked, spread over the clinics")
+    parser.add_argument('--days', type=int, default=365, help="days booked into (default: %(default)s)")
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'])
+    parser.add_argument('--hold-ms', type=float, default=0, help="extra time each booking holds the write lock")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='shard-scaling-')
+    source = os.path.join(directory, 'source.db')
+    try:
+        if args.db:
+            shutil.copyfile(args.db, source)
+        else:
+            generate(source, *SCALES[args.scale], seed=args.seed)
+        conn = sqlite3.connect(source)
+        doctor_ids = [row[0] for row in conn.execute("SELECT id FROM doctors ORDER BY id LIMIT ?", (args.doctors,))]
+        conn.close()
+
+        print(f"{args.workers} workers, {args.duration:.0f}s per round, synchronous={args.synchronous} "
+              f"hold={args.hold_ms:g}ms")
+        baseline = None
+        for clinics in (int(part) for part in args.clinics.split(',')):
+            round_directory = os.path.join(directory, f"clinics-{clinics}")
+            os.mkdir(round_directory)
+            path = os.path.join(round_directory, 'main.db')
+            shutil.copyfile(source, path)
+            split_clinics(path, doctor_ids, clinics if clinics > 1 else 0)
+            enlist(path)
+            options = {
+                'path': path,
+                'seed': args.seed,
+                'doctors': args.doctors,
+                'days': args.days,
+                'synchronous': args.synchronous,
+                'hold': args.hold_ms / 1000,
+                # Well clear of any generated appointments
+                'first_day': (date.today() + timedelta(days=3650)).isoformat(),
+            }
+            reports, elapsed = run_round(options, args.workers, args.duration)
+            latencies = sorted(value for result in reports for value in result['latencies'])
+            throughput = len(latencies) / elapsed
+            baseline = baseline or throughput
+            print(f"{clinics:>3} clinic(s): {throughput:8,.0f} bookings/s ({throughput / baseline:.2f}x), "
+                  f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, "
+                  f"{sum(result['busy_retries'] for result in reports)} busy retries, "
+                  f"{sum(result['taken'] for result in reports)} slots taken")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
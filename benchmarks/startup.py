@@ -0,0 +1,91 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+# Wall-clock startup times, from launching the interpreter to:
+#   gui      the login window being drawn ("import sqlite3.py" --startup-check)
+#   headless the command-line tools being ready (python -m manage --help)
+# "cold" runs start with the project's bytecode caches deleted, so its own
+# modules are compiled from source (the standard library keeps its shipped
+# caches); "warm" runs reuse them. --drop-caches also empties the OS page
+# cache before each cold run (Linux, as root).
+#
+#   python -m benchmarks.startup --runs 10
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MS = 300
+COMMANDS = {
+    'gui': [os.path.join(ROOT, 'import sqlite3.py'), '--startup-check'],
+    'headless': ['-m', 'manage', '--help'],
+}
+
+
+def clear_caches(drop_os_caches):
+    for directory, subdirectories, _ in os.walk(ROOT):
+        if '__pycache__' in subdirectories:
+            shutil.rmtree(os.path.join(directory, '__pycache__'), ignore_errors=True)
+            subdirectories.remove('__pycache__')
+    if drop_os_caches:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as handle:
+            handle.write('3\n')
+
+
+def time_run(command):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable] + command, cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit {result.returncode}")
+    return elapsed
+
+
+def measure(command, runs, cold, drop_os_caches=False):
+    timings = []
+    if not cold:
+        time_run(command)  # fill the caches
+    for _ in range(runs):
+        if cold:
+            clear_caches(drop_os_caches)
+        timings.append(time_run(command))
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup", description="Startup time benchmark")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--target-ms', type=float, default=TARGET_MS, help="GUI cold-start budget (default: %(default)s)")
+    parser.add_argument('--only', choices=COMMANDS)
+    parser.add_argument('--drop-caches', action='store_true', help="drop the OS page cache before cold runs")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for name, command in COMMANDS.items():
+        if args.only and name != args.only:
+            continue
+        for cold in (True, False):
+            label = f"{name} {'cold' if cold else 'warm'}"
+            try:
+                timings = measure(command, args.runs, cold, args.drop_caches)
+            except RuntimeError as error:
+                print(f"{label:>14}: failed ({error})")
+                status = 1
+                continue
+            median = statistics.median(timings)
+            verdict = ''
+            if name == 'gui' and cold:
+                verdict = f"  {'OK' if median <= args.target_ms else 'OVER'} (target {args.target_ms:g} ms)"
+                if median > args.target_ms:
+                    status = 1
+            print(f"{label:>14}: median {median:.0f} ms, min {min(timings):.0f} ms, max {max(timings):.0f} ms{verdict}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+import csv
+import itertools
+import json
+import os
+import sqlite3
+from contextlib import ExitStack, contextmanager
+
+from auth import hash_password
+from availability import SLOT_MINUTES, decode, encode
+from repository import rebuild_stats, restore_suspended
+
+# Bulk loading and dumping of whole tables. Records stream through
+# generators, so memory use doesn't grow with the size of the file:
+#   read_records -> validate_* -> batched -> executemany, one transaction per batch
+# Rows that fail validation are skipped and counted in ImportReport.
+
+BATCH_SIZE = 50000
+EXPORT_FETCH_SIZE = 1000
+
+
+class ImportReport:
+    def __init__(self):
+        self.loaded = 0
+        self.clashes = 0
+        self.rejected = []  # (line number, reason)
+
+    def reject(self, line, reason):
+        self.rejected.append((line, reason))
+
+
+def file_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    if fmt == 'csv':
+        return 'csv'
+    raise ValueError(f"Unknown file format for {path}; use .csv or .jsonl")
+
+
+def read_records(path, fmt=None):
+    # Yields (line number, dict) pairs, one record at a time. A JSON line
+    # that isn't an object yields (line number, reason) instead, for the
+    # validators to reject.
+    fmt = file_format(path, fmt)
+    with open(path, newline='', encoding='utf-8') as handle:
+        if fmt == 'csv':
+            reader = csv.DictReader(handle)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(handle, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    yield line_number, f"not valid JSON ({error})"
+                    continue
+                yield line_number, record if isinstance(record, dict) else "not a JSON object"
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _well_formed(records, report):
+    for line, record in records:
+        if isinstance(record, dict):
+            yield line, record
+        else:
+            report.reject(line, record)
+
+
+def _text(record, key):
+    value = record.get(key)
+    return value.strip() if isinstance(value, str) else value
+
+
+def validate_users(records, report, taken, role=None):
+    # Yields (username, password hash, role, speciality, email). A
+    # password_hash column is taken as-is, a plain password column is hashed
+    # (a full KDF run per row, so prefer hashes for big imports).
+    # `taken` holds the usernames already in use and grows as rows pass.
+    for line, record in _well_formed(records, report):
+        username = _text(record, 'username')
+        user_role = role or _text(record, 'role') or 'patient'
+        speciality = _text(record, 'speciality')
+        password_hash = _text(record, 'password_hash')
+        if not password_hash and _text(record, 'password'):
+            password_hash = hash_password(record['password'])
+        if not username or not password_hash:
+            report.reject(line, "username and password are required")
+        elif username in taken:
+            report.reject(line, f"username {username!r} already exists")
+        elif user_role not in ('patient', 'doctor'):
+            report.reject(line, f"unknown role {user_role!r}")
+        elif user_role == 'doctor' and not speciality:
+            report.reject(line, "doctors need a speciality")
+        else:
+            taken.add(username)
+            yield username, password_hash, user_role, speciality, _text(record, 'email') or None
+
+
+def validate_appointments(records, report, user_ids, doctor_ids):
+    # Patients and doctors may be given by id or by username; `user_ids`
+    # maps usernames to ids and doctor_ids is the set of doctors' ids.
+    # Yields (patient_id, doctor_id, date, time, start_minute, slot).
+    known = set(user_ids.values())
+    for line, record in _well_formed(records, report):
+        patient_id = _resolve(record, 'patient', user_ids)
+        doctor_id = _resolve(record, 'doctor', user_ids)
+        if patient_id not in known or doctor_id not in doctor_ids:
+            report.reject(line, "unknown patient or doctor")
+            continue
+        try:
+            start_minute = encode(_text(record, 'date'), _text(record, 'time'))
+        except (TypeError, ValueError):
+            report.reject(line, "date must be YYYY-MM-DD and time HH:MM AM/PM")
+            continue
+        # The date and time columns are display text rendered from
+        # start_minute, as everywhere else, not the file's own spelling
+        yield (patient_id, doctor_id) + decode(start_minute) + (start_minute, start_minute // SLOT_MINUTES)
+
+
+def _resolve(record, role, user_ids):
+    # The user's id, or None when it can't be read
+    user_id = _text(record, f'{role}_id')
+    if user_id:
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+    return user_ids.get(_text(record, role) or _text(record, f'{role}_username'))
+
+
+@contextmanager
+def suspended(conn, objects):
+    # Drop indexes or triggers, (name, kind, sql) tuples, for the duration of
+    # a load and recreate them afterwards. Their DDL goes into
+    # suspended_schema in the same transaction as the drops, so if the load
+    # dies before putting them back, the next connection pool to open the
+    # database does (see repository.ConnectionPool._recover).
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO main.suspended_schema (name, sql) VALUES (?, ?)",
+            [(name, sql) for name, _, sql in objects],
+        )
+        for name, kind, _ in objects:
+            conn.execute(f"DROP {kind} main.{name}")
+    try:
+        yield
+    finally:
+        with conn:
+            restore_suspended(conn, {name for name, _, _ in objects})
+
+
+def deferred_indexes(conn, tables):
+    # Drop the plain (non-unique) indexes on `tables` for the duration of a
+    # load and rebuild them afterwards: one sorted build is far cheaper than
+    # updating every index for every inserted row. Unique indexes stay, as
+    # they enforce integrity while loading.
+    placeholders = ', '.join('?' for _ in tables)
+    indexes = conn.execute(
+        f"SELECT name, sql FROM main.sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})",
+        list(tables),
+    ).fetchall()
+    return suspended(conn, [(name, 'INDEX', sql) for name, sql in indexes if not sql.upper().startswith('CREATE UNIQUE')])
+
+
+def suspended_triggers(conn, prefix):
+    # Drop the triggers whose names start with `prefix` for the duration of
+    # a load, and put them back afterwards.
+    triggers = conn.execute(
+        "SELECT name, sql FROM main.sqlite_master WHERE type = 'trigger' AND substr(name, 1, ?) = ?",
+        (len(prefix), prefix),
+    ).fetchall()
+    return suspended(conn, [(name, 'TRIGGER', sql) for name, sql in triggers])
+
+
+@contextmanager
+def deferred_statistics(conn):
+    # The daily_stats triggers cost an upsert per inserted appointment. For
+    # a load, drop them and recount everything once at the end instead;
+    # also when the load stops part way, as earlier batches have committed.
+    try:
+        with suspended_triggers(conn, 'stats_'):
+            yield
+    finally:
+        with conn:
+            rebuild_stats(conn)
+
+
+def import_users(conn, records, role=None, batch_size=BATCH_SIZE):
+    report = ImportReport()
+    taken = {username for (username,) in conn.execute("SELECT username FROM users")}
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_doctors (username TEXT PRIMARY KEY, speciality TEXT, email TEXT)")
+    with deferred_indexes(conn, ['users', 'doctors']):
+        for batch in batched(validate_users(records, report, taken, role), batch_size):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO users (username, password, role, email) VALUES (?, ?, ?, ?)",
+                    [(username, password, user_role, email) for username, password, user_role, _, email in batch],
+                )
+                # Doctors share their user's id, which executemany can't hand
+                # back, so match them up by username in one statement instead.
+                conn.execute("DELETE FROM temp.import_doctors")
+                conn.executemany(
+                    "INSERT INTO temp.import_doctors VALUES (?, ?, ?)",
+                    [(username, speciality, email) for username, _, user_role, speciality, email in batch if user_role == 'doctor'],
+                )
+                conn.execute('''
+                    INSERT INTO doctors (id, name, speciality, email)
+                    SELECT u.id, u.username, t.speciality, t.email
+                    FROM temp.import_doctors t JOIN users u ON u.username = t.username
+                ''')
+            report.loaded += len(batch)
+    return report
+
+
+def import_appointments(conn, records, batch_size=BATCH_SIZE, router=None):
+    # conn is the main database. With a shards.ShardRouter, appointments
+    # with doctors moved to a clinic load into that clinic's shard, and
+    # their patients are enlisted there first, as a booking would.
+    report = ImportReport()
+    user_ids = dict(conn.execute("SELECT username, id FROM users"))
+    doctor_ids = {doctor_id for (doctor_id,) in conn.execute("SELECT id FROM doctors")}
+    with ExitStack() as loads:
+        targets = {}
+        for batch in batched(validate_appointments(records, report, user_ids, doctor_ids), batch_size):
+            by_clinic = {}
+            for row in batch:
+                # Clinic 0 is the main database
+                by_clinic.setdefault(router.clinic_of(row[1]) if router else 0, []).append(row)
+            for clinic_id, rows in by_clinic.items():
+                target = targets.get(clinic_id)
+                if target is None:
+                    target = targets[clinic_id] = conn if not clinic_id else _shard_connection(router.pool(clinic_id))
+                    loads.enter_context(deferred_indexes(target, ['appointments']))
+                    loads.enter_context(deferred_statistics(target))
+                for patient_id in {row[0] for row in rows} if clinic_id else ():
+                    router.enlist(patient_id, clinic_id)
+                with target:
+                    _insert_appointments(target, rows, report)
+            report.loaded += len(batch)
+    return report
+
+
+def _shard_connection(pool):
+    # As for the main database (see manage.import_command): with the
+    # archive attached, recounting statistics keeps archived rows in
+    return pool.history() if pool.has_history() else pool.connection()
+
+
+def _insert_appointments(conn, batch, report):
+    sql = '''
+        INSERT INTO appointments (patient_id, doctor_id, date, time, start_minute, slot)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    conn.execute("SAVEPOINT import_batch")
+    try:
+        conn.executemany(sql, batch)
+        conn.execute("RELEASE import_batch")
+        return
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK TO import_batch")
+        conn.execute("RELEASE import_batch")
+    # Slow path, only for batches containing double bookings: historical
+    # clashes are kept but, like the ones the slot migration found, they get
+    # a NULL slot and so stay out of the uniqueness check.
+    for row in batch:
+        try:
+            conn.execute(sql, row)
+        except sqlite3.IntegrityError:
+            conn.execute(sql, row[:5] + (None,))
+            report.clashes += 1
+
+
+EXPORTS = {
+    'appointments': '''
+        SELECT a.id, p.username AS patient, d.name AS doctor, a.date, a.time, a.start_minute
+        FROM appointments a
+        JOIN users p ON a.patient_id = p.id
+        JOIN doctors d ON a.doctor_id = d.id
+        ORDER BY a.id
+    ''',
+    'notifications': '''
+        SELECT id, recipient_id, doctor_id, message, date, time, start_minute
+        FROM notifications
+        ORDER BY id
+    ''',
+}
+
+
+def export_table(conn, kind, path, fmt=None, fetch_size=EXPORT_FETCH_SIZE):
+    # Streams rows out with fetchmany, so memory stays flat for any table size.
+    fmt = file_format(path, fmt)
+    cursor = conn.execute(EXPORTS[kind])
+    columns = [column[0] for column in cursor.description]
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as handle:
+        writer = csv.writer(handle) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                handle.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            count += len(rows)
+    return count
@@ -1,64 +1,64 @@
+import time
+STARTED = time.perf_counter()
+
+import argparse
+import importlib.util
 import sqlite3
+import sys
 import tkinter as tk
 from tkinter import ttk, messagebox
 import ttkbootstrap as tb
-import hashlib
-from datetime import datetime
-import tkinter.simpledialog as simpledialog  # Import simpledialog here
-
-# Hash password
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-# Database connection
-conn = sqlite3.connect('doctor_appointment_system.db')
-cursor = conn.cursor()
-
-# Create tables if they don't exist
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL,
-    role TEXT NOT NULL
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS doctors (
-    id INTEGER PRIMARY KEY,
-    name TEXT NOT NULL,
-    speciality TEXT NOT NULL
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS appointments (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    patient_id INTEGER NOT NULL,
-    doctor_id INTEGER NOT NULL,
-    date TEXT NOT NULL,
-    time TEXT NOT NULL,
-    FOREIGN KEY (patient_id) REFERENCES users(id),
-    FOREIGN KEY (doctor_id) REFERENCES doctors(id)
-)
-''')
-# Create notifications table to store cancellation notifications
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS notifications (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    doctor_id INTEGER NOT NULL,
-    message TEXT NOT NULL,
-    date TEXT NOT NULL,
-    time TEXT NOT NULL,
-    FOREIGN KEY (doctor_id) REFERENCES doctors(id)
-)
-''')
-
-conn.commit()
-
-
-conn.commit()
+from collections import deque
+from datetime import datetime, timedelta
+from auth import hash_password, load_session_token, save_session_token, clear_session_token
+from repository import ConnectionPool, UserRepo, DoctorRepo, DoctorDirectory, SlotTakenError, SeriesConflictError
+from availability import MAX_OCCURRENCES, MINUTES_PER_DAY, encode, now_minute, recurrence
+from shards import FAN_OUT_WORKERS, ShardRouter
+from tasks import TaskRunner
+from widgets import PagedTreeview, DoctorPicker, NotificationFeed, CalendarCanvas
+import instrumentation
+from instrumentation import timed
+
+# Database access (the pool opens and migrates the database on first use).
+# Every worker thread of the app's TaskRunner holds one pooled connection.
+# Appointments, notifications, waitlists and statistics go through the
+# router, which finds the clinic database holding each doctor's (shards.py).
+WORKERS = 4
+pool = ConnectionPool('doctor_appointment_system.db', size=WORKERS)
+users_repo = UserRepo(pool)
+doctors_repo = DoctorRepo(pool)
+doctor_directory = DoctorDirectory(pool)
+router = ShardRouter(pool, size=WORKERS + FAN_OUT_WORKERS)
+
+# Labels for the booking screen's repeat menu -> availability.RECURRENCES
+REPEAT_OPTIONS = {
+    "Does not repeat": None,
+    "Every week": "weekly",
+    "Every 2 weeks": "biweekly",
+    "Every month": "monthly",
+}
+
+# How often a logged-in user's notification feed checks for new rows
+NOTIFICATION_POLL_MS = 5000
+NOTIFICATION_LIMIT = 200
+
+# Days the reports tab covers unless the doctor picks a range
+REPORT_DAYS = 30
+
+# Labels for the calendar's view menu -> schedule.view_range views
+CALENDAR_VIEWS = {"Week": "week", "Month": "month"}
+
+def percent(part, whole):
+    return f"{100 * part / whole:.1f}%" if whole else "-"
+
+def availability_of(doctor_id):
+    return router.availability(router.clinic_of(doctor_id))
+
+def search_doctors(text, limit):
+    # Blank input lists the first few doctors straight from the cache
+    if text.strip():
+        return doctors_repo.search(text, limit)
+    return doctor_directory.all(limit)
 
 # Main Application Class
 class DoctorAppointmentApp(tb.Window):
@@ -67,86 +67,177 @@ class DoctorAppointmentApp(tb.Window):
         self.title("Doctor Appointment System")
         self.geometry("1600x1000")
         self.user = None
+        self.session_token = None
         self.configure(background="#007BFF")
+        # Screens are frames stacked in one grid cell and raised in turn
+        self.screens = {}
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        self.tasks = TaskRunner(self, max_workers=WORKERS, on_busy=self.set_busy)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.debug_panel = None
+        if instrumentation.ENABLED:
+            instrumentation.configure_logging()
+            self.bind_all("<F12>", self.show_debug_panel)
         self.login_screen()
-
-
+        self.resume_session()
+
+    def set_busy(self, busy):
+        self.configure(cursor="watch" if busy else "")
+
+    def show_debug_panel(self, event=None):
+        if self.debug_panel is None or not self.debug_panel.winfo_exists():
+            from widgets import DebugPanel
+            self.debug_panel = DebugPanel(self, instrumentation.recorder)
+        self.debug_panel.lift()
+
+    def on_close(self):
+        self.tasks.shutdown()
+        self.destroy()
+
+    def show_screen(self, name, build):
+        # Build a screen the first time it is shown; afterwards just raise it
+        self.tasks.cancel_pending()
+        screen = self.screens.get(name)
+        if screen is None:
+            screen = tk.Frame(self, background="#007BFF")
+            screen.grid(row=0, column=0, sticky="nsew")
+            build(screen)
+            self.screens[name] = screen
+        screen.tkraise()
+        return screen
+
+    def drop_screen(self, name):
+        screen = self.screens.pop(name, None)
+        if screen is not None:
+            screen.destroy()
+
+    @timed(kind='screen')
     def login_screen(self):
-        self.clear_frame()
-        label = ttk.Label(self, text="Login", font=("Verdana", 24, "bold"), foreground="#1a73e8")
+        self.show_screen("login", self.build_login_screen)
+        self.password_entry.delete(0, tk.END)
+        self.username_entry.focus_set()
+
+    @timed(kind='screen')
+    def build_login_screen(self, parent):
+        label = ttk.Label(parent, text="Login", font=("Verdana", 24, "bold"), foreground="#1a73e8")
         label.pack(pady=20)
 
-        username_label = ttk.Label(self, text="Username:", font=("Verdana", 12), foreground="#001F3F")
+        username_label = ttk.Label(parent, text="Username:", font=("Verdana", 12), foreground="#001F3F")
         username_label.pack(pady=5)
-        self.username_entry = ttk.Entry(self, font=("Verdana", 10))
+        self.username_entry = ttk.Entry(parent, font=("Verdana", 10))
         self.username_entry.pack(pady=5)
 
-        password_label = ttk.Label(self, text="Password:", font=("Verdana", 12), foreground="#001F3F")
+        password_label = ttk.Label(parent, text="Password:", font=("Verdana", 12), foreground="#001F3F")
         password_label.pack(pady=5)
-        self.password_entry = ttk.Entry(self, show="*", font=("Verdana", 10))
+        self.password_entry = ttk.Entry(parent, show="*", font=("Verdana", 10))
         self.password_entry.pack(pady=5)
 
-        login_button = tb.Button(self, text="Login", style="dark.TButton", bootstyle="rounded", command=self.login)
+        self.remember_var = tk.BooleanVar(value=True)
+        remember_check = ttk.Checkbutton(parent, text="Keep me signed in", variable=self.remember_var)
+        remember_check.pack(pady=5)
+
+        login_button = tb.Button(parent, text="Login", style="dark.TButton", bootstyle="rounded", command=self.login)
         login_button.pack(pady=20)
 
-        register_button = tb.Button(self, text="Register", style="warning.TButton", bootstyle="rounded", command=self.register_screen)
+        register_button = tb.Button(parent, text="Register", style="warning.TButton", bootstyle="rounded", command=self.register_screen)
         register_button.pack(pady=10)
 
+    @timed(kind='screen')
     def register_screen(self):
-        self.clear_frame()
-        label = ttk.Label(self, text="Register", font=("Verdana", 24, "bold"), foreground="#1a73e8")
+        self.show_screen("register", self.build_register_screen)
+        self.register_username_entry.focus_set()
+
+    @timed(kind='screen')
+    def build_register_screen(self, parent):
+        label = ttk.Label(parent, text="Register", font=("Verdana", 24, "bold"), foreground="#1a73e8")
         label.pack(pady=20)
 
-        username_label = ttk.Label(self, text="Username:", font=("Arial", 12), foreground="#001F3F")
+        username_label = ttk.Label(parent, text="Username:", font=("Arial", 12), foreground="#001F3F")
         username_label.pack(pady=5)
-        self.username_entry = ttk.Entry(self, font=("Arial", 10))
-        self.username_entry.pack(pady=5)
+        self.register_username_entry = ttk.Entry(parent, font=("Arial", 10))
+        self.register_username_entry.pack(pady=5)
 
-        password_label = ttk.Label(self, text="Password:", font=("Arial", 12), foreground="#001F3F")
+        password_label = ttk.Label(parent, text="Password:", font=("Arial", 12), foreground="#001F3F")
         password_label.pack(pady=5)
-        self.password_entry = ttk.Entry(self, show="*", font=("Arial", 10))
-        self.password_entry.pack(pady=5)
+        self.register_password_entry = ttk.Entry(parent, show="*", font=("Arial", 10))
+        self.register_password_entry.pack(pady=5)
 
-        role_label = ttk.Label(self, text="Role:", font=("Arial", 12), foreground="#001F3F")
+        role_label = ttk.Label(parent, text="Role:", font=("Arial", 12), foreground="#001F3F")
         role_label.pack(pady=5)
         self.role_var = tk.StringVar(value="patient")
-        role_menu = ttk.OptionMenu(self, self.role_var, "patient", "doctor")
+        role_menu = ttk.OptionMenu(parent, self.role_var, "patient", "doctor")
         role_menu.pack(pady=5)
 
-        speciality_label = ttk.Label(self, text="Speciality:", font=("Arial", 12), foreground="#001F3F")
+        speciality_label = ttk.Label(parent, text="Speciality:", font=("Arial", 12), foreground="#001F3F")
         speciality_label.pack(pady=5)
-        self.speciality_entry = ttk.Entry(self, font=("Arial", 10))
+        self.speciality_entry = ttk.Entry(parent, font=("Arial", 10))
         self.speciality_entry.pack(pady=5)
 
-        register_button = tb.Button(self, text="Register", style="info.TButton", bootstyle="rounded", command=self.register)
+        email_label = ttk.Label(parent, text="Email (optional):", font=("Arial", 12), foreground="#001F3F")
+        email_label.pack(pady=5)
+        self.register_email_entry = ttk.Entry(parent, font=("Arial", 10))
+        self.register_email_entry.pack(pady=5)
+
+        register_button = tb.Button(parent, text="Register", style="info.TButton", bootstyle="rounded", command=self.register)
         register_button.pack(pady=20)
 
-        back_button = tb.Button(self, text="Back to Login", style="secondary.TButton", bootstyle="rounded", command=self.login_screen)
+        back_button = tb.Button(parent, text="Back to Login", style="secondary.TButton", bootstyle="rounded", command=self.login_screen)
         back_button.pack(pady=10)
 
+    @timed()
     def login(self):
         username = self.username_entry.get()
-        password = hash_password(self.password_entry.get())
+        password = self.password_entry.get()
 
         if not username or not password:
             messagebox.showerror("Input Error", "Please enter both username and password.")
             return
 
-        cursor.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
-        user = cursor.fetchone()
+        remember = self.remember_var.get()
 
+        # Password checking is deliberately slow, so it runs on a worker thread
+        def authenticate():
+            user = users_repo.authenticate(username, password)
+            token = None
+            if user and remember:
+                token = users_repo.create_session(user[0])
+                save_session_token(token)
+            return user, token
+
+        self.tasks.submit(authenticate, on_done=lambda result: self.on_login(username, *result))
+
+    def on_login(self, username, user, token=None):
         if user:
             self.user = user
+            self.session_token = token
             messagebox.showinfo("Login Successful", f"Welcome, {username}!")
             self.home_screen()
         else:
             messagebox.showerror("Login Failed", "Invalid username or password.")
 
+    def resume_session(self):
+        # A token saved by "Keep me signed in" takes the user straight home
+        # after one indexed lookup, without the password check
+        token = load_session_token()
+        if token:
+            self.tasks.submit(users_repo.resume, token, on_done=lambda user: self.on_resumed(token, user))
+
+    def on_resumed(self, token, user):
+        if user is None:
+            clear_session_token()
+        elif self.user is None:
+            self.user = user
+            self.session_token = token
+            self.home_screen()
+
+    @timed()
     def register(self):
-        username = self.username_entry.get()
-        password = hash_password(self.password_entry.get())
+        username = self.register_username_entry.get()
+        password = self.register_password_entry.get()
         role = self.role_var.get()
         speciality = self.speciality_entry.get() if role == 'doctor' else None
+        email = self.register_email_entry.get().strip() or None
 
         if not username or not password:
             messagebox.showerror("Input Error", "Please enter both username and password.")
@@ -154,58 +245,109 @@ class DoctorAppointmentApp(tb.Window):
         if role == 'doctor' and not speciality:
             messagebox.showerror("Input Error", "Please enter a speciality for the doctor.")
             return
+        if email and '@' not in email:
+            messagebox.showerror("Input Error", "Please enter a valid email address.")
+            return
 
-        try:
-            cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (username, password, role))
-            user_id = cursor.lastrowid
+        def create_user():
+            user_id = users_repo.register(username, hash_password(password), role, speciality, email)
             if role == 'doctor':
-                cursor.execute("INSERT INTO doctors (id, name, speciality) VALUES (?, ?, ?)", (user_id, username, speciality))
-            conn.commit()
-            messagebox.showinfo("Registration Successful", "You can now log in.")
-            self.login_screen()
-        except sqlite3.IntegrityError:
+                doctor_directory.invalidate()
+            return user_id
+
+        self.tasks.submit(create_user, on_done=self.on_registered, on_error=self.on_register_failed, cancellable=False)
+
+    def on_registered(self, user_id):
+        messagebox.showinfo("Registration Successful", "You can now log in.")
+        for entry in (self.register_username_entry, self.register_password_entry, self.speciality_entry,
+                      self.register_email_entry):
+            entry.delete(0, tk.END)
+        self.login_screen()
+
+    def on_register_failed(self, error):
+        if isinstance(error, sqlite3.IntegrityError):
             messagebox.showerror("Registration Failed", "Username already exists.")
+        else:
+            messagebox.showerror("Registration Failed", str(error))
 
+    @timed(kind='screen')
     def home_screen(self):
-        self.clear_frame()
-        notebook = ttk.Notebook(self)
-    
-        book_tab = ttk.Frame(notebook)
-        view_tab = ttk.Frame(notebook)
-        notification_tab = ttk.Frame(notebook)  # New tab for notifications
-    
-        notebook.add(book_tab, text="Book Appointment")
-        notebook.add(view_tab, text="View Appointments")
-        notebook.add(notification_tab, text="Notifications")  # Add the tab
-        notebook.pack(expand=True, fill='both')
+        # The home screen belongs to whoever just logged in, so it is built
+        # fresh for each login and then kept until logout
+        self.drop_screen("home")
+        self.show_screen("home", self.build_home_screen)
 
-        if self.user[3] == 'patient':
-            self.book_appointment_screen(parent=book_tab)
-            self.view_appointments_screen(parent=view_tab)
-        elif self.user[3] == 'doctor':
-            self.view_appointments_screen(parent=view_tab)
-            self.view_notifications(parent=notification_tab)  # Show notifications for the doctor
+    @timed(kind='screen')
+    def build_home_screen(self, parent):
+        self.notebook = ttk.Notebook(parent)
 
-        logout_button = tb.Button(self, text="Logout", style="danger.TButton", bootstyle="rounded", command=self.logout)
+        # Tabs are filled in the first time they are selected. Each entry is
+        # (name, title, build, refresh when stale, called whenever shown).
+        if self.user[3] == 'patient':
+            tabs = [
+                ("book", "Book Appointment", self.book_appointment_screen, None, None),
+                ("view", "View Appointments", self.view_appointments_screen, self.load_appointments, None),
+                ("notifications", "Notifications", self.view_notifications, None, self.mark_notifications_read),
+            ]
+        else:
+            tabs = [
+                ("view", "View Appointments", self.view_appointments_screen, self.load_appointments, None),
+                ("notifications", "Notifications", self.view_notifications, None, self.mark_notifications_read),
+                ("reports", "Reports", self.reports_screen, self.load_reports, None),
+            ]
+            # The calendar needs NumPy, which is optional
+            if importlib.util.find_spec("numpy") is not None:
+                tabs.insert(1, ("calendar", "Calendar", self.calendar_screen, self.load_calendar, None))
+        self.tabs = {}
+        for name, text, build, refresh, on_show in tabs:
+            tab = ttk.Frame(self.notebook)
+            self.notebook.add(tab, text=text)
+            self.tabs[str(tab)] = {
+                "name": name, "title": text, "frame": tab, "build": build, "refresh": refresh,
+                "on_show": on_show, "built": False, "stale": False,
+            }
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.notebook.pack(expand=True, fill='both')
+        self.start_notifications()
+        self.on_tab_changed()
+
+        logout_button = tb.Button(parent, text="Logout", style="danger.TButton", bootstyle="rounded", command=self.logout)
         logout_button.pack(pady=20)
 
+    @timed(kind='screen')
+    def on_tab_changed(self, event=None):
+        tab = self.tabs.get(self.notebook.select())
+        if tab is None:
+            return
+        if not tab["built"]:
+            tab["built"] = True
+            tab["build"](parent=tab["frame"])
+        elif tab["stale"]:
+            tab["stale"] = False
+            tab["refresh"]()
+        if tab["on_show"] is not None:
+            tab["on_show"]()
+
+    def mark_stale(self, name):
+        # Refresh a tab's data in place: now if it is showing, otherwise the
+        # next time it is selected. Tabs not built yet load fresh anyway.
+        for tab_id, tab in self.tabs.items():
+            if tab["name"] != name or not tab["built"] or tab["refresh"] is None:
+                continue
+            if self.notebook.select() == tab_id:
+                tab["refresh"]()
+            else:
+                tab["stale"] = True
+
+    @timed(kind='screen')
     def book_appointment_screen(self, parent):
         label = ttk.Label(parent, text="Book an Appointment", font=("Arial", 20), foreground="#1a73e8")
         label.pack(pady=20)
 
-        cursor.execute("SELECT * FROM doctors")
-        doctors = cursor.fetchall()
-
-        if not doctors:
-            messagebox.showerror("No Doctors Available", "There are no doctors available at the moment. Please try again later.")
-            self.home_screen()
-            return
-
-        doctor_label = ttk.Label(parent, text="Select Doctor:", font=("Arial", 12), foreground="#001F3F")
+        doctor_label = ttk.Label(parent, text="Search Doctor (name or speciality):", font=("Arial", 12), foreground="#001F3F")
         doctor_label.pack(pady=5)
-        self.doctor_var = tk.StringVar(value=f"{doctors[0][1]} - {doctors[0][2]}")
-        doctor_menu = ttk.OptionMenu(parent, self.doctor_var, *[f"{doctor[1]} - {doctor[2]}" for doctor in doctors])
-        doctor_menu.pack(pady=5)
+        self.doctor_picker = DoctorPicker(parent, self.tasks, search_doctors)
+        self.doctor_picker.pack(pady=5)
 
         date_label = ttk.Label(parent, text="Select Date (YYYY-MM-DD):", font=("Arial", 12), foreground="#001F3F")
         date_label.pack(pady=5)
@@ -217,15 +359,85 @@ class DoctorAppointmentApp(tb.Window):
         self.time_entry = ttk.Entry(parent, font=("Arial", 10))
         self.time_entry.pack(pady=5)
 
+        slots_frame = ttk.Frame(parent)
+        slots_frame.pack(pady=5)
+        next_button = tb.Button(slots_frame, text="Next Available", style="info.TButton", bootstyle="rounded", command=self.fill_next_available)
+        next_button.pack(side="left", padx=5)
+        free_button = tb.Button(slots_frame, text="Show Free Slots", style="info.TButton", bootstyle="rounded", command=self.show_free_slots)
+        free_button.pack(side="left", padx=5)
+        self.slots_label = ttk.Label(parent, text="", font=("Arial", 10), foreground="#001F3F", wraplength=900)
+        self.slots_label.pack(pady=5)
+
+        # Follow-up care can be booked as a series in one go
+        repeat_frame = ttk.Frame(parent)
+        repeat_frame.pack(pady=5)
+        ttk.Label(repeat_frame, text="Repeat:", font=("Arial", 12), foreground="#001F3F").pack(side="left", padx=5)
+        self.repeat_var = tk.StringVar(value="Does not repeat")
+        repeat_menu = ttk.OptionMenu(repeat_frame, self.repeat_var, "Does not repeat", *REPEAT_OPTIONS)
+        repeat_menu.pack(side="left", padx=5)
+        ttk.Label(repeat_frame, text="Times:", font=("Arial", 12), foreground="#001F3F").pack(side="left", padx=5)
+        self.repeat_count_entry = ttk.Entry(repeat_frame, font=("Arial", 10), width=5)
+        self.repeat_count_entry.insert(0, "4")
+        self.repeat_count_entry.pack(side="left", padx=5)
+        ttk.Label(repeat_frame, text="or until (YYYY-MM-DD):", font=("Arial", 12), foreground="#001F3F").pack(side="left", padx=5)
+        self.repeat_until_entry = ttk.Entry(repeat_frame, font=("Arial", 10), width=12)
+        self.repeat_until_entry.pack(side="left", padx=5)
+
         submit_button = tb.Button(parent, text="Confirm Appointment", style="success.TButton", bootstyle="rounded", command=self.confirm_appointment)
         submit_button.pack(pady=20)
 
+        waitlist_button = tb.Button(parent, text="Join Waitlist", style="secondary.TButton", bootstyle="rounded", command=self.join_waitlist)
+        waitlist_button.pack(pady=5)
+
+    @timed()
+    def fill_next_available(self):
+        doctor = self.doctor_picker.selected
+        if doctor is None:
+            messagebox.showerror("Input Error", "Please select a doctor.")
+            return
+        self.tasks.submit(lambda: availability_of(doctor[0]).next_available(doctor[0]), on_done=self.on_next_available)
+
+    def on_next_available(self, slot):
+        if slot is None:
+            self.slots_label.config(text="No free slots in the next 90 days.")
+            return
+        date, time = slot
+        self.date_entry.delete(0, tk.END)
+        self.date_entry.insert(0, date)
+        self.time_entry.delete(0, tk.END)
+        self.time_entry.insert(0, time)
+
+    @timed()
+    def show_free_slots(self):
+        doctor = self.doctor_picker.selected
+        date = self.date_entry.get()
+        if doctor is None:
+            messagebox.showerror("Input Error", "Please select a doctor.")
+            return
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("Invalid Date", "Please enter the date in YYYY-MM-DD format.")
+            return
+        self.tasks.submit(lambda: availability_of(doctor[0]).free_slots(doctor[0], date), on_done=lambda slots: self.on_free_slots(date, slots))
+
+    def on_free_slots(self, date, slots):
+        if slots:
+            self.slots_label.config(text=f"Free on {date}: " + ", ".join(slots))
+        else:
+            self.slots_label.config(text=f"No free slots on {date}.")
+
+    @timed()
     def confirm_appointment(self):
-        doctor_name_speciality = self.doctor_var.get()
-        doctor_name = doctor_name_speciality.split(" - ")[0]
+        doctor = self.doctor_picker.selected
         date = self.date_entry.get()
         time = self.time_entry.get()
 
+        if doctor is None:
+            messagebox.showerror("Input Error", "Please select a doctor.")
+            return
+        doctor_id, doctor_name = doctor[0], doctor[1]
+
         if not date or not time:
             messagebox.showerror("Input Error", "Please enter both date and time.")
             return
@@ -237,67 +449,198 @@ class DoctorAppointmentApp(tb.Window):
             return
 
         try:
-            datetime.strptime(time, "%I:%M %p")
+            start_minute = encode(date, time)
         except ValueError:
             messagebox.showerror("Invalid Time", "Please enter the time in HH:MM AM/PM format.")
             return
 
-        cursor.execute("SELECT id FROM doctors WHERE name=?", (doctor_name,))
-        doctor = cursor.fetchone()
-        if not doctor:
-            messagebox.showerror("Doctor Not Found", "The selected doctor could not be found.")
+        patient_id = self.user[0]
+
+        frequency = REPEAT_OPTIONS[self.repeat_var.get()]
+        if frequency is not None:
+            self.confirm_series(patient_id, doctor_id, doctor_name, start_minute, frequency)
             return
 
-        patient_id = self.user[0]
-        doctor_id = doctor[0]
+        def book():
+            if doctor_directory.get(doctor_id) is None:
+                return None
+            # Insert the appointment into the doctor's clinic database
+            return router.book(patient_id, doctor_id, start_minute)[1]
+
+        self.tasks.submit(
+            book,
+            on_done=lambda appointment_id: self.on_booked(appointment_id, doctor_name, date, time),
+            on_error=self.on_book_failed,
+            cancellable=False,
+        )
+
+    def confirm_series(self, patient_id, doctor_id, doctor_name, start_minute, frequency):
+        count_text = self.repeat_count_entry.get().strip()
+        until = self.repeat_until_entry.get().strip() or None
+        try:
+            count = int(count_text) if count_text else None
+            if until:
+                datetime.strptime(until, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("Invalid Repeat", "Times must be a whole number and the end date YYYY-MM-DD.")
+            return
+        if count is None and until is None:
+            messagebox.showerror("Invalid Repeat", "Please enter how many times to repeat or an end date.")
+            return
+        if count is not None and not 2 <= count <= MAX_OCCURRENCES:
+            messagebox.showerror("Invalid Repeat", f"A series can have between 2 and {MAX_OCCURRENCES} appointments.")
+            return
+
+        def book(skip_conflicts=False):
+            if doctor_directory.get(doctor_id) is None:
+                return None
+            occurrences = recurrence(start_minute, frequency, count, until)
+            return router.book_series(patient_id, doctor_id, occurrences, skip_conflicts)
+
+        def on_conflict(error):
+            if not isinstance(error, SeriesConflictError):
+                self.on_book_failed(error)
+                return
+            taken = "\n".join(f"{date} at {time}" for date, time in error.conflicts)
+            if messagebox.askyesno("Some Dates Unavailable",
+                                   f"The doctor is already booked on:\n{taken}\n\nBook the remaining dates anyway?"):
+                self.tasks.submit(book, True, on_done=on_series_booked, on_error=self.on_book_failed, cancellable=False)
+
+        def on_series_booked(booked):
+            if booked is None:
+                messagebox.showerror("Doctor Not Found", "The selected doctor could not be found.")
+                return
+            if not booked:
+                messagebox.showinfo("Nothing Booked", "None of the dates in the series were free.")
+                return
+            dates = "\n".join(f"{date} at {time}" for date, time in booked)
+            messagebox.showinfo("Appointments Confirmed", f"{len(booked)} appointments with {doctor_name} are confirmed:\n{dates}")
+            self.date_entry.delete(0, tk.END)
+            self.time_entry.delete(0, tk.END)
+            self.repeat_var.set("Does not repeat")
+            self.mark_stale("view")
+
+        self.tasks.submit(book, on_done=on_series_booked, on_error=on_conflict, cancellable=False)
+
+    @timed()
+    def join_waitlist(self):
+        # Wait for a cancellation with this doctor between the date entered
+        # and a last date; a freed slot in that window is booked automatically
+        from tkinter import simpledialog
+        doctor = self.doctor_picker.selected
+        date_from = self.date_entry.get()
+        if doctor is None:
+            messagebox.showerror("Input Error", "Please select a doctor.")
+            return
+        try:
+            datetime.strptime(date_from, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("Invalid Date", "Please enter the first date you could come in YYYY-MM-DD format.")
+            return
+        date_to = simpledialog.askstring("Join Waitlist", "Last date you could come (YYYY-MM-DD):", initialvalue=date_from)
+        if not date_to:
+            return
+        try:
+            if datetime.strptime(date_to, "%Y-%m-%d") < datetime.strptime(date_from, "%Y-%m-%d"):
+                messagebox.showerror("Invalid Date", "The last date must not be before the first date.")
+                return
+        except ValueError:
+            messagebox.showerror("Invalid Date", "Please enter the date in YYYY-MM-DD format.")
+            return
+        doctor_id, doctor_name = doctor[0], doctor[1]
+        self.tasks.submit(
+            router.join_waitlist, self.user[0], doctor_id, date_from, date_to,
+            on_done=lambda _: messagebox.showinfo(
+                "On the Waitlist",
+                f"You will be booked automatically if a slot with {doctor_name} opens up between {date_from} and {date_to}.",
+            ),
+            cancellable=False,
+        )
+
+    def on_book_failed(self, error):
+        if not isinstance(error, SlotTakenError):
+            messagebox.showerror("Booking Failed", str(error))
+            return
+        messagebox.showerror("Slot Unavailable", "The doctor is already booked at that time. Please pick another slot.")
+        self.show_free_slots()
 
-        # Insert the appointment into the database
-        cursor.execute("INSERT INTO appointments (patient_id, doctor_id, date, time) VALUES (?, ?, ?, ?)", (patient_id, doctor_id, date, time))
-        conn.commit()
+    def on_booked(self, appointment_id, doctor_name, date, time):
+        if appointment_id is None:
+            messagebox.showerror("Doctor Not Found", "The selected doctor could not be found.")
+            return
         messagebox.showinfo("Appointment Confirmed", f"Your appointment with {doctor_name} on {date} at {time} is confirmed.")
         self.date_entry.delete(0, tk.END)
         self.time_entry.delete(0, tk.END)
+        self.mark_stale("view")
 
+    @timed(kind='screen')
     def view_appointments_screen(self, parent):
         label = ttk.Label(parent, text="Your Appointments", font=("Arial", 20), foreground="#1a73e8")
         label.pack(pady=20)
 
-        # Fetch user's appointments
-        if self.user[3] == 'patient':
-            cursor.execute('''
-                SELECT a.id, d.name, a.date, a.time
-                FROM appointments a
-                JOIN doctors d ON a.doctor_id = d.id
-                WHERE a.patient_id = ?
-            ''', (self.user[0],))
-        elif self.user[3] == 'doctor':
-            cursor.execute('''
-                SELECT a.id, u.username, a.date, a.time
-                FROM appointments a
-                JOIN users u ON a.patient_id = u.id
-                WHERE a.doctor_id = ?
-            ''', (self.user[0],))
-
-        appointments = cursor.fetchall()
-
-        # Create a Treeview widget to display the appointments
+        # Date range filter; by default only upcoming appointments are listed
+        filter_frame = ttk.Frame(parent)
+        filter_frame.pack(pady=5)
+        self.upcoming_var = tk.BooleanVar(value=True)
+        upcoming_check = ttk.Checkbutton(filter_frame, text="Upcoming only", variable=self.upcoming_var, command=self.load_appointments)
+        upcoming_check.pack(side="left", padx=10)
+        # Archived appointments are only read when asked for
+        self.history_var = tk.BooleanVar(value=False)
+        history_check = ttk.Checkbutton(filter_frame, text="Include history", variable=self.history_var, command=self.load_appointments)
+        history_check.pack(side="left", padx=10)
+        ttk.Label(filter_frame, text="From (YYYY-MM-DD):", font=("Arial", 10)).pack(side="left")
+        self.from_entry = ttk.Entry(filter_frame, font=("Arial", 10), width=12)
+        self.from_entry.pack(side="left", padx=5)
+        ttk.Label(filter_frame, text="To:", font=("Arial", 10)).pack(side="left")
+        self.to_entry = ttk.Entry(filter_frame, font=("Arial", 10), width=12)
+        self.to_entry.pack(side="left", padx=5)
+        filter_button = tb.Button(filter_frame, text="Apply", style="info.TButton", bootstyle="rounded", command=self.load_appointments)
+        filter_button.pack(side="left", padx=10)
+
+        # Treeview that pages appointments in as the user scrolls; click the
+        # Date heading to flip the sort order
         columns = ("ID", "Doctor/Patient", "Date", "Time")
-        self.appointments_tree = ttk.Treeview(parent, columns=columns, show="headings")
-        self.appointments_tree.heading("ID", text="ID")
-        self.appointments_tree.heading("Doctor/Patient", text="Doctor/Patient")
-        self.appointments_tree.heading("Date", text="Date")
-        self.appointments_tree.heading("Time", text="Time")
-
+        self.appointments_tree = PagedTreeview(parent, columns, self.tasks, key=ShardRouter.page_key, sort_column="Date")
         self.appointments_tree.pack(fill="both", expand=True)
+        self.load_appointments()
 
-        for appointment in appointments:
-            self.appointments_tree.insert("", tk.END, values=appointment)
-
-        # Button to cancel appointment (for patients only)
+        # Patients cancel one appointment; doctors can clear whole days
         if self.user[3] == 'patient':
             cancel_button = tb.Button(parent, text="Cancel Appointment", style="danger.TButton", bootstyle="rounded", command=self.cancel_appointment)
             cancel_button.pack(pady=20)
+        elif self.user[3] == 'doctor':
+            cancel_button = tb.Button(parent, text="Cancel Days", style="danger.TButton", bootstyle="rounded", command=self.cancel_days)
+            cancel_button.pack(pady=20)
+
+    @timed()
+    def load_appointments(self):
+        date_from = self.from_entry.get() or None
+        date_to = self.to_entry.get() or None
+        for value in (date_from, date_to):
+            if value is None:
+                continue
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showerror("Invalid Date", "Please enter the date in YYYY-MM-DD format.")
+                return
+        if self.upcoming_var.get():
+            today = datetime.now().strftime("%Y-%m-%d")
+            date_from = max(date_from or today, today)
+
+        if self.user[3] == 'patient':
+            fetch = router.page_for_patient
+        else:
+            fetch = router.page_for_doctor
+        user_id = self.user[0]
+        include_history = self.history_var.get()
 
+        def fetch_page(after, limit, descending):
+            return fetch(user_id, after, limit, descending, date_from, date_to, include_history)
+
+        self.appointments_tree.reload(fetch_page)
+
+    @timed()
     def cancel_appointment(self):
         selected_item = self.appointments_tree.selection()
         if not selected_item:
@@ -305,51 +648,234 @@ class DoctorAppointmentApp(tb.Window):
             return
 
         appointment_id = self.appointments_tree.item(selected_item, 'values')[0]
+        clinic_id = self.appointments_tree.key_of(selected_item[0])[1]
         confirm = messagebox.askyesno("Cancel Confirmation", "Are you sure you want to cancel this appointment?")
         if confirm:
-        # Ask for the cancellation reason
+            # Ask for the cancellation reason (dialogs load on first use)
+            from tkinter import simpledialog
             reason = simpledialog.askstring("Cancellation Reason", "Please enter the reason for cancellation:")
             if not reason:
                 messagebox.showerror("Input Error", "You must provide a reason for canceling the appointment.")
                 return
 
-        # Fetch appointment details
-            cursor.execute('''
-                SELECT a.date, a.time, d.name, d.id, u.username
-                FROM appointments a
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN users u ON a.patient_id = u.id
-                WHERE a.id = ?
-            ''', (appointment_id,))
-            appointment_details = cursor.fetchone()
-            if not appointment_details:
-                messagebox.showerror("Error", "Could not retrieve appointment details.")
+            # Deletes the appointment and notifies the doctor in one transaction
+            patient_id = self.user[0]
+            self.tasks.submit(
+                router.cancel, clinic_id, int(appointment_id), reason, patient_id,
+                on_done=lambda details: self.on_cancelled(selected_item, details),
+                cancellable=False,
+            )
+
+    def on_cancelled(self, selected_item, appointment_details):
+        if not appointment_details:
+            messagebox.showerror("Error", "Could not retrieve appointment details.")
+            return
+        doctor_name = appointment_details[2]
+        self.appointments_tree.delete(*selected_item)
+        messagebox.showinfo("Appointment Cancelled", "Your appointment has been cancelled.")
+
+        # Inform the patient that the doctor will be notified
+        messagebox.showinfo("Notification Sent", f"A cancellation notification has been sent to Dr. {doctor_name}.")
+
+
+    @timed()
+    def cancel_days(self):
+        from tkinter import simpledialog
+        date_from = simpledialog.askstring("Cancel Days", "First day to cancel (YYYY-MM-DD):")
+        if not date_from:
+            return
+        date_to = simpledialog.askstring("Cancel Days", "Last day to cancel (YYYY-MM-DD):", initialvalue=date_from)
+        if not date_to:
+            return
+        try:
+            if datetime.strptime(date_to, "%Y-%m-%d") < datetime.strptime(date_from, "%Y-%m-%d"):
+                messagebox.showerror("Invalid Date", "The last day must not be before the first day.")
                 return
-        
-            appointment_date, appointment_time, doctor_name, doctor_id, patient_name = appointment_details
+        except ValueError:
+            messagebox.showerror("Invalid Date", "Please enter the date in YYYY-MM-DD format.")
+            return
+        confirm = messagebox.askyesno("Cancel Confirmation", f"Cancel all of your appointments from {date_from} to {date_to}?")
+        if not confirm:
+            return
+        reason = simpledialog.askstring("Cancellation Reason", "Please enter the reason for cancellation:")
+        if not reason:
+            messagebox.showerror("Input Error", "You must provide a reason for canceling the appointment.")
+            return
 
-        # Delete the appointment
-            cursor.execute("DELETE FROM appointments WHERE id=?", (appointment_id,))
-            conn.commit()
-            self.appointments_tree.delete(selected_item)
-            messagebox.showinfo("Appointment Cancelled", "Your appointment has been cancelled.")
+        # One DELETE and one batch of patient notifications, in one transaction
+        self.tasks.submit(
+            router.cancel_range, self.user[0], date_from, date_to, reason,
+            on_done=self.on_days_cancelled,
+            cancellable=False,
+        )
+
+    def on_days_cancelled(self, count):
+        messagebox.showinfo("Appointments Cancelled", f"{count} appointment(s) cancelled. The patients have been notified.")
+        self.load_appointments()
+        self.mark_stale("calendar")
+        self.mark_stale("reports")
+
+    @timed(kind='screen')
+    def calendar_screen(self, parent):
+        label = ttk.Label(parent, text="Calendar", font=("Arial", 20), foreground="#1a73e8")
+        label.pack(pady=20)
 
-        # Create notification message
-            notification_message = (
-                f"Patient {patient_name} has cancelled the appointment on {appointment_date} at {appointment_time}.\n"
-                f"Reason: {reason}"
-            )
-        
-        # Insert notification into the database for the doctor
-            cursor.execute(
-                "INSERT INTO notifications (doctor_id, message, date, time) VALUES (?, ?, ?, ?)",
-                (doctor_id, notification_message, appointment_date, appointment_time)
-            )
-            conn.commit()
+        controls = ttk.Frame(parent)
+        controls.pack(pady=5)
+        self.calendar_view_var = tk.StringVar(value="Week")
+        view_menu = ttk.OptionMenu(controls, self.calendar_view_var, "Week", *CALENDAR_VIEWS, command=lambda _: self.load_calendar())
+        view_menu.pack(side="left", padx=10)
+        tb.Button(controls, text="<", style="secondary.TButton", command=lambda: self.calendar_move(-1)).pack(side="left")
+        tb.Button(controls, text="Today", style="secondary.TButton", command=self.calendar_today).pack(side="left", padx=5)
+        tb.Button(controls, text=">", style="secondary.TButton", command=lambda: self.calendar_move(1)).pack(side="left")
+        self.calendar_title = ttk.Label(controls, font=("Arial", 12, "bold"), foreground="#001F3F")
+        self.calendar_title.pack(side="left", padx=15)
+
+        self.calendar_summary = ttk.Label(parent, font=("Arial", 10), foreground="#001F3F")
+        self.calendar_summary.pack(pady=5)
+        self.calendar_canvas = CalendarCanvas(parent, on_select=lambda text: self.calendar_detail.config(text=text))
+        self.calendar_canvas.pack(fill="both", expand=True, padx=10)
+        self.calendar_detail = ttk.Label(parent, font=("Arial", 10), foreground="#001F3F")
+        self.calendar_detail.pack(pady=5)
+        self.calendar_today()
+
+    def calendar_today(self):
+        self.calendar_first_day = now_minute() // MINUTES_PER_DAY
+        self.load_calendar()
+
+    def calendar_move(self, steps):
+        import schedule
+        self.calendar_first_day = schedule.shift(CALENDAR_VIEWS[self.calendar_view_var.get()], self.calendar_first_day, steps)
+        self.load_calendar()
+
+    @timed()
+    def load_calendar(self):
+        # One range query and the matrix work run on a worker; the canvas
+        # is then redrawn on the UI thread. Switching between week and month
+        # keeps to the week or month holding the first day shown.
+        import schedule
+        view = CALENDAR_VIEWS[self.calendar_view_var.get()]
+        first_day, days = schedule.view_range(view, self.calendar_first_day)
+        self.calendar_first_day = first_day
+        doctor_id = self.user[0]
+
+        def fetch():
+            rows = router.doctor_schedule(doctor_id, first_day, days)
+            return schedule.ScheduleGrid(first_day, days, rows, labels=view == 'week')
+
+        self.tasks.submit(fetch, on_done=lambda grid: self.on_calendar(view, grid))
+
+    @timed()
+    def on_calendar(self, view, grid):
+        # Paging quickly can bring results back out of order
+        if view != CALENDAR_VIEWS[self.calendar_view_var.get()] or grid.first_day != self.calendar_first_day:
+            return
+        first, last = grid.date_of(0), grid.date_of(grid.days - 1)
+        self.calendar_title.config(text=first.strftime("%B %Y") if view == 'month' else f"{first:%d %b} - {last:%d %b %Y}")
+        totals = grid.totals()
+        summary = (
+            f"{totals['booked']} of {totals['capacity']} slots booked ({percent(totals['booked'], totals['capacity'])}), "
+            f"{totals['gaps']} idle slots between bookings"
+        )
+        if totals['longest_gap_minutes']:
+            summary += f" (longest {totals['longest_gap_minutes']} min)"
+        if totals['overbooked']:
+            summary += f", {totals['overbooked']} overbooked"
+        if totals['off_hours']:
+            summary += f", {totals['off_hours']} outside working hours"
+        if totals['booked']:
+            summary += f"; busiest day {totals['busiest']:%a %d %b}"
+        self.calendar_summary.config(text=summary)
+        self.calendar_detail.config(text="")
+        self.calendar_canvas.show(grid)
+
+    @timed(kind='screen')
+    def reports_screen(self, parent):
+        label = ttk.Label(parent, text="Reports", font=("Arial", 20), foreground="#1a73e8")
+        label.pack(pady=20)
 
-        # Inform the patient that the doctor will be notified
-            messagebox.showinfo("Notification Sent", f"A cancellation notification has been sent to Dr. {doctor_name}.")
+        today = datetime.now()
+        range_frame = ttk.Frame(parent)
+        range_frame.pack(pady=5)
+        ttk.Label(range_frame, text="From (YYYY-MM-DD):", font=("Arial", 10)).pack(side="left")
+        self.report_from_entry = ttk.Entry(range_frame, font=("Arial", 10), width=12)
+        self.report_from_entry.insert(0, (today - timedelta(days=REPORT_DAYS - 1)).strftime("%Y-%m-%d"))
+        self.report_from_entry.pack(side="left", padx=5)
+        ttk.Label(range_frame, text="To:", font=("Arial", 10)).pack(side="left")
+        self.report_to_entry = ttk.Entry(range_frame, font=("Arial", 10), width=12)
+        self.report_to_entry.insert(0, today.strftime("%Y-%m-%d"))
+        self.report_to_entry.pack(side="left", padx=5)
+        apply_button = tb.Button(range_frame, text="Apply", style="info.TButton", bootstyle="rounded", command=self.load_reports)
+        apply_button.pack(side="left", padx=10)
+
+        self.report_summary = ttk.Label(parent, text="", font=("Arial", 12), foreground="#001F3F")
+        self.report_summary.pack(pady=5)
+
+        # Your days, every speciality side by side, and why appointments
+        # were cancelled
+        tables = ttk.Frame(parent)
+        tables.pack(fill="both", expand=True)
+        self.report_trees = {}
+        for name, title, columns in (
+            ("days", "Your days", ("Date", "Booked", "Capacity", "Utilization", "Cancelled", "Cancellation rate")),
+            ("specialities", "By speciality", ("Speciality", "Doctors", "Booked", "Utilization", "Cancelled", "Cancellation rate")),
+            ("reasons", "Recent cancellations", ("Date", "Time", "By", "Patient", "Reason")),
+        ):
+            frame = ttk.Labelframe(tables, text=title)
+            frame.pack(side="left", fill="both", expand=True, padx=5, pady=5)
+            tree = ttk.Treeview(frame, columns=columns, show="headings")
+            for column in columns:
+                tree.heading(column, text=column)
+                tree.column(column, width=90)
+            tree.pack(fill="both", expand=True)
+            self.report_trees[name] = tree
+        self.load_reports()
+
+    @timed()
+    def load_reports(self):
+        date_from, date_to = self.report_from_entry.get(), self.report_to_entry.get()
+        try:
+            if datetime.strptime(date_to, "%Y-%m-%d") < datetime.strptime(date_from, "%Y-%m-%d"):
+                messagebox.showerror("Invalid Date", "The last day must not be before the first day.")
+                return
+        except ValueError:
+            messagebox.showerror("Invalid Date", "Please enter the date in YYYY-MM-DD format.")
+            return
+        doctor_id = self.user[0]
+
+        def fetch():
+            stats = router.stats(router.clinic_of(doctor_id))
+            return (
+                stats.by_day(doctor_id, date_from, date_to),
+                router.by_speciality(date_from, date_to),
+                stats.reasons(doctor_id, date_from, date_to),
+            )
 
+        self.tasks.submit(fetch, on_done=self.on_reports)
+
+    def on_reports(self, result):
+        days, specialities, reasons = result
+        # Utilization is booked over capacity; the cancellation rate is over
+        # everything that was ever booked (still booked + cancelled)
+        rows = {"days": [], "specialities": [], "reasons": reasons}
+        total_booked = total_cancelled = total_capacity = 0
+        for date, booked, patient_cancelled, doctor_cancelled, capacity in days:
+            cancelled = patient_cancelled + doctor_cancelled
+            total_booked += booked
+            total_cancelled += cancelled
+            total_capacity += capacity
+            rows["days"].append((date, booked, capacity, percent(booked, capacity), cancelled, percent(cancelled, booked + cancelled)))
+        for speciality, doctors, booked, patient_cancelled, doctor_cancelled, capacity in specialities:
+            cancelled = patient_cancelled + doctor_cancelled
+            rows["specialities"].append((speciality, doctors, booked, percent(booked, capacity), cancelled, percent(cancelled, booked + cancelled)))
+        for name, tree in self.report_trees.items():
+            tree.delete(*tree.get_children())
+            for row in rows[name]:
+                tree.insert("", tk.END, values=row)
+        self.report_summary.config(text=(
+            f"{total_booked} booked of {total_capacity} slots ({percent(total_booked, total_capacity)} utilization), "
+            f"{total_cancelled} cancelled ({percent(total_cancelled, total_booked + total_cancelled)})"
+        ))
 
     def send_cancellation_notification(self, doctor_name, patient_name, appointment_date, appointment_time, reason):
         # Simulating sending a notification
@@ -367,35 +893,123 @@ class DoctorAppointmentApp(tb.Window):
                 f"Dr. {doctor_name} has cancelled the appointment on {appointment_date} at {appointment_time}.\n"
                 f"Reason: {reason}"
             )
+    @timed(kind='screen')
     def view_notifications(self, parent):
         label = ttk.Label(parent, text="Your Notifications", font=("Arial", 20), foreground="#1a73e8")
         label.pack(pady=20)
 
-        cursor.execute("SELECT message, date, time FROM notifications WHERE doctor_id=?", (self.user[0],))
-        notifications = cursor.fetchall()
-
-        if not notifications:
-            label = ttk.Label(parent, text="No Notifications Found", font=("Arial", 12), foreground="#001F3F")
-            label.pack(pady=5)
+        self.notification_feed = NotificationFeed(parent, max_items=NOTIFICATION_LIMIT)
+        self.notification_feed.pack(fill="both", expand=True)
+        self.notification_feed.add(list(self.notification_rows), self.notifications_last_seen)
+
+    def start_notifications(self):
+        # The feed polls for rows newer than the last one it has in each
+        # clinic, so only new cancellations travel; the widget keeps the
+        # newest NOTIFICATION_LIMIT. Cursors are {clinic id: notification id}.
+        self.notification_feed = None
+        self.notification_rows = deque(maxlen=NOTIFICATION_LIMIT)
+        self.notification_cursor = None
+        self.notifications_last_seen = {}
+        self.unread_notifications = 0
+        self.notification_poll_id = None
+        self.poll_notifications()
+
+    def poll_notifications(self):
+        self.notification_poll_id = None
+        user_id = self.user[0]
+        cursor = self.notification_cursor
+
+        def fetch():
+            if cursor is None:
+                newest = router.newest(user_id)
+                rows = router.recent(user_id, NOTIFICATION_LIMIT)
+            else:
+                newest = dict(cursor)
+                rows = router.since(user_id, cursor)[::-1]
+            for clinic_id, notification_id, *_ in rows:
+                newest[clinic_id] = max(newest.get(clinic_id, 0), notification_id)
+            return rows, newest, router.unread_count(user_id), router.last_seen(user_id)
+
+        self.tasks.submit(fetch, on_done=self.on_notifications, on_error=self.on_notifications_failed)
+
+    @timed()
+    def on_notifications(self, result):
+        rows, cursor, unread, last_seen = result
+        first_poll = self.notification_cursor is None
+        self.notification_cursor = cursor
+        self.notifications_last_seen = last_seen
+        self.notification_rows.extendleft(reversed(rows))
+        if rows and not first_poll:
+            # A new notification may be a waitlist booking or a cancellation
+            self.mark_stale("view")
+            self.mark_stale("reports")
+        if self.notification_feed is not None:
+            self.notification_feed.add(rows, last_seen)
+        self.set_unread_badge(unread)
+        if unread and self.tab_showing("notifications"):
+            self.mark_notifications_read()
+        self.notification_poll_id = self.after(NOTIFICATION_POLL_MS, self.poll_notifications)
+
+    def on_notifications_failed(self, error):
+        # Try again on the next tick rather than stopping the feed
+        self.notification_poll_id = self.after(NOTIFICATION_POLL_MS, self.poll_notifications)
+
+    def mark_notifications_read(self):
+        if not self.unread_notifications or not self.notification_cursor:
             return
+        user_id, cursor = self.user[0], dict(self.notification_cursor)
+        self.tasks.submit(router.mark_seen, user_id, cursor, on_done=lambda _: self.on_notifications_read(cursor), cancellable=False)
+
+    def on_notifications_read(self, cursor):
+        self.notifications_last_seen = cursor
+        if self.notification_feed is not None:
+            self.notification_feed.mark_all_read()
+        self.set_unread_badge(0)
+
+    def set_unread_badge(self, unread):
+        self.unread_notifications = unread
+        for tab in self.tabs.values():
+            if tab["name"] == "notifications":
+                title = f"{tab['title']} ({unread})" if unread else tab["title"]
+                self.notebook.tab(tab["frame"], text=title)
+
+    def tab_showing(self, name):
+        tab = self.tabs.get(self.notebook.select())
+        return tab is not None and tab["name"] == name
+
+    @timed()
+    def logout(self):
+        if getattr(self, "notification_poll_id", None) is not None:
+            self.after_cancel(self.notification_poll_id)
+            self.notification_poll_id = None
+        if self.session_token is not None:
+            token, self.session_token = self.session_token, None
 
-        for notification in notifications:
-            notification_message = f"On {notification[1]} at {notification[2]}: {notification[0]}"
-            notification_label = ttk.Label(parent, text=notification_message, font=("Arial", 12), foreground="#001F3F")
-            notification_label.pack(pady=5)
-
-
+            def end_session():
+                users_repo.end_session(token)
+                clear_session_token()
 
-    def logout(self):
+            self.tasks.submit(end_session, cancellable=False)
         self.user = None
+        self.drop_screen("home")
         self.login_screen()
 
-    def clear_frame(self):
-        for widget in self.winfo_children():
-            widget.destroy()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Doctor Appointment System")
+    parser.add_argument('--startup-check', action='store_true',
+                        help="draw the login window, print how long that took and exit")
+    args = parser.parse_args(argv)
 
-# Run the application
-if __name__ == "__main__":
     app = DoctorAppointmentApp()
+    if args.startup_check:
+        app.update()
+        print(f"Login window ready in {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+        app.on_close()
+        return 0
     app.mainloop()
+    return 0
+
+# Run the application
+if __name__ == "__main__":
+    sys.exit(main())
 
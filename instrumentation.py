@@ -0,0 +1,221 @@
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Optional tracing of SQL statements, background tasks and GUI actions.
+# Switched on at startup with the environment:
+#   APPOINTMENTS_TRACE=1          turn instrumentation on
+#   APPOINTMENTS_SLOW_MS=50       slow-query threshold (default 100)
+#   APPOINTMENTS_TRACE_LOG=path   JSON-lines log (default instrumentation.log)
+# When it is off, timed() hands back the undecorated function and
+# connections are plain sqlite3 ones, so nothing is paid at run time.
+
+ENABLED = os.environ.get('APPOINTMENTS_TRACE', '') not in ('', '0')
+SLOW_MS = float(os.environ.get('APPOINTMENTS_SLOW_MS', 100))
+LOG_PATH = os.environ.get('APPOINTMENTS_TRACE_LOG', 'instrumentation.log')
+
+log = None  # set up by configure_logging(); logging isn't imported until then
+
+
+def _normalize(sql, _cache={}):
+    text = _cache.get(sql)
+    if text is None:
+        text = _cache[sql] = re.sub(r"\s+", " ", sql).strip()
+    return text
+
+
+# The trace callback sees statements with their parameters filled in; put
+# the placeholders back so that one query with different values is counted
+# as one statement.
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def _unbind(sql):
+    return _LITERAL.sub("?", re.sub(r"\s+", " ", sql).strip())
+
+
+class Timing:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, calls=1):
+        self.count += calls
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Recorder:
+    # Running totals, shared by every thread. Statement timings come from
+    # TracingCursor; `traced` counts every statement SQLite runs, which also
+    # takes in transaction control and statements fired by triggers.
+    def __init__(self, slow_ms=SLOW_MS, keep_slow=200):
+        self.slow_ms = slow_ms
+        self.recording = True
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.traced_counts = {}
+        self.actions = {}
+        self.slow = deque(maxlen=keep_slow)
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.traced_counts.clear()
+            self.actions.clear()
+            self.slow.clear()
+
+    def traced(self, sql):
+        if self.recording:
+            sql = _unbind(sql)
+            with self._lock:
+                self.traced_counts[sql] = self.traced_counts.get(sql, 0) + 1
+
+    def statement(self, sql, seconds, calls=1):
+        if not self.recording:
+            return
+        sql = _normalize(sql)
+        with self._lock:
+            timing = self.statements.get(sql)
+            if timing is None:
+                timing = self.statements[sql] = Timing()
+            timing.add(seconds, calls)
+        milliseconds = seconds * 1000
+        if milliseconds >= self.slow_ms:
+            entry = {'event': 'slow_query', 'sql': sql, 'ms': round(milliseconds, 3),
+                     'thread': threading.current_thread().name, 'at': time.time()}
+            self.slow.append(entry)
+            if log is not None:
+                log.warning(json.dumps(entry))
+
+    def action(self, kind, name, seconds):
+        if not self.recording:
+            return
+        key = f"{kind}:{name}"
+        with self._lock:
+            timing = self.actions.get(key)
+            if timing is None:
+                timing = self.actions[key] = Timing()
+            timing.add(seconds)
+        if log is not None:
+            log.info(json.dumps({'event': kind, 'name': name, 'ms': round(seconds * 1000, 3), 'at': time.time()}))
+
+    def snapshot(self):
+        # Copies for display: (key, count, total ms, max ms) sorted by total
+        def rows(timings):
+            return sorted(
+                ((key, t.count, t.total * 1000, t.max * 1000) for key, t in timings.items()),
+                key=lambda row: row[2], reverse=True,
+            )
+        with self._lock:
+            return {
+                'statements': rows(self.statements),
+                'traced': sorted(self.traced_counts.items(), key=lambda item: item[1], reverse=True),
+                'actions': rows(self.actions),
+                'slow': list(self.slow),
+            }
+
+
+recorder = Recorder()
+
+
+class TracingCursor(sqlite3.Cursor):
+    # Times execute and the fetches that follow it; with SQLite most of a
+    # query's work happens as the rows are stepped through.
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            recorder.statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            recorder.statement(sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def _fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._sql is not None:
+                recorder.statement(self._sql, time.perf_counter() - started, calls=0)
+
+
+class TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    # The C implementations of these don't go through cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    return TracingConnection if ENABLED else sqlite3.Connection
+
+
+def install(conn):
+    if ENABLED:
+        conn.set_trace_callback(recorder.traced)
+
+
+def timed(name=None, kind='action'):
+    # Decorator recording how long each call takes. Free when disabled: the
+    # function is returned untouched.
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                recorder.action(kind, label, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def configure_logging(path=LOG_PATH):
+    # One JSON object per line: actions and tasks at INFO, slow queries at
+    # WARNING.
+    global log
+    if not ENABLED or log is not None:
+        return
+    import logging
+    log = logging.getLogger('appointments.instrumentation')
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
@@ -0,0 +1,228 @@
+import argparse
+import os
+import random
+import smtplib
+import sys
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formatdate
+
+import instrumentation
+from repository import DB_PATH, ConnectionPool, OutboxRepo
+
+# Email dispatcher for the outbox (migration 13). Every notification row
+# gets an outbox row from a trigger, in the same transaction that cancelled
+# the appointment, so a mail is queued exactly when the cancellation commits
+# and nothing waits on SMTP while booking or cancelling. This process drains
+# the queue in batches over one SMTP connection, kept open while there is
+# mail and closed when the queue goes quiet:
+#
+#   python -m mailer --smtp-host localhost --smtp-port 8025
+#   python -m mailer --once       # send what is due and exit
+#
+# A failed send is retried with exponential backoff; a permanent refusal
+# (5xx) or running out of attempts marks the row failed. Each row is sent
+# with a Message-ID derived from its outbox id, so a mail sent again after a
+# crash (between the server accepting it and the row being marked sent) can
+# be recognised as a duplicate.
+
+SMTP_HOST = os.environ.get('APPOINTMENTS_SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('APPOINTMENTS_SMTP_PORT', 25))
+SMTP_USER = os.environ.get('APPOINTMENTS_SMTP_USER')
+SMTP_PASSWORD = os.environ.get('APPOINTMENTS_SMTP_PASSWORD')
+MAIL_FROM = os.environ.get('APPOINTMENTS_MAIL_FROM', 'appointments@localhost')
+MESSAGE_DOMAIN = MAIL_FROM.rpartition('@')[2] or 'localhost'
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 30        # first retry; doubles each attempt after that
+MAX_BACKOFF_SECONDS = 3600
+LEASE_SECONDS = 300         # rows claimed by a dispatcher that died free up after this
+POLL_SECONDS = 2
+IDLE_SECONDS = 30           # close the SMTP connection after this long with nothing to send
+TIMEOUT_SECONDS = 30
+
+
+def backoff(attempts):
+    # Seconds before attempt number `attempts + 1`, with jitter so that rows
+    # that failed together don't all come back together
+    delay = min(BACKOFF_SECONDS * 2 ** attempts, MAX_BACKOFF_SECONDS)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def message_id(outbox_id):
+    return f"<outbox-{outbox_id}@{MESSAGE_DOMAIN}>"
+
+
+class OutboxDispatcher:
+    def __init__(self, pool, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASSWORD,
+                 sender=MAIL_FROM, starttls=False, batch_size=BATCH_SIZE):
+        self.outbox = OutboxRepo(pool)
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.smtp = None
+        self.last_sent = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connections = 0
+
+    def connect(self):
+        if self.smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=TIMEOUT_SECONDS)
+            try:
+                if self.starttls:
+                    smtp.starttls()
+                if self.user:
+                    smtp.login(self.user, self.password)
+            except BaseException:
+                smtp.close()
+                raise
+            self.smtp = smtp
+            self.connections += 1
+        return self.smtp
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+    def build(self, row):
+        outbox_id, recipient, subject, body, _, created_at = row
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = recipient
+        message['Subject'] = subject
+        message['Date'] = formatdate(created_at, localtime=True)
+        message['Message-ID'] = message_id(outbox_id)
+        message.set_content(body)
+        return message
+
+    @instrumentation.timed(kind='task')
+    def dispatch_once(self):
+        # Claim and send one batch. Returns how many rows were claimed, or 0
+        # when the SMTP server couldn't be reached, so the caller backs off.
+        rows = self.outbox.claim(self.batch_size, LEASE_SECONDS)
+        if not rows:
+            return 0
+        sent, retry, failed = [], [], []
+        reachable = True
+        try:
+            smtp = self.connect()
+        except (smtplib.SMTPException, OSError) as error:
+            # Nothing can go out: put the whole batch back, one connection
+            # attempt per batch rather than per message
+            self.defer(rows, error, retry, failed)
+            reachable = False
+        for index, row in enumerate(rows if reachable else ()):
+            try:
+                smtp.send_message(self.build(row))
+            except smtplib.SMTPRecipientsRefused as error:
+                code, text = next(iter(error.recipients.values()))
+                self.refused(row, code, text, retry, failed)
+            except smtplib.SMTPResponseException as error:
+                self.refused(row, error.smtp_code, error.smtp_error, retry, failed)
+                if error.smtp_code == 421:
+                    self.close()
+                    self.defer(rows[index + 1:], error, retry, failed)
+                    break
+            except (smtplib.SMTPException, OSError) as error:
+                # The connection is gone; the rest of the batch waits for
+                # the next round instead of reconnecting message by message
+                self.close()
+                self.defer(rows[index:], error, retry, failed)
+                reachable = False
+                break
+            else:
+                sent.append(row[0])
+        self.outbox.finish(sent, retry, failed)
+        self.sent += len(sent)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        if sent:
+            self.last_sent = time.monotonic()
+        return len(rows) if reachable else 0
+
+    def refused(self, row, code, text, retry, failed):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        error = f"{code} {text}"
+        if 500 <= code < 600:
+            failed.append((row[0], error))
+        else:
+            self.defer([row], error, retry, failed)
+
+    def defer(self, rows, error, retry, failed):
+        now = time.time()
+        for row in rows:
+            attempts = row[4] + 1
+            if attempts >= MAX_ATTEMPTS:
+                failed.append((row[0], str(error)))
+            else:
+                retry.append((row[0], int(now + backoff(attempts - 1)), str(error)))
+
+    def drain(self):
+        # Send batches until nothing is due
+        total = 0
+        while True:
+            count = self.dispatch_once()
+            if not count:
+                return total
+            total += count
+
+    def run(self, stop=None):
+        # Poll until `stop` (a threading.Event) is set
+        stop = stop or threading.Event()
+        try:
+            while not stop.is_set():
+                if not self.drain() and self.smtp is not None and time.monotonic() - self.last_sent > IDLE_SECONDS:
+                    self.close()
+                stop.wait(POLL_SECONDS)
+        finally:
+            self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mailer", description="Send queued notification emails")
+    parser.add_argument('--db', default=DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument('--smtp-host', default=SMTP_HOST, help="(default: %(default)s)")
+    parser.add_argument('--smtp-port', type=int, default=SMTP_PORT, help="(default: %(default)s)")
+    parser.add_argument('--smtp-user', default=SMTP_USER)
+    parser.add_argument('--starttls', action='store_true', help="upgrade the connection with STARTTLS")
+    parser.add_argument('--from', dest='sender', default=MAIL_FROM, help="sender address (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="mails per claim (default: %(default)s)")
+    parser.add_argument('--once', action='store_true', help="send what is due now and exit")
+    args = parser.parse_args(argv)
+
+    pool = ConnectionPool(args.db, size=1)
+    instrumentation.configure_logging()
+    dispatcher = OutboxDispatcher(pool, args.smtp_host, args.smtp_port, args.smtp_user, SMTP_PASSWORD,
+                                  args.sender, args.starttls, args.batch_size)
+    try:
+        if args.once:
+            dispatcher.drain()
+        else:
+            print(f"Sending mail through {args.smtp_host}:{args.smtp_port}", flush=True)
+            dispatcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.close()
+        counts = dispatcher.outbox.counts()
+        pool.close()
+    print(f"Sent {dispatcher.sent}, retrying {dispatcher.retried}, failed {dispatcher.failed} "
+          f"over {dispatcher.connections} connection(s); {counts['pending']} still queued")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
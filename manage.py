@@ -0,0 +1,185 @@
+import argparse
+import sys
+from datetime import date, timedelta
+
+import archive
+import bulk
+from availability import midnight_of
+from repository import DB_PATH, ConnectionPool, StatsRepo
+from shards import ShardRouter
+
+# Command-line maintenance tasks, run from the project directory:
+#   python -m manage import users patients.csv
+#   python -m manage import doctors doctors.jsonl
+#   python -m manage import appointments history.csv --batch-size 100000
+#   python -m manage export appointments appointments.jsonl
+#   python -m manage stats --by speciality --from 2025-01-01 --to 2025-03-31
+#   python -m manage stats --by day --doctor 12
+#   python -m manage rebuild-stats
+#   python -m manage archive --older-than 365 --compact
+#   python -m manage clinic add North clinics/north.db
+#   python -m manage clinic assign 12 1
+
+
+def import_command(pool, args):
+    # With the archive attached, recounting statistics after the load keeps
+    # the archived appointments in
+    conn = pool.history() if pool.has_history() else pool.connection()
+    records = bulk.read_records(args.path, args.format)
+    if args.kind == 'appointments':
+        router = ShardRouter(pool, size=1, workers=1)
+        try:
+            report = bulk.import_appointments(conn, records, args.batch_size, router)
+        finally:
+            router.close()
+    else:
+        role = 'doctor' if args.kind == 'doctors' else None
+        report = bulk.import_users(conn, records, role, args.batch_size)
+    print(f"Imported {report.loaded} {args.kind} from {args.path}")
+    if report.clashes:
+        print(f"{report.clashes} appointments clash with an earlier booking and were kept without a slot")
+    for line, reason in report.rejected[:20]:
+        print(f"  line {line}: {reason}", file=sys.stderr)
+    if len(report.rejected) > 20:
+        print(f"  ... and {len(report.rejected) - 20} more", file=sys.stderr)
+    if report.rejected:
+        print(f"Rejected {len(report.rejected)} rows", file=sys.stderr)
+    return 1 if report.rejected else 0
+
+
+def export_command(pool, args):
+    count = bulk.export_table(pool.connection(), args.kind, args.path, args.format)
+    print(f"Exported {count} {args.kind} to {args.path}")
+    return 0
+
+
+def _percent(part, whole):
+    return f"{100 * part / whole:.1f}%" if whole else "-"
+
+
+def stats_command(pool, args):
+    stats = StatsRepo(pool)
+    date_to = args.date_to or date.today().isoformat()
+    date_from = args.date_from or (date.fromisoformat(date_to) - timedelta(days=29)).isoformat()
+    if args.by == 'day':
+        if args.doctor is None:
+            raise ValueError("--by day needs --doctor")
+        heading = "date"
+        rows = stats.by_day(args.doctor, date_from, date_to)
+    elif args.by == 'doctor':
+        heading = "doctor"
+        rows = [(f"{row[1]} ({row[2]})",) + row[3:] for row in stats.by_doctor(date_from, date_to, args.speciality)]
+    else:
+        heading = "speciality"
+        rows = [(f"{row[0]} ({row[1]})",) + row[2:] for row in stats.by_speciality(date_from, date_to)]
+
+    # Utilization is booked over capacity; the cancellation rate is over
+    # everything that was ever booked (still booked + cancelled)
+    print(f"{date_from} to {date_to}")
+    print(f"{heading:<32} {'booked':>8} {'capacity':>9} {'used':>7} {'cancelled':>10} {'by doctor':>10} {'rate':>7}")
+    for label, booked, patient_cancelled, doctor_cancelled, capacity in rows:
+        cancelled = patient_cancelled + doctor_cancelled
+        print(f"{label[:32]:<32} {booked:>8} {capacity:>9} {_percent(booked, capacity):>7} "
+              f"{cancelled:>10} {doctor_cancelled:>10} {_percent(cancelled, booked + cancelled):>7}")
+    return 0
+
+
+def rebuild_stats_command(pool, args):
+    StatsRepo(pool).rebuild()
+    print("Statistics rebuilt")
+    return 0
+
+
+def archive_command(pool, args):
+    cutoff = midnight_of(args.before) if args.before else archive.cutoff_minute(args.older_than)
+    report = archive.archive(pool, cutoff, args.batch_size)
+    print(f"Archived {report.appointments} appointments and {report.notifications} notifications to {pool.history_path}")
+    if args.compact:
+        archive.compact(pool)
+    return 0
+
+
+def clinic_command(pool, args):
+    router = ShardRouter(pool, size=1, workers=1)
+    try:
+        if args.action == 'add':
+            clinic_id = router.add_clinic(args.name, args.path)
+            print(f"Added clinic {clinic_id}, {args.name}")
+        elif args.action == 'assign':
+            if pool.connection().execute("SELECT 1 FROM doctors WHERE id = ?", (args.doctor,)).fetchone() is None:
+                raise ValueError(f"no doctor {args.doctor}")
+            moved = router.assign(args.doctor, args.clinic)
+            print(f"Moved doctor {args.doctor} and {moved} appointments to clinic {args.clinic}")
+        else:
+            print(f"{0:>4}  (main database)")
+            for clinic_id, name, path, doctors in router.clinics():
+                print(f"{clinic_id:>4}  {name}  {path}  {doctors} doctors")
+    except KeyError as error:
+        raise ValueError(error.args[0]) from None
+    finally:
+        router.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m manage", description="Doctor Appointment System maintenance")
+    parser.add_argument('--db', default=DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument('--history', help="archive database file (default: the --db name with _history)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importer = commands.add_parser('import', help="bulk-load rows from a CSV or JSONL file")
+    importer.add_argument('kind', choices=['users', 'doctors', 'appointments'])
+    importer.add_argument('path')
+    importer.add_argument('--format', choices=['csv', 'jsonl'], help="default: from the file extension")
+    importer.add_argument('--batch-size', type=int, default=bulk.BATCH_SIZE)
+    importer.set_defaults(run=import_command)
+
+    exporter = commands.add_parser('export', help="stream rows out to a CSV or JSONL file")
+    exporter.add_argument('kind', choices=sorted(bulk.EXPORTS))
+    exporter.add_argument('path')
+    exporter.add_argument('--format', choices=['csv', 'jsonl'], help="default: from the file extension")
+    exporter.set_defaults(run=export_command)
+
+    reporter = commands.add_parser('stats', help="bookings, utilization and cancellations")
+    reporter.add_argument('--by', choices=['speciality', 'doctor', 'day'], default='speciality')
+    reporter.add_argument('--from', dest='date_from', help="first day, YYYY-MM-DD (default: 30 days before --to)")
+    reporter.add_argument('--to', dest='date_to', help="last day, YYYY-MM-DD (default: today)")
+    reporter.add_argument('--doctor', type=int, help="doctor id, for --by day")
+    reporter.add_argument('--speciality', help="only this speciality, for --by doctor")
+    reporter.set_defaults(run=stats_command)
+
+    rebuilder = commands.add_parser('rebuild-stats', help="recount the statistics from scratch")
+    rebuilder.set_defaults(run=rebuild_stats_command)
+
+    archiver = commands.add_parser('archive', help="move old appointments and notifications to the history database")
+    cutoff = archiver.add_mutually_exclusive_group()
+    cutoff.add_argument('--older-than', type=int, default=archive.ARCHIVE_AFTER_DAYS, metavar='DAYS',
+                        help="archive what is more than DAYS days old (default: %(default)s)")
+    cutoff.add_argument('--before', help="archive what is before this date, YYYY-MM-DD")
+    archiver.add_argument('--batch-size', type=int, default=archive.BATCH_SIZE)
+    archiver.add_argument('--compact', action='store_true', help="shrink the main database file afterwards")
+    archiver.set_defaults(run=archive_command)
+
+    clinics = commands.add_parser('clinic', help="split clinics into databases of their own (run with the app stopped)")
+    actions = clinics.add_subparsers(dest='action', required=True)
+    actions.add_parser('list', help="clinics and how many doctors each has")
+    adder = actions.add_parser('add', help="register a clinic and create its database")
+    adder.add_argument('name')
+    adder.add_argument('path', help="database file; relative to the main database's directory")
+    assigner = actions.add_parser('assign', help="move a doctor and their appointments to a clinic (0: main database)")
+    assigner.add_argument('doctor', type=int)
+    assigner.add_argument('clinic', type=int)
+    clinics.set_defaults(run=clinic_command)
+
+    args = parser.parse_args(argv)
+    pool = ConnectionPool(args.db, size=1, history=args.history)
+    try:
+        return args.run(pool, args)
+    except (OSError, ValueError) as error:
+        parser.exit(2, f"error: {error}\n")
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
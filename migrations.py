@@ -0,0 +1,529 @@
+import sqlite3
+
+from availability import MINUTES_PER_DAY, SLOT_MINUTES, encode, slot_of
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Databases created by older builds of the app have user_version 0 and were
+# built with CREATE TABLE IF NOT EXISTS, so every step has to cope with the
+# objects it creates already being there.
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _create_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS doctors (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        speciality TEXT NOT NULL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS appointments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        doctor_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        FOREIGN KEY (patient_id) REFERENCES users(id),
+        FOREIGN KEY (doctor_id) REFERENCES doctors(id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        doctor_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        FOREIGN KEY (doctor_id) REFERENCES doctors(id)
+    )
+    ''')
+
+
+def _add_doctor_email(cursor):
+    # Some deployed databases already picked this column up by hand.
+    if 'email' not in _columns(cursor, 'doctors'):
+        cursor.execute("ALTER TABLE doctors ADD COLUMN email TEXT")
+
+
+def _add_lookup_indexes(cursor):
+    # The appointment indexes carry every column the patient and doctor views
+    # read (the rowid is stored in each entry), so those queries never have to
+    # visit the appointments table itself.
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_doctor
+    ON appointments (doctor_id, date, time, patient_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_patient
+    ON appointments (patient_id, date, time, doctor_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_notifications_doctor
+    ON notifications (doctor_id, id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_doctors_name
+    ON doctors (name)
+    ''')
+
+
+def _add_keyset_indexes(cursor):
+    # Appointment lists are paged by (date, time, id). Putting id ahead of the
+    # joined column keeps the index in exactly that order, so a page is a
+    # single index range scan with no sort step, and the index stays covering.
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_doctor")
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_patient")
+    cursor.execute('''
+    CREATE INDEX idx_appointments_doctor
+    ON appointments (doctor_id, date, time, id, patient_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX idx_appointments_patient
+    ON appointments (patient_id, date, time, id, doctor_id)
+    ''')
+
+
+def _add_doctor_search(cursor):
+    # External-content FTS5 index over the doctors table, kept in sync by
+    # triggers. The prefix option builds extra index entries for 1-3 letter
+    # prefixes so search-as-you-type stays a direct lookup.
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS doctors_fts USING fts5(
+        name, speciality, content='doctors', content_rowid='id', prefix='1 2 3'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS doctors_fts_insert AFTER INSERT ON doctors BEGIN
+        INSERT INTO doctors_fts (rowid, name, speciality) VALUES (new.id, new.name, new.speciality);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS doctors_fts_delete AFTER DELETE ON doctors BEGIN
+        INSERT INTO doctors_fts (doctors_fts, rowid, name, speciality) VALUES ('delete', old.id, old.name, old.speciality);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS doctors_fts_update AFTER UPDATE OF id, name, speciality ON doctors BEGIN
+        INSERT INTO doctors_fts (doctors_fts, rowid, name, speciality) VALUES ('delete', old.id, old.name, old.speciality);
+        INSERT INTO doctors_fts (rowid, name, speciality) VALUES (new.id, new.name, new.speciality);
+    END
+    ''')
+    cursor.execute("INSERT INTO doctors_fts (doctors_fts) VALUES ('rebuild')")
+
+
+def _add_appointment_slots(cursor):
+    # Number every appointment's slot within its day and make (doctor, date,
+    # slot) unique so the database itself refuses double bookings. Legacy rows
+    # that already clash, or whose time can't be parsed, keep a NULL slot:
+    # they stay visible but take no part in the constraint.
+    if 'slot' not in _columns(cursor, 'appointments'):
+        cursor.execute("ALTER TABLE appointments ADD COLUMN slot INTEGER")
+    cursor.execute("SELECT id, doctor_id, date, time FROM appointments ORDER BY id")
+    taken = set()
+    updates = []
+    for appointment_id, doctor_id, date, time in cursor.fetchall():
+        try:
+            slot = slot_of(time)
+        except ValueError:
+            continue
+        if (doctor_id, date, slot) in taken:
+            continue
+        taken.add((doctor_id, date, slot))
+        updates.append((slot, appointment_id))
+    cursor.executemany("UPDATE appointments SET slot = ? WHERE id = ?", updates)
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_doctor_slot
+    ON appointments (doctor_id, date, slot)
+    ''')
+
+
+def _encode_or_midnight(date, time):
+    try:
+        return encode(date, time)
+    except ValueError:
+        pass
+    try:
+        return encode(date, "12:00 AM")
+    except ValueError:
+        return 0
+
+
+def _add_start_minutes(cursor):
+    # Replace text date/time comparisons with one integer, start_minute
+    # (minutes since the epoch, see availability.encode). The text columns
+    # stay as display values. Rows whose time can't be parsed sort at the
+    # start of their day rather than being left out.
+    for table in ('appointments', 'notifications'):
+        if 'start_minute' not in _columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN start_minute INTEGER")
+    cursor.connection.create_function("encode_minute", 2, _encode_or_midnight, deterministic=True)
+    cursor.execute("UPDATE appointments SET start_minute = encode_minute(date, time)")
+    cursor.execute("UPDATE notifications SET start_minute = encode_minute(date, time)")
+
+    # slot becomes the absolute slot number, start_minute / SLOT_MINUTES, so
+    # one unique (doctor_id, slot) index guards against double bookings.
+    # Legacy clashes keep their NULL slot. Dates written differently
+    # ('2025-1-5', '2025-01-05') or unparseable ones (all at minute 0) can
+    # clash only now, so look again and keep the earliest row of each.
+    cursor.execute(f"UPDATE appointments SET slot = start_minute / {SLOT_MINUTES} WHERE slot IS NOT NULL")
+    cursor.execute('''
+    UPDATE appointments SET slot = NULL
+    WHERE slot IS NOT NULL AND id NOT IN (
+        SELECT min(id) FROM appointments WHERE slot IS NOT NULL GROUP BY doctor_id, slot
+    )
+    ''')
+
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_doctor")
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_patient")
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_doctor_slot")
+    cursor.execute('''
+    CREATE INDEX idx_appointments_doctor
+    ON appointments (doctor_id, start_minute, id, patient_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX idx_appointments_patient
+    ON appointments (patient_id, start_minute, id, doctor_id)
+    ''')
+    cursor.execute('''
+    CREATE UNIQUE INDEX idx_appointments_doctor_slot
+    ON appointments (doctor_id, slot)
+    ''')
+
+
+def _add_notification_cursors(cursor):
+    # Read/unread state is a per-user high-water mark: notifications with an
+    # id above last_seen_id are unread. Marking the feed read is then a
+    # single upsert, and counting unread ones is an index range scan.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS notification_cursors (
+        user_id INTEGER PRIMARY KEY,
+        last_seen_id INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''')
+
+
+def _add_notification_recipients(cursor):
+    # Notifications can now go to patients as well as doctors. recipient_id is
+    # the user who reads the notification; doctor_id stays as the doctor the
+    # appointment was with. Existing rows were all addressed to the doctor
+    # (a doctor's user id is their doctor id).
+    if 'recipient_id' not in _columns(cursor, 'notifications'):
+        cursor.execute("ALTER TABLE notifications ADD COLUMN recipient_id INTEGER REFERENCES users(id)")
+    cursor.execute("UPDATE notifications SET recipient_id = doctor_id WHERE recipient_id IS NULL")
+    cursor.execute("DROP INDEX IF EXISTS idx_notifications_doctor")
+    cursor.execute('''
+    CREATE INDEX idx_notifications_recipient
+    ON notifications (recipient_id, id)
+    ''')
+
+
+def _add_sessions(cursor):
+    # "Keep me signed in" tokens. Only a digest of each token is stored, and
+    # resuming is a single primary-key lookup instead of a password check.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users(id),
+        expires_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_sessions_user
+    ON sessions (user_id)
+    ''')
+
+
+def _add_waitlist(cursor):
+    # Patients waiting for a doctor to free up a slot within their window
+    # [earliest_minute, latest_minute). Higher priority goes first, then
+    # whoever joined first. The index is in exactly that order and carries
+    # the window, so finding who gets a freed slot walks the doctor's list
+    # from the top and stops at the first fit without touching the table.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS waitlist (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        doctor_id INTEGER NOT NULL REFERENCES doctors(id),
+        patient_id INTEGER NOT NULL REFERENCES users(id),
+        priority INTEGER NOT NULL DEFAULT 0,
+        earliest_minute INTEGER NOT NULL,
+        latest_minute INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_waitlist_queue
+    ON waitlist (doctor_id, priority DESC, id, earliest_minute, latest_minute, patient_id)
+    ''')
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_waitlist_patient
+    ON waitlist (patient_id, doctor_id)
+    ''')
+
+
+def _add_statistics(cursor):
+    # Running per-doctor, per-day counts for reports, kept up to date by
+    # triggers so a report reads one row per day instead of scanning every
+    # appointment. day is start_minute / MINUTES_PER_DAY. booked is what is
+    # on the books now; a cancellation moves an appointment from booked to
+    # one of the cancelled columns (decrement by the delete trigger,
+    # increment by the insert into cancellations).
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS cancellations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        appointment_id INTEGER,
+        doctor_id INTEGER NOT NULL REFERENCES doctors(id),
+        patient_id INTEGER REFERENCES users(id),
+        start_minute INTEGER NOT NULL,
+        cancelled_at INTEGER,
+        cancelled_by TEXT NOT NULL CHECK (cancelled_by IN ('patient', 'doctor')),
+        reason TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_cancellations_doctor
+    ON cancellations (doctor_id, start_minute)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        doctor_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        booked INTEGER NOT NULL DEFAULT 0,
+        patient_cancelled INTEGER NOT NULL DEFAULT 0,
+        doctor_cancelled INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (doctor_id, day)
+    ) WITHOUT ROWID
+    ''')
+    # Reports across all doctors read a range of days
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_daily_stats_day
+    ON daily_stats (day, doctor_id, booked, patient_cancelled, doctor_cancelled)
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_appointment_insert AFTER INSERT ON appointments BEGIN
+        INSERT INTO daily_stats (doctor_id, day, booked) VALUES (new.doctor_id, new.start_minute / {MINUTES_PER_DAY}, 1)
+        ON CONFLICT (doctor_id, day) DO UPDATE SET booked = booked + 1;
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_appointment_delete AFTER DELETE ON appointments BEGIN
+        UPDATE daily_stats SET booked = booked - 1
+        WHERE doctor_id = old.doctor_id AND day = old.start_minute / {MINUTES_PER_DAY};
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_appointment_update AFTER UPDATE OF doctor_id, start_minute ON appointments BEGIN
+        UPDATE daily_stats SET booked = booked - 1
+        WHERE doctor_id = old.doctor_id AND day = old.start_minute / {MINUTES_PER_DAY};
+        INSERT INTO daily_stats (doctor_id, day, booked) VALUES (new.doctor_id, new.start_minute / {MINUTES_PER_DAY}, 1)
+        ON CONFLICT (doctor_id, day) DO UPDATE SET booked = booked + 1;
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS stats_cancellation_insert AFTER INSERT ON cancellations BEGIN
+        INSERT INTO daily_stats (doctor_id, day, patient_cancelled, doctor_cancelled)
+        VALUES (new.doctor_id, new.start_minute / {MINUTES_PER_DAY}, new.cancelled_by = 'patient', new.cancelled_by = 'doctor')
+        ON CONFLICT (doctor_id, day) DO UPDATE SET
+            patient_cancelled = patient_cancelled + excluded.patient_cancelled,
+            doctor_cancelled = doctor_cancelled + excluded.doctor_cancelled;
+    END
+    ''')
+
+    # Until now a cancellation only left a notification behind. Recover what
+    # those messages say (who cancelled, the patient, the reason); when and
+    # which appointment id are lost.
+    cursor.execute('''
+    INSERT INTO cancellations (doctor_id, patient_id, start_minute, cancelled_by, reason)
+    SELECT n.doctor_id, u.id, n.start_minute, 'patient', substr(n.message, instr(n.message, 'Reason: ') + 8)
+    FROM notifications n
+    LEFT JOIN users u ON u.username = substr(n.message, 9, instr(n.message, ' has cancelled the appointment') - 9)
+    WHERE n.recipient_id = n.doctor_id AND n.message LIKE 'Patient % has cancelled the appointment on %'
+    ORDER BY n.id
+    ''')
+    cursor.execute('''
+    INSERT INTO cancellations (doctor_id, patient_id, start_minute, cancelled_by, reason)
+    SELECT doctor_id, recipient_id, start_minute, 'doctor', substr(message, instr(message, 'Reason: ') + 8)
+    FROM notifications
+    WHERE recipient_id != doctor_id AND message LIKE 'Dr. % has cancelled the appointment on %'
+    ORDER BY id
+    ''')
+    # The inserts above went through the trigger; start the counts afresh
+    cursor.execute("DELETE FROM daily_stats")
+    cursor.execute(f'''
+    INSERT INTO daily_stats (doctor_id, day, booked, patient_cancelled, doctor_cancelled)
+    SELECT doctor_id, day, sum(booked), sum(patient_cancelled), sum(doctor_cancelled) FROM (
+        SELECT doctor_id, start_minute / {MINUTES_PER_DAY} AS day, 1 AS booked, 0 AS patient_cancelled, 0 AS doctor_cancelled
+        FROM appointments
+        UNION ALL
+        SELECT doctor_id, start_minute / {MINUTES_PER_DAY}, 0, cancelled_by = 'patient', cancelled_by = 'doctor'
+        FROM cancellations
+    )
+    GROUP BY doctor_id, day
+    ''')
+
+
+def _add_outbox(cursor):
+    # Email copies of notifications, queued by a trigger in the same
+    # transaction as the notification itself and sent later by mailer.py.
+    # Patients can now have an address too; a doctor's falls back to the one
+    # on their doctors row. A row is due while sent_at and failed_at are
+    # NULL and next_attempt_at has passed; leased_until stops two
+    # dispatchers sending it at once. Times are Unix seconds.
+    if 'email' not in _columns(cursor, 'users'):
+        cursor.execute("ALTER TABLE users ADD COLUMN email TEXT")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        notification_id INTEGER UNIQUE,
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at INTEGER NOT NULL,
+        leased_until INTEGER NOT NULL DEFAULT 0,
+        sent_at INTEGER,
+        failed_at INTEGER,
+        last_error TEXT
+    )
+    ''')
+    # Only undelivered rows are indexed, so the dispatcher's scan stays as
+    # small as the backlog however much mail has gone out
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_outbox_due
+    ON outbox (next_attempt_at, id) WHERE sent_at IS NULL AND failed_at IS NULL
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS outbox_notification AFTER INSERT ON notifications BEGIN
+        INSERT INTO outbox (notification_id, recipient, subject, body, created_at, next_attempt_at)
+        SELECT new.id, coalesce(nullif(u.email, ''), d.email),
+               substr(new.message, 1, instr(new.message || char(10), char(10)) - 1), new.message,
+               CAST(strftime('%s', 'now') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)
+        FROM users u LEFT JOIN doctors d ON d.id = u.id
+        WHERE u.id = new.recipient_id AND coalesce(nullif(u.email, ''), d.email, '') != '';
+    END
+    ''')
+
+
+def _add_clinics(cursor):
+    # Sharding by clinic (see shards.py). In the catalog database, clinics
+    # lists the shard files, doctors.clinic_id says which one holds a
+    # doctor's appointments and notifications (NULL: this database, as
+    # before sharding) and patient_clinics which shards a patient has booked
+    # in, so lookups across clinics visit only those. Shards have the same
+    # tables, left empty. Notifications get a creation time (Unix seconds;
+    # NULL on older rows), as ids alone can't order them across shards.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS clinics (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        path TEXT UNIQUE NOT NULL
+    )
+    ''')
+    if 'clinic_id' not in _columns(cursor, 'doctors'):
+        cursor.execute("ALTER TABLE doctors ADD COLUMN clinic_id INTEGER REFERENCES clinics(id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS patient_clinics (
+        patient_id INTEGER NOT NULL REFERENCES users(id),
+        clinic_id INTEGER NOT NULL REFERENCES clinics(id),
+        PRIMARY KEY (patient_id, clinic_id)
+    ) WITHOUT ROWID
+    ''')
+    if 'created_at' not in _columns(cursor, 'notifications'):
+        cursor.execute("ALTER TABLE notifications ADD COLUMN created_at INTEGER")
+
+
+def _add_directory_generation(cursor):
+    # A counter bumped by every change to what the doctor directory shows
+    # (repository.DoctorDirectory), so a cached copy can tell it is stale
+    # from one row, where PRAGMA data_version changes with any commit to
+    # any table: bookings and sign-ins included.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS directory_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        generation INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO directory_generation (id, generation) VALUES (0, 0)")
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'), ('update', 'UPDATE OF id, name, speciality')):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS directory_doctors_{name} AFTER {event} ON doctors BEGIN
+            UPDATE directory_generation SET generation = generation + 1 WHERE id = 0;
+        END
+        ''')
+
+
+def _add_suspended_schema(cursor):
+    # Indexes and triggers a bulk load has dropped for its duration (see
+    # bulk.suspended), recorded in the transaction that drops them. Normally
+    # the load puts them back and clears its rows; if it died first, the
+    # next connection pool to open the database does (see
+    # ConnectionPool._recover).
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS suspended_schema (
+        name TEXT PRIMARY KEY,
+        sql TEXT NOT NULL
+    )
+    ''')
+
+
+# (version, step) pairs. Never edit a step once it has shipped; add a new one.
+MIGRATIONS = [
+    (1, _create_tables),
+    (2, _add_doctor_email),
+    (3, _add_lookup_indexes),
+    (4, _add_keyset_indexes),
+    (5, _add_doctor_search),
+    (6, _add_appointment_slots),
+    (7, _add_start_minutes),
+    (8, _add_notification_cursors),
+    (9, _add_notification_recipients),
+    (10, _add_sessions),
+    (11, _add_waitlist),
+    (12, _add_statistics),
+    (13, _add_outbox),
+    (14, _add_clinics),
+    (15, _add_directory_generation),
+    (16, _add_suspended_schema),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+
+    cursor = conn.cursor()
+    for version, step in MIGRATIONS:
+        try:
+            # Take the write lock before re-reading the version so that two
+            # app instances starting together don't both run the same step.
+            cursor.execute("BEGIN IMMEDIATE")
+            if schema_version(conn) < version:
+                step(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return schema_version(conn)
@@ -0,0 +1,832 @@
+import itertools
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+import instrumentation
+from auth import SESSION_DAYS, hash_password, new_session_token, token_digest, verify_nobody, verify_password
+from availability import EPOCH, MINUTES_PER_DAY, SLOT_MINUTES, decode, midnight_of, now_minute, working_slots
+from migrations import migrate
+
+DB_PATH = 'doctor_appointment_system.db'
+
+# Appointments and notifications old enough to be archived (see archive.py)
+# move to a second database file, attached only when something asks for
+# history, so the main file stays small enough to live in the page cache.
+HISTORY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS history.appointments (
+        id INTEGER PRIMARY KEY,
+        patient_id INTEGER NOT NULL,
+        doctor_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        slot INTEGER,
+        start_minute INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS history.idx_appointments_doctor
+    ON appointments (doctor_id, start_minute, id, patient_id);
+    CREATE INDEX IF NOT EXISTS history.idx_appointments_patient
+    ON appointments (patient_id, start_minute, id, doctor_id);
+    CREATE TABLE IF NOT EXISTS history.notifications (
+        id INTEGER PRIMARY KEY,
+        doctor_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        start_minute INTEGER,
+        recipient_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS history.idx_notifications_recipient
+    ON notifications (recipient_id, id);
+'''
+
+
+def history_path(path):
+    return f"{os.path.splitext(path)[0]}_history.db"
+
+
+class SlotTakenError(Exception):
+    pass
+
+
+class SeriesConflictError(SlotTakenError):
+    # `conflicts` lists the (date, time) occurrences that are already booked
+    def __init__(self, conflicts):
+        super().__init__(f"{len(conflicts)} of the dates are already booked")
+        self.conflicts = conflicts
+
+
+class ConnectionPool:
+    # Every thread gets its own connection (sqlite3 connections must not be
+    # used from two threads at once). Idle connections are reused, and no
+    # more than `size` are ever open, so a burst of threads waits instead of
+    # piling up file handles.
+    def __init__(self, path=DB_PATH, size=4, timeout=10.0, busy_timeout=5000, cached_statements=256,
+                 journal_mode='WAL', synchronous='NORMAL', history=None):
+        self.path = path
+        self.history_path = history or history_path(path)
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._migrated = False
+        self._opened = []
+        self._with_history = set()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=instrumentation.connection_factory(),
+        )
+        instrumentation.install(conn)
+        # WAL lets readers run alongside the single writer; NORMAL sync is
+        # durable across application crashes and much cheaper per commit.
+        conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        with self._lock:
+            if not self._migrated:
+                migrate(conn)
+                self._recover(conn)
+                self._migrated = True
+            self._opened.append(conn)
+        return conn
+
+    def _recover(self, conn):
+        # A bulk load that never finished (see bulk.suspended) leaves indexes
+        # or triggers dropped: put them back and, if the statistics triggers
+        # were among them, recount what they missed.
+        if conn.execute("SELECT 1 FROM suspended_schema LIMIT 1").fetchone() is None:
+            return
+        attached = self.has_history()
+        if attached:
+            conn.execute("ATTACH DATABASE ? AS history", (self.history_path,))
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if any(name.startswith('stats_') for name in restore_suspended(conn)):
+                    rebuild_stats(conn)
+        finally:
+            if attached:
+                conn.execute("DETACH DATABASE history")
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("connection pool exhausted")
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._open()
+            except Exception:
+                self._slots.release()
+                raise
+        self._local.conn = conn
+        return conn
+
+    def dedicated(self):
+        # A connection outside the per-thread ones, for a long-lived user
+        # that serializes its own access to it. It takes no pool slot, and
+        # close() closes it with the rest.
+        return self._open()
+
+    def release(self):
+        # Hand the calling thread's connection back for another thread to use.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        self._slots.release()
+
+    def history(self):
+        # The calling thread's connection with the history database attached
+        # as "history" (created if missing). Attaching happens once per
+        # connection, on first use.
+        conn = self.connection()
+        if id(conn) not in self._with_history:
+            conn.execute("ATTACH DATABASE ? AS history", (self.history_path,))
+            conn.execute(f"PRAGMA history.journal_mode={self.journal_mode}")
+            conn.executescript(HISTORY_SCHEMA)
+            self._with_history.add(id(conn))
+        return conn
+
+    def has_history(self):
+        return os.path.exists(self.history_path)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # immediate=True takes the write lock up front, so a transaction that
+        # reads before it writes can't lose a race to another writer halfway.
+        # Inside another transaction this becomes a savepoint: an error undoes
+        # just this part, and the outer transaction decides when to commit
+        # (see server.GroupCommitWriter).
+        conn = self.connection()
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            name = f"nested_{depth}"
+            conn.execute(f"SAVEPOINT {name}")
+            self._local.depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                conn.execute(f"ROLLBACK TO {name}")
+                raise
+            finally:
+                self._local.depth = depth
+                conn.execute(f"RELEASE {name}")
+            return
+        self._local.depth = 1
+        try:
+            with conn:
+                if immediate:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            conn.close()
+        self._with_history.clear()
+
+
+class UserRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def authenticate(self, username, password):
+        # Slow on purpose (see auth.py), so call it from a worker thread.
+        # Returns the user row, or None. Passwords stored with a legacy or
+        # outdated hash are re-hashed while the plain password is at hand.
+        user, new_hash = self.check(username, password)
+        if new_hash is not None:
+            self.rehash(user, new_hash)
+        return user
+
+    def check(self, username, password):
+        # authenticate() without the write, for callers that send writes
+        # elsewhere (see server.Service.login): (user row or None, the hash
+        # to store in place of an outdated one or None)
+        user = self.pool.connection().execute(
+            "SELECT * FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if user is None:
+            return verify_nobody(password) or None, None
+        matches, needs_rehash = verify_password(password, user[2])
+        if not matches:
+            return None, None
+        return user, hash_password(password) if needs_rehash else None
+
+    def rehash(self, user, new_hash):
+        # Unless the password has changed since `user` was read
+        with self.pool.transaction() as conn:
+            conn.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (new_hash, user[0], user[2]))
+
+    def register(self, username, password_hash, role, speciality=None, email=None):
+        # Raises sqlite3.IntegrityError when the username is taken. With an
+        # email address, notifications are mailed too (see mailer.py).
+        with self.pool.transaction() as conn:
+            user_id = conn.execute(
+                "INSERT INTO users (username, password, role, email) VALUES (?, ?, ?, ?)",
+                (username, password_hash, role, email),
+            ).lastrowid
+            if role == 'doctor':
+                conn.execute(
+                    "INSERT INTO doctors (id, name, speciality, email) VALUES (?, ?, ?, ?)",
+                    (user_id, username, speciality, email),
+                )
+        return user_id
+
+    def create_session(self, user_id, days=SESSION_DAYS):
+        # Returns the token to hand back to the client; only its digest is kept
+        token = new_session_token()
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ? AND expires_at <= ?", (user_id, int(time.time())))
+            conn.execute(
+                "INSERT INTO sessions (token_hash, user_id, expires_at) VALUES (?, ?, ?)",
+                (token_digest(token), user_id, int(time.time()) + days * 24 * 60 * 60),
+            )
+        return token
+
+    def resume(self, token):
+        # The user row for a live session token, or None
+        return self.pool.connection().execute('''
+            SELECT u.* FROM sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash = ? AND s.expires_at > ?
+        ''', (token_digest(token), int(time.time()))).fetchone()
+
+    def end_session(self, token):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE token_hash = ?", (token_digest(token),))
+
+
+class DoctorRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def all(self):
+        return self.pool.connection().execute("SELECT id, name, speciality FROM doctors").fetchall()
+
+    def search(self, text, limit=20):
+        # Every word the user typed is matched as a prefix of a word in the
+        # doctor's name or speciality. Results come back in id order rather
+        # than by rank: ranking would have to score every match, while this
+        # stops after `limit` rows.
+        terms = re.findall(r"\w+", text)
+        if not terms:
+            return []
+        query = " ".join(f'"{term}"*' for term in terms)
+        return self.pool.connection().execute('''
+            SELECT d.id, d.name, d.speciality
+            FROM doctors_fts
+            JOIN doctors d ON d.id = doctors_fts.rowid
+            WHERE doctors_fts MATCH ?
+            LIMIT ?
+        ''', (query, limit)).fetchall()
+
+
+class DoctorDirectory:
+    # Process-wide cache of the doctor list, keyed by id. It is reloaded only
+    # when invalidate() has been called since the last load or when the
+    # directory_generation counter (migration 15), which triggers bump on
+    # any change to doctors, has moved since then. Bookings, cancellations
+    # and sign-ins leave it alone, so checking a fresh cache costs one
+    # single-row read.
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._conn = None
+        self._doctors = {}
+        self._generation = 0
+        self._loaded_generation = None
+        self._directory_generation = None
+        self.loads = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+
+    def all(self, limit=None):
+        with self._lock:
+            self._refresh()
+            return list(itertools.islice(self._doctors.values(), limit))
+
+    def get(self, doctor_id):
+        with self._lock:
+            self._refresh()
+            return self._doctors.get(doctor_id)
+
+    def _refresh(self):
+        if self._conn is None:
+            # Only used under the lock, so callers on any thread share it
+            self._conn = self.pool.dedicated()
+        with self._conn:
+            # One snapshot for the counter and the rows read with it
+            self._conn.execute("BEGIN")
+            directory_generation = self._conn.execute(
+                "SELECT generation FROM directory_generation WHERE id = 0"
+            ).fetchone()[0]
+            if self._loaded_generation == self._generation and self._directory_generation == directory_generation:
+                return
+            rows = self._conn.execute("SELECT id, name, speciality FROM doctors").fetchall()
+        self._doctors = {row[0]: row for row in rows}
+        self._loaded_generation = self._generation
+        self._directory_generation = directory_generation
+        self.loads += 1
+
+
+class AppointmentRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def book(self, patient_id, doctor_id, start_minute):
+        # start_minute comes from availability.encode(). Raises SlotTakenError
+        # if the doctor already has this slot booked.
+        date, time = decode(start_minute)
+        with self.pool.transaction(immediate=True) as conn:
+            try:
+                return conn.execute(
+                    "INSERT INTO appointments (patient_id, doctor_id, date, time, start_minute, slot) VALUES (?, ?, ?, ?, ?, ?)",
+                    (patient_id, doctor_id, date, time, start_minute, start_minute // SLOT_MINUTES),
+                ).lastrowid
+            except sqlite3.IntegrityError as exc:
+                raise SlotTakenError(f"{date} {time} is already booked") from exc
+
+    def book_series(self, patient_id, doctor_id, start_minutes, skip_conflicts=False):
+        # Book a whole series (see availability.recurrence) in one transaction.
+        # The doctor's bookings across the series' span are read with a single
+        # range query and every occurrence is checked against them. If any
+        # clash, nothing is booked and SeriesConflictError lists them, unless
+        # skip_conflicts is set, when just the free ones are booked. Returns
+        # the (date, time) pairs booked.
+        start_minutes = list(start_minutes)
+        if not start_minutes:
+            return []
+        with self.pool.transaction(immediate=True) as conn:
+            taken = {minute // SLOT_MINUTES for (minute,) in conn.execute('''
+                SELECT start_minute FROM appointments
+                WHERE doctor_id = ? AND start_minute >= ? AND start_minute < ?
+            ''', (doctor_id, min(start_minutes) // SLOT_MINUTES * SLOT_MINUTES,
+                  (max(start_minutes) // SLOT_MINUTES + 1) * SLOT_MINUTES))}
+            free = [minute for minute in start_minutes if minute // SLOT_MINUTES not in taken]
+            if len(free) < len(start_minutes) and not skip_conflicts:
+                raise SeriesConflictError([decode(minute) for minute in start_minutes if minute // SLOT_MINUTES in taken])
+            conn.executemany(
+                "INSERT INTO appointments (patient_id, doctor_id, date, time, start_minute, slot) VALUES (?, ?, ?, ?, ?, ?)",
+                [(patient_id, doctor_id) + decode(minute) + (minute, minute // SLOT_MINUTES) for minute in free],
+            )
+        return [decode(minute) for minute in free]
+
+    def page_for_patient(self, patient_id, after=None, limit=100, descending=False, date_from=None, date_to=None,
+                         include_history=False):
+        return self._page('''
+            SELECT a.id, d.name, a.date, a.time, a.start_minute
+            FROM {appointments} a
+            JOIN main.doctors d ON a.doctor_id = d.id
+        ''', 'patient_id', patient_id, after, limit, descending, date_from, date_to, include_history)
+
+    def page_for_doctor(self, doctor_id, after=None, limit=100, descending=False, date_from=None, date_to=None,
+                        include_history=False):
+        return self._page('''
+            SELECT a.id, u.username, a.date, a.time, a.start_minute
+            FROM {appointments} a
+            JOIN main.users u ON a.patient_id = u.id
+        ''', 'doctor_id', doctor_id, after, limit, descending, date_from, date_to, include_history)
+
+    def doctor_schedule(self, doctor_id, first_day, days):
+        # Every booking in the `days` days from epoch day `first_day`, as
+        # (id, start_minute, patient): one seek on (doctor_id, start_minute)
+        start = first_day * MINUTES_PER_DAY
+        return self.pool.connection().execute('''
+            SELECT a.id, a.start_minute, u.username
+            FROM appointments a
+            JOIN users u ON a.patient_id = u.id
+            WHERE a.doctor_id = ? AND a.start_minute >= ? AND a.start_minute < ?
+            ORDER BY a.start_minute
+        ''', (doctor_id, start, start + days * MINUTES_PER_DAY)).fetchall()
+
+    def _page(self, select, owner_column, owner_id, after, limit, descending, date_from, date_to, include_history):
+        # Keyset pagination on (start_minute, id): `after` is the page_key()
+        # of the last row already shown, so each page is an index seek rather
+        # than an OFFSET scan over everything before it. Dates are YYYY-MM-DD.
+        # With include_history, the same page is read from the archive too
+        # and the two are merged; ids never clash as archived rows keep theirs.
+        clauses = [f"a.{owner_column} = ?"]
+        params = [owner_id]
+        if date_from:
+            clauses.append("a.start_minute >= ?")
+            params.append(midnight_of(date_from))
+        if date_to:
+            clauses.append("a.start_minute < ?")
+            params.append(midnight_of(date_to) + MINUTES_PER_DAY)
+        if after is not None:
+            clauses.append(f"(a.start_minute, a.id) {'<' if descending else '>'} (?, ?)")
+            params.extend(after)
+        order = "DESC" if descending else "ASC"
+        params.append(limit)
+        query = f"{select} WHERE {' AND '.join(clauses)} ORDER BY a.start_minute {order}, a.id {order} LIMIT ?"
+        if not include_history:
+            return self.pool.connection().execute(query.format(appointments='main.appointments'), params).fetchall()
+        return self.pool.history().execute(f'''
+            SELECT * FROM ({query.format(appointments='main.appointments')})
+            UNION ALL
+            SELECT * FROM ({query.format(appointments='history.appointments')})
+            ORDER BY 5 {order}, 1 {order}
+            LIMIT ?
+        ''', params + params + [limit]).fetchall()
+
+    @staticmethod
+    def page_key(row):
+        return (row[4], row[0])
+
+    def cancel(self, appointment_id, reason, patient_id=None):
+        # Delete the appointment, notify the doctor and hand the freed slot to
+        # the first fitting patient on the doctor's waitlist, all in one
+        # transaction, so a crash can't lose any part and it costs a single
+        # commit. With patient_id set, only that patient's own appointment is
+        # touched. Returns (date, time, doctor name, doctor id, patient
+        # username), or None if there was nothing to cancel.
+        with self.pool.transaction(immediate=True) as conn:
+            details = conn.execute('''
+                SELECT a.date, a.time, d.name, d.id, u.username, a.start_minute, a.patient_id
+                FROM appointments a
+                JOIN doctors d ON a.doctor_id = d.id
+                JOIN users u ON a.patient_id = u.id
+                WHERE a.id = ?
+            ''', (appointment_id,)).fetchone()
+            if details is None or (patient_id is not None and details[6] != patient_id):
+                return None
+            date, time, doctor_name, doctor_id, patient_name, start_minute, owner_id = details
+            conn.execute("DELETE FROM appointments WHERE id = ?", (appointment_id,))
+            conn.execute('''
+                INSERT INTO cancellations (appointment_id, doctor_id, patient_id, start_minute, cancelled_at, cancelled_by, reason)
+                VALUES (?, ?, ?, ?, ?, 'patient', ?)
+            ''', (appointment_id, doctor_id, owner_id, start_minute, now_minute(), reason))
+            message = (
+                f"Patient {patient_name} has cancelled the appointment on {date} at {time}.\n"
+                f"Reason: {reason}"
+            )
+            _notify(conn, [(doctor_id, doctor_id, message, date, time, start_minute)])
+            _backfill(conn, doctor_id, doctor_name, start_minute)
+        return date, time, doctor_name, doctor_id, patient_name
+
+    def cancel_range(self, doctor_id, date_from, date_to, reason):
+        # Cancel every appointment a doctor has between two dates (inclusive)
+        # with one DELETE, and tell each patient. Returns how many were
+        # cancelled.
+        first, last = midnight_of(date_from), midnight_of(date_to) + MINUTES_PER_DAY
+        with self.pool.transaction(immediate=True) as conn:
+            affected = conn.execute('''
+                SELECT a.patient_id, a.date, a.time, a.start_minute, d.name
+                FROM appointments a
+                JOIN doctors d ON a.doctor_id = d.id
+                WHERE a.doctor_id = ? AND a.start_minute >= ? AND a.start_minute < ?
+            ''', (doctor_id, first, last)).fetchall()
+            if not affected:
+                return 0
+            conn.execute('''
+                INSERT INTO cancellations (appointment_id, doctor_id, patient_id, start_minute, cancelled_at, cancelled_by, reason)
+                SELECT id, doctor_id, patient_id, start_minute, ?, 'doctor', ?
+                FROM appointments
+                WHERE doctor_id = ? AND start_minute >= ? AND start_minute < ?
+            ''', (now_minute(), reason, doctor_id, first, last))
+            conn.execute(
+                "DELETE FROM appointments WHERE doctor_id = ? AND start_minute >= ? AND start_minute < ?",
+                (doctor_id, first, last),
+            )
+            _notify(conn, (
+                (patient_id, doctor_id,
+                 f"Dr. {doctor_name} has cancelled the appointment on {date} at {time}.\nReason: {reason}",
+                 date, time, start_minute)
+                for patient_id, date, time, start_minute, doctor_name in affected
+            ))
+        return len(affected)
+
+
+def _backfill(conn, doctor_id, doctor_name, start_minute):
+    # Book the freed slot for the highest-priority, longest-waiting patient
+    # whose window covers it, and tell them. Returns their patient id, or
+    # None. Days a doctor cancels (cancel_range) are days off, so only single
+    # cancellations come here.
+    if start_minute <= now_minute():
+        return None
+    candidate = conn.execute('''
+        SELECT id, patient_id FROM waitlist
+        WHERE doctor_id = ? AND earliest_minute <= ? AND latest_minute > ?
+        ORDER BY priority DESC, id
+        LIMIT 1
+    ''', (doctor_id, start_minute, start_minute)).fetchone()
+    if candidate is None:
+        return None
+    entry_id, patient_id = candidate
+    date, time = decode(start_minute)
+    try:
+        conn.execute(
+            "INSERT INTO appointments (patient_id, doctor_id, date, time, start_minute, slot) VALUES (?, ?, ?, ?, ?, ?)",
+            (patient_id, doctor_id, date, time, start_minute, start_minute // SLOT_MINUTES),
+        )
+    except sqlite3.IntegrityError:
+        # A legacy double booking still holds the slot
+        return None
+    conn.execute("DELETE FROM waitlist WHERE id = ?", (entry_id,))
+    _notify(conn, [(
+        patient_id, doctor_id,
+        f"A slot opened up: you are now booked with Dr. {doctor_name} on {date} at {time}.",
+        date, time, start_minute,
+    )])
+    return patient_id
+
+
+def _notify(conn, rows):
+    # rows: (recipient_id, doctor_id, message, date, time, start_minute)
+    conn.executemany('''
+        INSERT INTO notifications (recipient_id, doctor_id, message, date, time, start_minute, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+    ''', rows)
+
+
+class WaitlistRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def join(self, patient_id, doctor_id, date_from, date_to, priority=0):
+        # Wait for any slot with the doctor between two dates (inclusive).
+        # Joining again replaces the patient's window for that doctor but
+        # keeps their place in the queue.
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO waitlist (doctor_id, patient_id, priority, earliest_minute, latest_minute)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (patient_id, doctor_id) DO UPDATE SET
+                    priority = excluded.priority,
+                    earliest_minute = excluded.earliest_minute,
+                    latest_minute = excluded.latest_minute
+            ''', (doctor_id, patient_id, priority, midnight_of(date_from), midnight_of(date_to) + MINUTES_PER_DAY))
+            # Nobody can be booked into a window that has already passed
+            conn.execute("DELETE FROM waitlist WHERE doctor_id = ? AND latest_minute <= ?", (doctor_id, now_minute()))
+
+    def leave(self, patient_id, doctor_id):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM waitlist WHERE patient_id = ? AND doctor_id = ?", (patient_id, doctor_id))
+
+    def for_patient(self, patient_id):
+        # (doctor_id, doctor name, first date, last date)
+        return [
+            (doctor_id, name, decode(earliest)[0], decode(latest - MINUTES_PER_DAY)[0])
+            for doctor_id, name, earliest, latest in self.pool.connection().execute('''
+                SELECT w.doctor_id, d.name, w.earliest_minute, w.latest_minute
+                FROM waitlist w JOIN doctors d ON d.id = w.doctor_id
+                WHERE w.patient_id = ?
+                ORDER BY w.earliest_minute
+            ''', (patient_id,))
+        ]
+
+
+class StatsRepo:
+    # Reads the daily_stats counts kept by the triggers of migration 12, so
+    # a report costs one row per doctor per day. Dates are YYYY-MM-DD and
+    # ranges inclusive. Each row ends (booked, patient cancellations, doctor
+    # cancellations, capacity), capacity being the bookable slots in the
+    # range (availability.working_slots).
+    def __init__(self, pool):
+        self.pool = pool
+
+    def by_day(self, doctor_id, date_from, date_to):
+        # Every day in the range, busy or not
+        first, last = _days(date_from, date_to)
+        counts = {day: row for day, *row in self.pool.connection().execute('''
+            SELECT day, booked, patient_cancelled, doctor_cancelled FROM daily_stats
+            WHERE doctor_id = ? AND day BETWEEN ? AND ?
+        ''', (doctor_id, first, last))}
+        rows = []
+        date = EPOCH.date() + timedelta(days=first)
+        for day in range(first, last + 1):
+            rows.append((date.isoformat(), *counts.get(day, (0, 0, 0)), working_slots(day)))
+            date += timedelta(days=1)
+        return rows
+
+    def by_doctor(self, date_from, date_to, speciality=None):
+        # (doctor id, name, speciality, ...) for doctors with any activity
+        first, last = _days(date_from, date_to)
+        params = [first, last]
+        where = ""
+        if speciality:
+            where = "WHERE d.speciality = ?"
+            params.append(speciality)
+        capacity = _capacity(first, last)
+        return [row + (capacity,) for row in self.pool.connection().execute(f'''
+            SELECT d.id, d.name, d.speciality, s.booked, s.patient_cancelled, s.doctor_cancelled
+            FROM (
+                SELECT doctor_id, sum(booked) AS booked, sum(patient_cancelled) AS patient_cancelled,
+                       sum(doctor_cancelled) AS doctor_cancelled
+                FROM daily_stats WHERE day BETWEEN ? AND ?
+                GROUP BY doctor_id
+            ) s
+            JOIN doctors d ON d.id = s.doctor_id
+            {where}
+            ORDER BY d.name
+        ''', params)]
+
+    def by_speciality(self, date_from, date_to):
+        # (speciality, number of doctors, ...); capacity covers every doctor
+        # of the speciality, busy or not
+        first, last = _days(date_from, date_to)
+        capacity = _capacity(first, last)
+        return [row + (row[1] * capacity,) for row in self.pool.connection().execute('''
+            SELECT d.speciality, count(*), coalesce(sum(s.booked), 0), coalesce(sum(s.patient_cancelled), 0),
+                   coalesce(sum(s.doctor_cancelled), 0)
+            FROM doctors d
+            LEFT JOIN (
+                SELECT doctor_id, sum(booked) AS booked, sum(patient_cancelled) AS patient_cancelled,
+                       sum(doctor_cancelled) AS doctor_cancelled
+                FROM daily_stats WHERE day BETWEEN ? AND ?
+                GROUP BY doctor_id
+            ) s ON s.doctor_id = d.id
+            GROUP BY d.speciality
+            ORDER BY d.speciality
+        ''', (first, last))]
+
+    def reasons(self, doctor_id, date_from, date_to, limit=100):
+        # The latest cancellations of a doctor's appointments in the range:
+        # (date, time, cancelled by, patient username, reason)
+        first, last = _days(date_from, date_to)
+        return [
+            decode(start_minute) + (cancelled_by, patient, reason)
+            for start_minute, cancelled_by, patient, reason in self.pool.connection().execute('''
+                SELECT c.start_minute, c.cancelled_by, u.username, c.reason
+                FROM cancellations c LEFT JOIN users u ON u.id = c.patient_id
+                WHERE c.doctor_id = ? AND c.start_minute >= ? AND c.start_minute < ?
+                ORDER BY c.start_minute DESC
+                LIMIT ?
+            ''', (doctor_id, first * MINUTES_PER_DAY, (last + 1) * MINUTES_PER_DAY, limit))
+        ]
+
+    def rebuild(self):
+        # Recount everything from appointments (archived ones included) and
+        # cancellations, for when the counts are suspect.
+        if self.pool.has_history():
+            self.pool.history()
+        with self.pool.transaction(immediate=True) as conn:
+            rebuild_stats(conn)
+
+
+def _days(date_from, date_to):
+    return midnight_of(date_from) // MINUTES_PER_DAY, midnight_of(date_to) // MINUTES_PER_DAY
+
+
+def _capacity(first, last):
+    return sum(working_slots(day) for day in range(first, last + 1))
+
+
+def rebuild_stats(conn):
+    # Call inside a transaction. Archived appointments still count, so
+    # attach the history database first if there is one (see
+    # ConnectionPool.history).
+    archived = ""
+    if any(row[1] == 'history' for row in conn.execute("PRAGMA database_list")):
+        archived = f'''
+            UNION ALL
+            SELECT doctor_id, start_minute / {MINUTES_PER_DAY}, 1, 0, 0 FROM history.appointments
+        '''
+    conn.execute("DELETE FROM main.daily_stats")
+    conn.execute(f'''
+        INSERT INTO main.daily_stats (doctor_id, day, booked, patient_cancelled, doctor_cancelled)
+        SELECT doctor_id, day, sum(booked), sum(patient_cancelled), sum(doctor_cancelled) FROM (
+            SELECT doctor_id, start_minute / {MINUTES_PER_DAY} AS day, 1 AS booked, 0 AS patient_cancelled,
+                   0 AS doctor_cancelled
+            FROM main.appointments{archived}
+            UNION ALL
+            SELECT doctor_id, start_minute / {MINUTES_PER_DAY}, 0, cancelled_by = 'patient', cancelled_by = 'doctor'
+            FROM main.cancellations
+        )
+        GROUP BY doctor_id, day
+    ''')
+
+
+def restore_suspended(conn, names=None):
+    # Call inside a transaction. Recreates the indexes and triggers listed
+    # in suspended_schema (all of them, or just `names`) and clears their
+    # rows. One already back, put there by another process, is left as it
+    # is. Returns the names restored.
+    restored = []
+    for name, sql in conn.execute("SELECT name, sql FROM main.suspended_schema ORDER BY name").fetchall():
+        if names is not None and name not in names:
+            continue
+        if conn.execute("SELECT 1 FROM main.sqlite_master WHERE name = ?", (name,)).fetchone() is None:
+            conn.execute(sql)
+        conn.execute("DELETE FROM main.suspended_schema WHERE name = ?", (name,))
+        restored.append(name)
+    return restored
+
+
+class OutboxRepo:
+    # The email queue filled by the outbox_notification trigger (migration
+    # 13). Rows are leased before sending so that two dispatchers never send
+    # the same one; a lease that runs out (its dispatcher died) frees the
+    # row again. Times are Unix seconds.
+    def __init__(self, pool):
+        self.pool = pool
+
+    def claim(self, limit, lease_seconds):
+        # The next `limit` due rows, oldest first: (id, recipient, subject,
+        # body, attempts, created_at)
+        now = int(time.time())
+        with self.pool.transaction(immediate=True) as conn:
+            rows = conn.execute('''
+                SELECT id, recipient, subject, body, attempts, created_at FROM outbox
+                WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= ? AND leased_until <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            ''', (now, now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET leased_until = ? WHERE id = ?",
+                [(now + lease_seconds, row[0]) for row in rows],
+            )
+        return rows
+
+    def finish(self, sent=(), retry=(), failed=()):
+        # Record a batch's outcomes in one transaction. sent: ids; retry:
+        # (id, next attempt time, error); failed: (id, error).
+        now = int(time.time())
+        with self.pool.transaction() as conn:
+            conn.executemany(
+                "UPDATE outbox SET sent_at = ?, attempts = attempts + 1, leased_until = 0 WHERE id = ?",
+                [(now, outbox_id) for outbox_id in sent],
+            )
+            conn.executemany('''
+                UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, leased_until = 0
+                WHERE id = ?
+            ''', [(next_attempt, error, outbox_id) for outbox_id, next_attempt, error in retry])
+            conn.executemany('''
+                UPDATE outbox SET failed_at = ?, attempts = attempts + 1, last_error = ?, leased_until = 0
+                WHERE id = ?
+            ''', [(now, error, outbox_id) for outbox_id, error in failed])
+
+    def counts(self):
+        # {'pending': n, 'sent': n, 'failed': n}
+        pending, sent, failed = self.pool.connection().execute('''
+            SELECT count(*) FILTER (WHERE sent_at IS NULL AND failed_at IS NULL),
+                   count(sent_at), count(failed_at)
+            FROM outbox
+        ''').fetchone()
+        return {'pending': pending, 'sent': sent, 'failed': failed}
+
+
+class NotificationRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def recent(self, user_id, limit=50):
+        # Newest first: (id, message, date, time)
+        return self.pool.connection().execute('''
+            SELECT id, message, date, time FROM notifications
+            WHERE recipient_id = ? ORDER BY id DESC LIMIT ?
+        ''', (user_id, limit)).fetchall()
+
+    def since(self, user_id, after_id, limit=100):
+        # Oldest first, so polling can advance its cursor page by page
+        return self.pool.connection().execute('''
+            SELECT id, message, date, time FROM notifications
+            WHERE recipient_id = ? AND id > ? ORDER BY id LIMIT ?
+        ''', (user_id, after_id, limit)).fetchall()
+
+    def last_seen(self, user_id):
+        row = self.pool.connection().execute(
+            "SELECT last_seen_id FROM notification_cursors WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def unread_count(self, user_id):
+        return self.pool.connection().execute('''
+            SELECT count(*) FROM notifications
+            WHERE recipient_id = ? AND id > coalesce((SELECT last_seen_id FROM notification_cursors WHERE user_id = ?), 0)
+        ''', (user_id, user_id)).fetchone()[0]
+
+    def mark_seen(self, user_id, last_id):
+        # Everything up to and including last_id becomes read
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                INSERT INTO notification_cursors (user_id, last_seen_id) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET last_seen_id = max(last_seen_id, excluded.last_seen_id)
+            ''', (user_id, last_id))
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from availability import DAY_END, DAY_START, EPOCH, MINUTES_PER_DAY, SLOT_MINUTES, WORKING_WEEKDAYS, time_of
+
+# Week and month calendar for doctors. One range query gives the doctor's
+# bookings for the whole view, which become a days x slots matrix of booking
+# counts; per-day load, idle gaps and overbooking are then computed on the
+# whole matrix at once. This module needs NumPy, which the rest of the app
+# doesn't: the Calendar tab is only offered where it is installed, and this
+# module is only imported when the tab is first opened.
+
+SLOTS_PER_DAY = MINUTES_PER_DAY // SLOT_MINUTES
+
+# Cell states, as drawn by widgets.CalendarCanvas
+CLOSED, FREE, BOOKED, OVERBOOKED, OFF_HOURS = range(5)
+
+
+def view_range(view, day):
+    # (first epoch day, number of days) of the week or month containing
+    # `day` (an epoch day number). Weeks start on Monday.
+    if view == 'week':
+        return day - (day + 3) % 7, 7
+    first = EPOCH + timedelta(days=day)
+    first = first.replace(day=1)
+    following = (first + timedelta(days=32)).replace(day=1)
+    return (first - EPOCH).days, (following - first).days
+
+
+def shift(view, first_day, steps):
+    # The first day of the week or month `steps` views away
+    if view == 'week':
+        return first_day + 7 * steps
+    month = EPOCH + timedelta(days=first_day)
+    index = month.year * 12 + month.month - 1 + steps
+    return (datetime(index // 12, index % 12 + 1, 1) - EPOCH).days
+
+
+class ScheduleGrid:
+    # counts[d, s] = bookings in slot s of day first_day + d. `rows` are
+    # (appointment id, start_minute, patient) as from
+    # AppointmentRepo.doctor_schedule.
+    def __init__(self, first_day, days, rows, day_start=DAY_START, day_end=DAY_END, weekdays=WORKING_WEEKDAYS,
+                 labels=False):
+        self.first_day = first_day
+        self.days = days
+        minutes = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        cells = (minutes - first_day * MINUTES_PER_DAY) // SLOT_MINUTES
+        self.counts = np.bincount(cells, minlength=days * SLOTS_PER_DAY).reshape(days, SLOTS_PER_DAY)
+
+        slots = np.arange(SLOTS_PER_DAY)
+        working_slots = (slots >= -(-day_start // SLOT_MINUTES)) & (slots < day_end // SLOT_MINUTES)
+        weekday = (first_day + np.arange(days) + 3) % 7
+        self.working = np.isin(weekday, weekdays)[:, None] & working_slots[None, :]
+
+        # Patient names per cell, for the week view's cell text
+        self.labels = {}
+        if labels:
+            for _, minute, patient in rows:
+                cell = divmod((minute - first_day * MINUTES_PER_DAY) // SLOT_MINUTES, SLOTS_PER_DAY)
+                self.labels[cell] = self.labels[cell] + ", " + patient if cell in self.labels else patient
+
+        self._summarise()
+
+    def _summarise(self):
+        counts, working = self.counts, self.working
+        occupied = counts > 0
+        self.capacity = working.sum(axis=1)
+        self.booked = (occupied & working).sum(axis=1)
+        self.overbooked = np.maximum(counts - 1, 0).sum(axis=1)
+        self.off_hours = np.where(working, 0, counts).sum(axis=1)
+        self.load = np.divide(self.booked, self.capacity, out=np.zeros(self.days), where=self.capacity > 0)
+
+        # Gaps: free working slots with a booking somewhere before and after
+        # them the same day; longest_gap is the longest run of those
+        before = np.logical_or.accumulate(occupied, axis=1)
+        after = np.logical_or.accumulate(occupied[:, ::-1], axis=1)[:, ::-1]
+        gap = working & ~occupied & before & after
+        self.gaps = gap.sum(axis=1)
+        index = np.arange(SLOTS_PER_DAY)
+        last_break = np.maximum.accumulate(np.where(gap, -1, index), axis=1)
+        self.longest_gap = np.where(gap, index - last_break, 0).max(axis=1, initial=0)
+
+        self.state = np.where(working, FREE, CLOSED)
+        self.state[occupied] = np.where(working, BOOKED, OFF_HOURS)[occupied]
+        self.state[counts > 1] = OVERBOOKED
+
+    def slot_range(self):
+        # (first, last) slot of the day worth showing: working hours, widened
+        # to take in any booking outside them
+        shown = self.working.any(axis=0) | (self.counts > 0).any(axis=0)
+        if not shown.any():
+            return 0, SLOTS_PER_DAY
+        slots = np.flatnonzero(shown)
+        return int(slots[0]), int(slots[-1]) + 1
+
+    def date_of(self, index):
+        return (EPOCH + timedelta(days=self.first_day + index)).date()
+
+    def day_summary(self, index):
+        text = f"{self.booked[index]}/{self.capacity[index]}"
+        if self.capacity[index]:
+            text += f" {self.load[index]:.0%}"
+        if self.overbooked[index]:
+            text += f" +{self.overbooked[index]}"
+        return text
+
+    def totals(self):
+        return {
+            'booked': int(self.booked.sum()),
+            'capacity': int(self.capacity.sum()),
+            'gaps': int(self.gaps.sum()),
+            'overbooked': int(self.overbooked.sum()),
+            'off_hours': int(self.off_hours.sum()),
+            'longest_gap_minutes': int(self.longest_gap.max(initial=0)) * SLOT_MINUTES,
+            'busiest': self.date_of(int(self.load.argmax())) if self.days else None,
+        }
+
+    def cell_text(self, day, slot):
+        return f"{self.date_of(day).isoformat()} {time_of(slot)}: {self.labels.get((day, slot), 'free')}"
@@ -0,0 +1,579 @@
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import instrumentation
+from availability import MAX_OCCURRENCES, RECURRENCES, encode, recurrence
+from repository import DB_PATH, ConnectionPool, DoctorDirectory, DoctorRepo, SeriesConflictError, SlotTakenError, UserRepo
+from shards import CATALOG, FAN_OUT_WORKERS, ShardRouter
+
+# Local HTTP/JSON service over the same repositories as the desktop app, for
+# kiosks and other front ends. Standard library only:
+#   python -m server --port 8080
+#
+#   POST /login                     {"username", "password"} -> {"token", "user"}
+#   POST /logout
+#   GET  /doctors?q=card&limit=20
+#   GET  /doctors/<id>/slots?date=YYYY-MM-DD
+#   GET  /doctors/<id>/next-available
+#   GET  /appointments?from=&to=&after=&limit=&descending=&history=
+#   POST /appointments              {"doctor_id", "date", "time", "repeat"?: {"frequency", "count"?, "until"?},
+#                                    "skip_conflicts"?}
+#   POST /appointments/<id>/cancel  {"reason", "clinic"?}      (patients)
+#   POST /cancel-days               {"from", "to", "reason"}   (doctors)
+#   GET  /notifications?after=<cursor>
+#   POST /notifications/seen        {"last_id"} or {"cursor"}
+#
+# Every call but /login takes "Authorization: Bearer <token>". Reads run on a
+# pool of threads, each with its own pooled connection. Writes go to a writer
+# thread, which commits whatever has queued up in a single transaction
+# (group commit): one fsync is shared by a whole burst of bookings, and
+# writers never wait on each other for the database lock.
+#
+# Clinic data is reached through shards.ShardRouter: with clinic shards set
+# up, each has a writer of its own, so clinics commit side by side.
+# Appointments and notifications then carry the clinic they live in, and a
+# patient's lists merge every clinic's. Notification cursors are per clinic,
+# written "clinic:id,clinic:id" (a bare id is clinic 0, the main database).
+
+HOST = '127.0.0.1'
+PORT = 8080
+READERS = 8
+MAX_BATCH = 64
+MAX_BODY = 64 * 1024
+PAGE_LIMIT = 100
+MAX_PAGE = 1000
+NOTIFICATION_LIMIT = 200
+
+# Details of failed requests stay here; clients get a generic message
+log = logging.getLogger('appointments.server')
+
+REASONS = {
+    200: 'OK', 201: 'Created', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.payload = {'error': message, **details}
+
+
+class GroupCommitWriter:
+    # Queues write operations (plain functions that use pool.transaction)
+    # and runs them on a single thread. Everything waiting when the thread
+    # comes free, up to max_batch, goes into one transaction; each operation
+    # runs in its own savepoint (pool.transaction nests), so one that fails,
+    # say on a taken slot, is undone alone while the rest commit.
+    def __init__(self, pool, max_batch=MAX_BATCH):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.batches = 0
+        self.operations = 0
+        self._queue = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, fn, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, args, future))
+        return await future
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                outcomes = await loop.run_in_executor(self._executor, self._commit, batch)
+            except Exception as error:
+                # The commit itself failed, so nothing in the batch happened
+                outcomes = [(False, error)] * len(batch)
+            for (_, _, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _commit(self, batch):
+        outcomes = []
+        with self.pool.transaction(immediate=True):
+            for fn, args, _ in batch:
+                try:
+                    outcomes.append((True, fn(*args)))
+                except Exception as error:
+                    outcomes.append((False, error))
+        self.batches += 1
+        self.operations += len(batch)
+        return outcomes
+
+
+def _date(value, field):
+    try:
+        datetime.strptime(value or '', "%Y-%m-%d")
+    except ValueError:
+        raise HTTPError(400, f"{field} must be a date, YYYY-MM-DD") from None
+    return value
+
+
+def _doctor_json(row):
+    return {'id': row[0], 'name': row[1], 'speciality': row[2]}
+
+
+def _cursor(text):
+    # "clinic:id,clinic:id" -> {clinic: id}; a bare id is clinic 0
+    cursor = {}
+    try:
+        for part in text.split(','):
+            clinic, _, last_id = part.rpartition(':')
+            cursor[int(clinic or CATALOG)] = int(last_id)
+    except ValueError:
+        raise HTTPError(400, "after must be the cursor of an earlier response") from None
+    return cursor
+
+
+def _cursor_text(cursor):
+    return ','.join(f"{clinic}:{last_id}" for clinic, last_id in sorted(cursor.items()))
+
+
+class Service:
+    def __init__(self, pool, readers=READERS, max_batch=MAX_BATCH):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.users = UserRepo(pool)
+        self.doctors = DoctorRepo(pool)
+        self.directory = DoctorDirectory(pool)
+        # Shard connections: one per reader, the shard's writer and the
+        # router's fan-out threads
+        self.router = ShardRouter(pool, size=readers + 1 + FAN_OUT_WORKERS)
+        self.writers = {CATALOG: GroupCommitWriter(pool, max_batch)}
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        # (method, path pattern, handler, signed in)
+        routes = [
+            ('POST', r'/login', self.login, False),
+            ('POST', r'/logout', self.logout, True),
+            ('GET', r'/doctors', self.list_doctors, True),
+            ('GET', r'/doctors/(\d+)/slots', self.free_slots, True),
+            ('GET', r'/doctors/(\d+)/next-available', self.next_available, True),
+            ('GET', r'/appointments', self.list_appointments, True),
+            ('POST', r'/appointments', self.book, True),
+            ('POST', r'/appointments/(\d+)/cancel', self.cancel, True),
+            ('POST', r'/cancel-days', self.cancel_days, True),
+            ('GET', r'/notifications', self.list_notifications, True),
+            ('POST', r'/notifications/seen', self.mark_seen, True),
+        ]
+        self.routes = [(method, re.compile(pattern), handler, signed_in) for method, pattern, handler, signed_in in routes]
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, fn, *args)
+
+    async def write(self, fn, *args, clinic=CATALOG):
+        # On the clinic's writer, started with its first write
+        writer = self.writers.get(clinic)
+        if writer is None:
+            pool = await self.read(self.router.pool, clinic)
+            writer = self.writers.setdefault(clinic, GroupCommitWriter(pool, self.max_batch))
+            if writer._task is None:
+                writer.start()
+        return await writer.submit(fn, *args)
+
+    def start(self):
+        self.writers[CATALOG].start()
+
+    async def stop(self):
+        for writer in list(self.writers.values()):
+            await writer.stop()
+        self._readers.shutdown(wait=True)
+        self.router.close()
+
+    def clinic_for(self, doctor_id):
+        # Runs on a reader: the doctor's clinic, its shard opened
+        clinic = self.router.clinic_of(doctor_id)
+        self.router.pool(clinic)
+        return clinic
+
+    # Routing
+
+    async def dispatch(self, method, target, headers, body):
+        # Returns (status, payload)
+        url = urlsplit(target)
+        allowed = False
+        for route_method, pattern, handler, signed_in in self.routes:
+            match = pattern.fullmatch(url.path)
+            if match is None:
+                continue
+            allowed = True
+            if route_method != method:
+                continue
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                raise HTTPError(400, "body must be JSON") from None
+            if not isinstance(data, dict):
+                raise HTTPError(400, "body must be a JSON object")
+            user = await self.signed_in_user(headers) if signed_in else None
+            started = time.perf_counter()
+            try:
+                return await handler(user, *match.groups(), query=query, data=data, headers=headers)
+            finally:
+                if instrumentation.ENABLED:
+                    instrumentation.recorder.action('request', handler.__name__, time.perf_counter() - started)
+        if allowed:
+            raise HTTPError(405, f"{method} is not allowed on {url.path}")
+        raise HTTPError(404, f"no such endpoint: {url.path}")
+
+    async def signed_in_user(self, headers):
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            raise HTTPError(401, "sign in first")
+        user = await self.read(self.users.resume, token.strip())
+        if user is None:
+            raise HTTPError(401, "session expired, sign in again")
+        return user
+
+    # Handlers; each returns (status, payload)
+
+    async def login(self, user, query, data, headers):
+        username, password = data.get('username'), data.get('password')
+        if not username or not password:
+            raise HTTPError(400, "username and password are required")
+        # Checking the password is slow and only reads, so it runs on a
+        # reader; storing an upgraded hash rides along with the session
+        user, new_hash = await self.read(self.users.check, username, password)
+        if user is None:
+            raise HTTPError(401, "invalid username or password")
+
+        def sign_in():
+            if new_hash is not None:
+                self.users.rehash(user, new_hash)
+            return self.users.create_session(user[0])
+
+        token = await self.write(sign_in)
+        return 200, {'token': token, 'user': {'id': user[0], 'username': user[1], 'role': user[3]}}
+
+    async def logout(self, user, query, data, headers):
+        token = headers['authorization'].partition(' ')[2].strip()
+        await self.write(self.users.end_session, token)
+        return 200, {}
+
+    async def list_doctors(self, user, query, data, headers):
+        limit = max(1, min(int(query.get('limit', 20)), MAX_PAGE))
+        text = query.get('q', '').strip()
+        if text:
+            rows = await self.read(self.doctors.search, text, limit)
+        else:
+            rows = await self.read(self.directory.all, limit)
+        return 200, {'doctors': [_doctor_json(row) for row in rows]}
+
+    async def free_slots(self, user, doctor_id, query, data, headers):
+        date = _date(query.get('date'), 'date')
+        def fetch():
+            return self.router.availability(self.clinic_for(int(doctor_id))).free_slots(int(doctor_id), date)
+
+        return 200, {'date': date, 'slots': await self.read(fetch)}
+
+    async def next_available(self, user, doctor_id, query, data, headers):
+        def fetch():
+            return self.router.availability(self.clinic_for(int(doctor_id))).next_available(int(doctor_id))
+
+        date, time_text = await self.read(fetch) or (None, None)
+        return 200, {'date': date, 'time': time_text}
+
+    async def list_appointments(self, user, query, data, headers):
+        # Keyset paging as in the app: pass the "next" value back as "after"
+        date_from = _date(query['from'], 'from') if query.get('from') else None
+        date_to = _date(query['to'], 'to') if query.get('to') else None
+        after = None
+        if query.get('after'):
+            try:
+                after = tuple(int(part) for part in query['after'].split(':', 2))
+            except ValueError:
+                after = ()
+            if len(after) == 2:
+                after = (after[0], CATALOG, after[1])
+            if len(after) != 3:
+                raise HTTPError(400, "after must be the next value of the previous page")
+        limit = max(1, min(int(query.get('limit', PAGE_LIMIT)), MAX_PAGE))
+        descending = query.get('descending') in ('1', 'true')
+        include_history = query.get('history') in ('1', 'true')
+        fetch = self.router.page_for_patient if user[3] == 'patient' else self.router.page_for_doctor
+        rows = await self.read(fetch, user[0], after, limit, descending, date_from, date_to, include_history)
+        next_after = None
+        if len(rows) == limit:
+            next_after = '%d:%d:%d' % ShardRouter.page_key(rows[-1])
+        return 200, {
+            'appointments': [
+                {'id': row[0], 'clinic': row[5], 'with': row[1], 'date': row[2], 'time': row[3]} for row in rows
+            ],
+            'next': next_after,
+        }
+
+    async def book(self, user, query, data, headers):
+        if user[3] != 'patient':
+            raise HTTPError(403, "only patients book appointments")
+        doctor_id, date, time_text = data.get('doctor_id'), data.get('date'), data.get('time')
+        if not isinstance(doctor_id, int) or not date or not time_text:
+            raise HTTPError(400, "doctor_id, date and time are required")
+        _date(date, 'date')
+        try:
+            start_minute = encode(date, time_text)
+        except (TypeError, ValueError):
+            raise HTTPError(400, "time must be HH:MM AM/PM") from None
+        if await self.read(self.directory.get, doctor_id) is None:
+            raise HTTPError(404, "no such doctor")
+
+        def prepare():
+            clinic = self.clinic_for(doctor_id)
+            return clinic, self.router.to_enlist(user[0], clinic)
+
+        clinic, enlisting = await self.read(prepare)
+        if enlisting is not None:
+            # A first booking at this clinic; the writes go to the writers of
+            # the shard and of the catalog, like any others
+            await self.write(self.router.copy_user, clinic, enlisting, clinic=clinic)
+            await self.write(self.router.note_enlisted, user[0], clinic)
+        appointments = self.router.appointments(clinic)
+        repeat = data.get('repeat')
+        if not repeat:
+            try:
+                appointment_id = await self.write(appointments.book, user[0], doctor_id, start_minute, clinic=clinic)
+            except SlotTakenError:
+                raise HTTPError(409, "the doctor is already booked at that time") from None
+            return 201, {'id': appointment_id, 'clinic': clinic, 'date': date, 'time': time_text}
+
+        frequency, count, until = repeat.get('frequency'), repeat.get('count'), repeat.get('until')
+        if frequency not in RECURRENCES:
+            raise HTTPError(400, f"frequency must be one of {', '.join(RECURRENCES)}")
+        if until:
+            _date(until, 'until')
+        if count is None and not until:
+            raise HTTPError(400, "a series needs a count or an until date")
+        if count is not None and (not isinstance(count, int) or not 2 <= count <= MAX_OCCURRENCES):
+            raise HTTPError(400, f"a series can have between 2 and {MAX_OCCURRENCES} appointments")
+        occurrences = list(recurrence(start_minute, frequency, count, until))
+        try:
+            booked = await self.write(
+                appointments.book_series, user[0], doctor_id, occurrences, bool(data.get('skip_conflicts')),
+                clinic=clinic,
+            )
+        except SeriesConflictError as error:
+            raise HTTPError(409, "the doctor is already booked on some of the dates",
+                            conflicts=[{'date': d, 'time': t} for d, t in error.conflicts]) from None
+        return 201, {'clinic': clinic, 'booked': [{'date': d, 'time': t} for d, t in booked]}
+
+    async def cancel(self, user, appointment_id, query, data, headers):
+        if user[3] != 'patient':
+            raise HTTPError(403, "doctors cancel whole days, see /cancel-days")
+        reason = (data.get('reason') or '').strip()
+        if not reason:
+            raise HTTPError(400, "a reason is required")
+        clinic = data.get('clinic', CATALOG)
+        if not isinstance(clinic, int):
+            raise HTTPError(400, "clinic must be the clinic id the appointment was listed with")
+        try:
+            await self.read(self.router.pool, clinic)
+        except KeyError:
+            raise HTTPError(404, "no such clinic") from None
+        details = await self.write(self.router.appointments(clinic).cancel, int(appointment_id), reason, user[0],
+                                   clinic=clinic)
+        if details is None:
+            raise HTTPError(404, "no such appointment")
+        date, time_text, doctor_name, doctor_id, _ = details
+        return 200, {'date': date, 'time': time_text, 'doctor': doctor_name, 'doctor_id': doctor_id}
+
+    async def cancel_days(self, user, query, data, headers):
+        if user[3] != 'doctor':
+            raise HTTPError(403, "only doctors cancel whole days")
+        date_from, date_to = _date(data.get('from'), 'from'), _date(data.get('to'), 'to')
+        if date_to < date_from:
+            raise HTTPError(400, "to must not be before from")
+        reason = (data.get('reason') or '').strip()
+        if not reason:
+            raise HTTPError(400, "a reason is required")
+        clinic = await self.read(self.clinic_for, user[0])
+        count = await self.write(self.router.appointments(clinic).cancel_range, user[0], date_from, date_to, reason,
+                                 clinic=clinic)
+        return 200, {'cancelled': count}
+
+    async def list_notifications(self, user, query, data, headers):
+        # Newest first without "after"; with it, only newer ones, oldest
+        # first within each clinic. "cursor" covers everything returned, for
+        # the next "after"; "last_seen" is the read cursor.
+        after = _cursor(query['after']) if query.get('after') else None
+
+        def fetch():
+            if after is not None:
+                cursor = dict(after)
+                rows = self.router.since(user[0], after)
+            else:
+                cursor = self.router.newest(user[0])
+                rows = self.router.recent(user[0], NOTIFICATION_LIMIT)
+            return rows, cursor, self.router.unread_count(user[0]), self.router.last_seen(user[0])
+
+        rows, cursor, unread, last_seen = await self.read(fetch)
+        for clinic, notification_id, *_ in rows:
+            cursor[clinic] = max(cursor.get(clinic, 0), notification_id)
+        return 200, {
+            'notifications': [
+                {'id': row[1], 'clinic': row[0], 'message': row[2], 'date': row[3], 'time': row[4]} for row in rows
+            ],
+            'cursor': _cursor_text(cursor),
+            'unread': unread,
+            'last_seen': _cursor_text(last_seen),
+        }
+
+    async def mark_seen(self, user, query, data, headers):
+        # Everything up to the cursor (or, for clinic 0, last_id) becomes read
+        if isinstance(data.get('last_id'), int):
+            cursor = {CATALOG: data['last_id']}
+        elif isinstance(data.get('cursor'), str):
+            cursor = _cursor(data['cursor'])
+        else:
+            raise HTTPError(400, "last_id or cursor is required")
+        for clinic, last_id in cursor.items():
+            try:
+                await self.read(self.router.pool, clinic)
+            except KeyError:
+                raise HTTPError(404, "no such clinic") from None
+            await self.write(self.router.notifications(clinic).mark_seen, user[0], last_id, clinic=clinic)
+        return 200, {}
+
+    # HTTP/1.1 with keep-alive, just enough of it for JSON clients
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                keep_alive = await self._respond(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except ValueError:
+            # readline() on a line longer than the stream's limit
+            self._send(writer, 400, {'error': "request or header line too long"}, False)
+        finally:
+            writer.close()
+
+    async def _respond(self, request_line, reader, writer):
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            self._send(writer, 400, {'error': "malformed request line"}, False)
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_BODY:
+            self._send(writer, 413 if length > 0 else 400, {'error': "bad or oversized body"}, False)
+            return False
+        body = await reader.readexactly(length) if length else b''
+        try:
+            status, payload = await self.dispatch(method, target, headers, body)
+        except HTTPError as error:
+            status, payload = error.status, error.payload
+        except sqlite3.OperationalError:
+            log.warning("%s %s failed", method, target, exc_info=True)
+            status, payload = 503, {'error': "database busy, try again"}
+        except ValueError as error:
+            status, payload = 400, {'error': str(error)}
+        except Exception:
+            log.exception("%s %s failed", method, target)
+            status, payload = 500, {'error': "internal error"}
+        self._send(writer, status, payload, keep_alive)
+        return keep_alive
+
+    @staticmethod
+    def _send(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = [
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+        ]
+        if not keep_alive:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+
+
+async def serve(pool, host=HOST, port=PORT, readers=READERS, max_batch=MAX_BATCH, ready=None):
+    # Runs until cancelled. `ready`, if given, is called with the bound port
+    # (useful with port 0).
+    service = Service(pool, readers, max_batch)
+    service.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    port = server.sockets[0].getsockname()[1]
+    if ready is not None:
+        ready(port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m server", description="Doctor Appointment System HTTP service")
+    parser.add_argument('--db', default=DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument('--host', default=HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=PORT, help="0 picks a free port (default: %(default)s)")
+    parser.add_argument('--readers', type=int, default=READERS, help="read threads (default: %(default)s)")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help="most writes per commit (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    # One connection per reader, one for the writer (shard pools are sized
+    # by Service)
+    pool = ConnectionPool(args.db, size=args.readers + 1)
+    instrumentation.configure_logging()
+    try:
+        asyncio.run(serve(pool, args.host, args.port, args.readers, args.max_batch,
+                          ready=lambda port: print(f"Serving on http://{args.host}:{port}", flush=True)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
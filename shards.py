@@ -0,0 +1,485 @@
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from availability import Availability
+from repository import AppointmentRepo, ConnectionPool, NotificationRepo, StatsRepo, WaitlistRepo
+
+# Multi-clinic sharding. The main database is the catalog: users, sessions
+# and the doctor directory stay there, and `clinics` lists one SQLite file
+# per clinic, a shard with the same schema that holds its doctors'
+# appointments, notifications, cancellations, statistics and waitlists.
+# doctors.clinic_id routes a doctor to their shard; patient_clinics lists
+# the shards a patient has booked in. Each shard has its own write lock, so
+# clinics never wait on each other's bookings.
+#
+# Clinic 0 is the catalog itself, holding whatever has not been moved to a
+# clinic. With no clinics at all everything routes there, exactly as before
+# sharding, so code written against the router works on a single file too.
+#
+# Shards join their rows to `users` and `doctors` like the catalog does, so
+# each keeps copies of the rows its data refers to. User ids are handed out
+# by the catalog only, so they agree everywhere; appointment and
+# notification ids are per shard, and travel with their clinic id.
+
+CATALOG = 0
+FAN_OUT_WORKERS = 8
+MAX_ID = 2 ** 63 - 1
+# Stands in for the password on users copied into a shard: only the catalog
+# signs people in, and no password hashes to this
+MIRROR_PASSWORD = '!'
+
+
+def _shard_after(after, clinic_id):
+    # A keyset cursor (start_minute, clinic, id) as the (start_minute, id)
+    # cursor to resume one shard's page from. Rows of a clinic ordered after
+    # the cursor's clinic may share its minute; rows of one ordered before
+    # may not.
+    if after is None:
+        return None
+    minute, after_clinic, after_id = after
+    if clinic_id == after_clinic:
+        return minute, after_id
+    return minute, 0 if clinic_id > after_clinic else MAX_ID
+
+
+class ShardRouter:
+    def __init__(self, catalog, size=4, workers=FAN_OUT_WORKERS):
+        # size: connections per shard pool
+        self.catalog = catalog
+        self.size = size
+        self._pools = {CATALOG: catalog}
+        self._repos = {}
+        self._doctor_clinics = {}
+        self._enlisted = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard')
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for clinic_id, pool in list(self._pools.items()):
+            if clinic_id != CATALOG:
+                pool.close()
+
+    # Catalog
+
+    def clinics(self):
+        # [(id, name, path, doctors)]
+        return self.catalog.connection().execute('''
+            SELECT c.id, c.name, c.path, count(d.id)
+            FROM clinics c LEFT JOIN doctors d ON d.clinic_id = c.id
+            GROUP BY c.id ORDER BY c.id
+        ''').fetchall()
+
+    def _path(self, path):
+        return os.path.join(os.path.dirname(os.path.abspath(self.catalog.path)), path)
+
+    def add_clinic(self, name, path):
+        # Registers a clinic and creates its shard. A relative path is taken
+        # from the catalog's directory. Returns the clinic id.
+        with self.catalog.transaction() as conn:
+            try:
+                clinic_id = conn.execute("INSERT INTO clinics (name, path) VALUES (?, ?)", (name, path)).lastrowid
+            except sqlite3.IntegrityError:
+                raise ValueError(f"a clinic named {name!r} or stored in {path!r} already exists") from None
+            # Opening the shard creates and migrates it; if that fails, the
+            # clinic isn't registered either
+            pool = ConnectionPool(self._path(path), size=self.size)
+            try:
+                pool.connection()
+            except sqlite3.OperationalError as error:
+                pool.close()
+                raise OSError(f"can't create {path}: {error}") from None
+        self._pools[clinic_id] = pool
+        return clinic_id
+
+    def pool(self, clinic_id):
+        # The ConnectionPool for a clinic's shard, opened on first use
+        pool = self._pools.get(clinic_id)
+        if pool is None:
+            row = self.catalog.connection().execute("SELECT path FROM clinics WHERE id = ?", (clinic_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"no clinic {clinic_id}")
+            with self._lock:
+                pool = self._pools.setdefault(clinic_id, ConnectionPool(self._path(row[0]), size=self.size))
+        return pool
+
+    def _repo(self, kind, clinic_id):
+        repo = self._repos.get((kind, clinic_id))
+        if repo is None:
+            repo = self._repos[kind, clinic_id] = kind(self.pool(clinic_id))
+        return repo
+
+    def appointments(self, clinic_id):
+        return self._repo(AppointmentRepo, clinic_id)
+
+    def notifications(self, clinic_id):
+        return self._repo(NotificationRepo, clinic_id)
+
+    def availability(self, clinic_id):
+        return self._repo(Availability, clinic_id)
+
+    def stats(self, clinic_id):
+        return self._repo(StatsRepo, clinic_id)
+
+    def waitlist(self, clinic_id):
+        return self._repo(WaitlistRepo, clinic_id)
+
+    def clinic_ids(self):
+        return [CATALOG] + [row[0] for row in self.catalog.connection().execute("SELECT id FROM clinics ORDER BY id")]
+
+    def clinic_of(self, doctor_id):
+        # Doctors never seen by the catalog route to it, as they always did
+        clinic_id = self._doctor_clinics.get(doctor_id)
+        if clinic_id is None:
+            row = self.catalog.connection().execute(
+                "SELECT coalesce(clinic_id, 0) FROM doctors WHERE id = ?", (doctor_id,)
+            ).fetchone()
+            clinic_id = self._doctor_clinics[doctor_id] = row[0] if row else CATALOG
+        return clinic_id
+
+    def clinics_of(self, user_id):
+        # Every clinic that may hold a user's appointments or notifications:
+        # the catalog, the shards they booked in, and their own as a doctor
+        return [CATALOG] + [row[0] for row in self.catalog.connection().execute('''
+            SELECT clinic_id FROM patient_clinics WHERE patient_id = ?
+            UNION
+            SELECT clinic_id FROM doctors WHERE id = ? AND clinic_id IS NOT NULL
+        ''', (user_id, user_id))]
+
+    def enlist(self, patient_id, clinic_id):
+        # Before a patient's first booking at a clinic: copy their user row
+        # to its shard and note in the catalog that they have data there.
+        # Both writes are idempotent.
+        user = self.to_enlist(patient_id, clinic_id)
+        if user is not None:
+            self.copy_user(clinic_id, user)
+            self.note_enlisted(patient_id, clinic_id)
+
+    def to_enlist(self, patient_id, clinic_id):
+        # enlist() in parts, for callers that send writes elsewhere (see
+        # server.Service.book). This one only reads: the user row to pass to
+        # copy_user(), or None when the patient is enlisted already.
+        if clinic_id == CATALOG or (patient_id, clinic_id) in self._enlisted:
+            return None
+        catalog = self.catalog.connection()
+        enlisted = catalog.execute(
+            "SELECT 1 FROM patient_clinics WHERE patient_id = ? AND clinic_id = ?", (patient_id, clinic_id)
+        ).fetchone()
+        if enlisted is not None:
+            self._enlisted.add((patient_id, clinic_id))
+            return None
+        return catalog.execute("SELECT id, username, role, email FROM users WHERE id = ?", (patient_id,)).fetchone()
+
+    def copy_user(self, clinic_id, user):
+        # Writes to the clinic's shard
+        with self.pool(clinic_id).transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO users (id, username, password, role, email) VALUES (?, ?, ?, ?, ?)",
+                (user[0], user[1], MIRROR_PASSWORD, user[2], user[3]),
+            )
+
+    def note_enlisted(self, patient_id, clinic_id):
+        # Writes to the catalog; after copy_user(), as it marks the patient
+        # done. Not remembered until to_enlist() reads it back: inside a
+        # group commit it could yet be rolled back.
+        with self.catalog.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO patient_clinics (patient_id, clinic_id) VALUES (?, ?)",
+                         (patient_id, clinic_id))
+
+    def fan_out(self, clinic_ids, fn):
+        # fn(clinic_id) for every clinic, the shards in parallel; results in
+        # the order given. The catalog's share runs on the calling thread,
+        # which normally holds a catalog connection already.
+        for clinic_id in clinic_ids:
+            self.pool(clinic_id)
+        futures = {
+            clinic_id: self._executor.submit(self._on_shard, clinic_id, fn)
+            for clinic_id in clinic_ids if clinic_id != CATALOG
+        }
+        return [fn(clinic_id) if clinic_id == CATALOG else futures[clinic_id].result() for clinic_id in clinic_ids]
+
+    def _on_shard(self, clinic_id, fn):
+        # Fan-out threads serve every shard, so they give each connection
+        # back rather than keep one per shard
+        try:
+            return fn(clinic_id)
+        finally:
+            self._pools[clinic_id].release()
+
+    # Appointments. Rows are AppointmentRepo's with the clinic id appended,
+    # and cancelling takes the clinic id along with the appointment id.
+
+    def book(self, patient_id, doctor_id, start_minute):
+        # Returns (clinic id, appointment id)
+        clinic_id = self.clinic_of(doctor_id)
+        self.enlist(patient_id, clinic_id)
+        return clinic_id, self.appointments(clinic_id).book(patient_id, doctor_id, start_minute)
+
+    def book_series(self, patient_id, doctor_id, start_minutes, skip_conflicts=False):
+        clinic_id = self.clinic_of(doctor_id)
+        self.enlist(patient_id, clinic_id)
+        return self.appointments(clinic_id).book_series(patient_id, doctor_id, start_minutes, skip_conflicts)
+
+    def cancel(self, clinic_id, appointment_id, reason, patient_id=None):
+        return self.appointments(clinic_id).cancel(appointment_id, reason, patient_id)
+
+    def cancel_range(self, doctor_id, date_from, date_to, reason):
+        return self.appointments(self.clinic_of(doctor_id)).cancel_range(doctor_id, date_from, date_to, reason)
+
+    def doctor_schedule(self, doctor_id, first_day, days):
+        return self.appointments(self.clinic_of(doctor_id)).doctor_schedule(doctor_id, first_day, days)
+
+    def join_waitlist(self, patient_id, doctor_id, date_from, date_to):
+        clinic_id = self.clinic_of(doctor_id)
+        self.enlist(patient_id, clinic_id)
+        return self.waitlist(clinic_id).join(patient_id, doctor_id, date_from, date_to)
+
+    def page_for_doctor(self, doctor_id, after=None, limit=100, descending=False, date_from=None, date_to=None,
+                        include_history=False):
+        clinic_id = self.clinic_of(doctor_id)
+        rows = self.appointments(clinic_id).page_for_doctor(
+            doctor_id, _shard_after(after, clinic_id), limit, descending, date_from, date_to, include_history,
+        )
+        return [row + (clinic_id,) for row in rows]
+
+    def page_for_patient(self, patient_id, after=None, limit=100, descending=False, date_from=None, date_to=None,
+                         include_history=False):
+        # A patient's appointments at every clinic as one keyset-paged list:
+        # each shard is asked for a page in parallel and the pages are
+        # merged, so a page costs one index seek per shard the patient uses.
+        def page(clinic_id):
+            rows = self.appointments(clinic_id).page_for_patient(
+                patient_id, _shard_after(after, clinic_id), limit, descending, date_from, date_to, include_history,
+            )
+            return [row + (clinic_id,) for row in rows]
+
+        pages = self.fan_out(self.clinics_of(patient_id), page)
+        return list(itertools.islice(heapq.merge(*pages, key=self.page_key, reverse=descending), limit))
+
+    @staticmethod
+    def page_key(row):
+        # Orders rows from all shards: (start_minute, clinic, id)
+        return (row[4], row[5], row[0])
+
+    # Notifications. Each shard has its own ids and read cursors, so a
+    # user's cursor here is a {clinic id: last seen id} dict.
+
+    def recent(self, user_id, limit=50):
+        # Newest first across clinics: (clinic id, id, message, date, time).
+        # Each shard's rows come in merge-key order; moved rows have new ids,
+        # so id order alone won't do. NULL times (older rows) sort last.
+        def newest(clinic_id):
+            rows = self.pool(clinic_id).connection().execute('''
+                SELECT coalesce(created_at, 0), id, message, date, time FROM notifications
+                WHERE recipient_id = ? ORDER BY created_at DESC, id DESC LIMIT ?
+            ''', (user_id, limit)).fetchall()
+            return [(row[0], clinic_id) + row[1:] for row in rows]
+
+        merged = heapq.merge(*self.fan_out(self.clinics_of(user_id), newest), key=lambda row: row[0], reverse=True)
+        return [row[1:] for row in itertools.islice(merged, limit)]
+
+    def since(self, user_id, cursor, limit=100):
+        # Anything newer than `cursor`, oldest first within each clinic
+        def newer(clinic_id):
+            rows = self.notifications(clinic_id).since(user_id, cursor.get(clinic_id, 0), limit)
+            return [(clinic_id,) + row for row in rows]
+
+        return [row for rows in self.fan_out(self.clinics_of(user_id), newer) for row in rows]
+
+    def newest(self, user_id):
+        # {clinic id: newest notification id}, the cursor that makes since()
+        # return only what arrives from now on
+        def newest_id(clinic_id):
+            return self.pool(clinic_id).connection().execute(
+                "SELECT coalesce(max(id), 0) FROM notifications WHERE recipient_id = ?", (user_id,)
+            ).fetchone()[0]
+
+        clinic_ids = self.clinics_of(user_id)
+        return dict(zip(clinic_ids, self.fan_out(clinic_ids, newest_id)))
+
+    def last_seen(self, user_id):
+        clinic_ids = self.clinics_of(user_id)
+        return dict(zip(clinic_ids, self.fan_out(clinic_ids, lambda clinic_id: self.notifications(clinic_id).last_seen(user_id))))
+
+    def unread_count(self, user_id):
+        return sum(self.fan_out(self.clinics_of(user_id), lambda clinic_id: self.notifications(clinic_id).unread_count(user_id)))
+
+    def mark_seen(self, user_id, cursor):
+        for clinic_id, last_id in cursor.items():
+            self.notifications(clinic_id).mark_seen(user_id, last_id)
+
+    # Reports
+
+    def by_speciality(self, date_from, date_to):
+        # StatsRepo.by_speciality over every clinic: the catalog lists every
+        # doctor, so its doctor counts and capacity stand, and each shard's
+        # counts are added in
+        pages = self.fan_out(self.clinic_ids(), lambda clinic_id: self.stats(clinic_id).by_speciality(date_from, date_to))
+        rows = {row[0]: list(row) for row in pages[0]}
+        for page in pages[1:]:
+            for speciality, _, booked, patient_cancelled, doctor_cancelled, _ in page:
+                row = rows[speciality]
+                row[2] += booked
+                row[3] += patient_cancelled
+                row[4] += doctor_cancelled
+        return [tuple(row) for row in rows.values()]
+
+    # Moving doctors between clinics
+
+    def assign(self, doctor_id, clinic_id):
+        # Move a doctor, with their appointments, notifications,
+        # cancellations, statistics and waitlist, to another clinic (0: the
+        # catalog). The copy commits before routing switches and the
+        # originals are deleted last, so a failure part way loses nothing.
+        # Run it with the app and service stopped: bookings made while it
+        # runs could be left behind. Archived history does not move. Returns
+        # how many appointments moved.
+        source_id = self.clinic_of(doctor_id)
+        if source_id == clinic_id:
+            return 0
+        source, target = self.pool(source_id), self.pool(clinic_id)
+        moved = _copy_doctor(target, source.path, doctor_id, mirror=source_id == CATALOG)
+        patients = target.connection().execute(_PATIENTS.format(schema='main'), (doctor_id,) * 3).fetchall()
+        with self.catalog.transaction() as conn:
+            conn.execute("UPDATE doctors SET clinic_id = ? WHERE id = ?", (clinic_id or None, doctor_id))
+            if clinic_id != CATALOG:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO patient_clinics (patient_id, clinic_id) VALUES (?, ?)",
+                    [(patient_id, clinic_id) for (patient_id,) in patients],
+                )
+        self._doctor_clinics[doctor_id] = clinic_id
+        with source.transaction(immediate=True) as conn:
+            for table in ('appointments', 'notifications', 'cancellations', 'waitlist', 'daily_stats'):
+                conn.execute(f"DELETE FROM main.{table} WHERE doctor_id = ?", (doctor_id,))
+            if source_id != CATALOG:
+                conn.execute("DELETE FROM main.doctors WHERE id = ?", (doctor_id,))
+        return moved
+
+
+# Everyone with a row about a doctor; takes the doctor id three times
+_PATIENTS = '''
+    SELECT patient_id FROM {schema}.appointments WHERE doctor_id = ?
+    UNION SELECT patient_id FROM {schema}.waitlist WHERE doctor_id = ?
+    UNION SELECT recipient_id FROM {schema}.notifications WHERE doctor_id = ? AND recipient_id IS NOT NULL
+'''
+
+
+def _copy_doctor(target, source_path, doctor_id, mirror):
+    # Copy one doctor's rows from the database at source_path into target,
+    # replacing any copies left by an earlier, interrupted move. Rows get new
+    # ids in the target, in their old order, and what refers to them
+    # (cancellations, read cursors) is moved over to the new ids. The target's statistics and
+    # outbox triggers are dropped for the copy and recreated before it
+    # commits, so nothing is counted twice or mailed again, and other
+    # connections never see them missing. mirror: the source is the catalog,
+    # whose password hashes stay there.
+    conn = target.connection()
+    conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+    try:
+        with target.transaction(immediate=True):
+            triggers = conn.execute('''
+                SELECT name, sql FROM main.sqlite_master
+                WHERE type = 'trigger' AND (name LIKE 'stats!_%' ESCAPE '!' OR name LIKE 'outbox!_%' ESCAPE '!')
+            ''').fetchall()
+            for name, _ in triggers:
+                conn.execute(f"DROP TRIGGER main.{name}")
+            for table in ('appointments', 'notifications', 'cancellations', 'waitlist', 'daily_stats'):
+                conn.execute(f"DELETE FROM main.{table} WHERE doctor_id = ?", (doctor_id,))
+
+            conn.execute(f'''
+                INSERT OR IGNORE INTO main.users (id, username, password, role, email)
+                SELECT id, username, {"'" + MIRROR_PASSWORD + "'" if mirror else 'password'}, role, email
+                FROM source.users
+                WHERE id = ? OR id IN ({_PATIENTS.format(schema='source')})
+            ''', (doctor_id,) * 4)
+            conn.execute('''
+                INSERT OR REPLACE INTO main.doctors (id, name, speciality, email)
+                SELECT id, name, speciality, email FROM source.doctors WHERE id = ?
+            ''', (doctor_id,))
+            conn.execute("CREATE TEMP TABLE moved_ids (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+            # Cancellations keep the id of the appointment they cancelled,
+            # gone from appointments; it is given a new id with the rest
+            _map_ids(conn, 'appointments', '''
+                SELECT id FROM source.appointments WHERE doctor_id = ?
+                UNION SELECT appointment_id FROM source.cancellations WHERE doctor_id = ? AND appointment_id IS NOT NULL
+            ''', (doctor_id, doctor_id))
+            moved = conn.execute('''
+                INSERT INTO main.appointments (id, patient_id, doctor_id, date, time, slot, start_minute)
+                SELECT m.new_id, a.patient_id, a.doctor_id, a.date, a.time, a.slot, a.start_minute
+                FROM source.appointments a JOIN temp.moved_ids m ON m.old_id = a.id
+                WHERE a.doctor_id = ? ORDER BY a.id
+            ''', (doctor_id,)).rowcount
+            conn.execute('''
+                INSERT INTO main.cancellations
+                    (appointment_id, doctor_id, patient_id, start_minute, cancelled_at, cancelled_by, reason)
+                SELECT m.new_id, c.doctor_id, c.patient_id, c.start_minute, c.cancelled_at, c.cancelled_by, c.reason
+                FROM source.cancellations c LEFT JOIN temp.moved_ids m ON m.old_id = c.appointment_id
+                WHERE c.doctor_id = ? ORDER BY c.id
+            ''', (doctor_id,))
+
+            _map_ids(conn, 'notifications', "SELECT id FROM source.notifications WHERE doctor_id = ?", (doctor_id,))
+            conn.execute('''
+                INSERT INTO main.notifications
+                    (id, doctor_id, message, date, time, start_minute, recipient_id, created_at)
+                SELECT m.new_id, n.doctor_id, n.message, n.date, n.time, n.start_minute, n.recipient_id, n.created_at
+                FROM source.notifications n JOIN temp.moved_ids m ON m.old_id = n.id
+                WHERE n.doctor_id = ? ORDER BY n.id
+            ''', (doctor_id,))
+            # What a recipient had read stays read: their cursor here moves
+            # up to the last of these they had seen, unless that would also
+            # mark read something of theirs already here that they haven't
+            for user_id, last_seen_id in conn.execute('''
+                SELECT c.user_id, max(m.new_id)
+                FROM source.notification_cursors c
+                JOIN source.notifications n ON n.recipient_id = c.user_id AND n.id <= c.last_seen_id
+                JOIN temp.moved_ids m ON m.old_id = n.id
+                WHERE n.doctor_id = ? GROUP BY c.user_id
+            ''', (doctor_id,)).fetchall():
+                conn.execute('''
+                    INSERT INTO main.notification_cursors (user_id, last_seen_id)
+                    SELECT ?, ? WHERE NOT EXISTS (
+                        SELECT 1 FROM main.notifications
+                        WHERE recipient_id = ? AND id <= ? AND id NOT IN (SELECT new_id FROM temp.moved_ids)
+                          AND id > coalesce((SELECT last_seen_id FROM main.notification_cursors WHERE user_id = ?), 0)
+                    )
+                    ON CONFLICT (user_id) DO UPDATE SET last_seen_id = max(last_seen_id, excluded.last_seen_id)
+                ''', (user_id, last_seen_id, user_id, last_seen_id, user_id))
+            conn.execute("DROP TABLE temp.moved_ids")
+            conn.execute('''
+                INSERT INTO main.waitlist (doctor_id, patient_id, priority, earliest_minute, latest_minute)
+                SELECT doctor_id, patient_id, priority, earliest_minute, latest_minute
+                FROM source.waitlist WHERE doctor_id = ? ORDER BY id
+            ''', (doctor_id,))
+            conn.execute('''
+                INSERT INTO main.daily_stats (doctor_id, day, booked, patient_cancelled, doctor_cancelled)
+                SELECT doctor_id, day, booked, patient_cancelled, doctor_cancelled
+                FROM source.daily_stats WHERE doctor_id = ?
+            ''', (doctor_id,))
+
+            for _, sql in triggers:
+                conn.execute(sql)
+    finally:
+        conn.execute("DETACH DATABASE source")
+    return moved
+
+
+def _map_ids(conn, table, old_ids, params):
+    # Fills temp.moved_ids with a new id in the target's `table` for each id
+    # the old_ids query selects, in the same order and above any id the
+    # table has handed out. Its sequence is moved past them all, so those no
+    # row takes are never handed out either.
+    base = conn.execute(f'''
+        SELECT max(coalesce((SELECT seq FROM main.sqlite_sequence WHERE name = ?), 0),
+                   coalesce((SELECT max(id) FROM main.{table}), 0))
+    ''', (table,)).fetchone()[0]
+    conn.execute("DELETE FROM temp.moved_ids")
+    count = conn.execute(f'''
+        INSERT INTO temp.moved_ids (old_id, new_id)
+        SELECT id, ? + row_number() OVER (ORDER BY id) FROM ({old_ids})
+    ''', (base,) + params).rowcount
+    conn.execute("DELETE FROM main.sqlite_sequence WHERE name = ?", (table,))
+    conn.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (table, base + count))
@@ -0,0 +1,84 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+
+
+class TaskRunner:
+    # Runs blocking work (SQL, password hashing) on a thread pool and hands the
+    # results back on the Tk mainloop. Tk widgets may only be touched from the
+    # thread that created them, so callbacks are queued by the workers and
+    # drained by an after() poll that only runs while work is outstanding.
+    def __init__(self, root, max_workers=4, poll_ms=25, on_busy=None):
+        self.root = root
+        self.poll_ms = poll_ms
+        self.on_busy = on_busy
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db-worker')
+        self._results = queue.SimpleQueue()
+        self._pending = {}
+        self._generation = 0
+        self._poll_id = None
+        self._busy = False
+
+    def submit(self, fn, *args, on_done=None, on_error=None, cancellable=True):
+        # Writes should pass cancellable=False: they always run, even if the
+        # user moves on, but their callbacks are still dropped once stale.
+        generation = self._generation
+        if instrumentation.ENABLED:
+            fn = instrumentation.timed(getattr(fn, '__qualname__', repr(fn)), kind='task')(fn)
+        future = self._executor.submit(fn, *args)
+        self._pending[future] = cancellable
+        future.add_done_callback(lambda f: self._results.put((f, generation, on_done, on_error)))
+        self._set_busy(True)
+        if self._poll_id is None:
+            self._poll_id = self.root.after(self.poll_ms, self._poll)
+        return future
+
+    def cancel_pending(self):
+        # Called when the screen changes. Queued reads are dropped and results
+        # that are still in flight are ignored when they arrive.
+        self._generation += 1
+        for future, cancellable in list(self._pending.items()):
+            if cancellable:
+                future.cancel()
+
+    def shutdown(self):
+        self.cancel_pending()
+        if self._poll_id is not None:
+            self.root.after_cancel(self._poll_id)
+            self._poll_id = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        self._poll_id = None
+        while True:
+            try:
+                future, generation, on_done, on_error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._pending.pop(future, None)
+            if future.cancelled() or generation != self._generation:
+                continue
+            try:
+                error = future.exception()
+                if error is None:
+                    if on_done is not None:
+                        on_done(future.result())
+                elif on_error is not None:
+                    on_error(error)
+                else:
+                    raise error
+            except Exception as exc:
+                # Keep polling; one failing callback must not strand the rest.
+                self.root.report_callback_exception(type(exc), exc, exc.__traceback__)
+
+        if self._pending:
+            self._poll_id = self.root.after(self.poll_ms, self._poll)
+        else:
+            self._set_busy(False)
+
+    def _set_busy(self, busy):
+        if busy != self._busy:
+            self._busy = busy
+            if self.on_busy is not None:
+                self.on_busy(busy)
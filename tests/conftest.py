@@ -0,0 +1,36 @@
+from datetime import date, timedelta
+
+import pytest
+
+from auth import hash_password
+from availability import encode
+from repository import ConnectionPool, UserRepo
+
+PASSWORD = hash_password('secret')
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'appointments.db'), size=4)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def people(pool):
+    # (doctor id, patient id, second patient id)
+    users = UserRepo(pool)
+    return (
+        users.register('doc', PASSWORD, 'doctor', 'Cardiology'),
+        users.register('pat', PASSWORD, 'patient'),
+        users.register('pat2', PASSWORD, 'patient'),
+    )
+
+
+@pytest.fixture
+def future():
+    # future(days, time): start_minute of `time` on the day `days` days from
+    # now; backfill and the waitlist only deal in slots still to come
+    def start_minute(days, time='09:00 AM'):
+        return encode((date.today() + timedelta(days=days)).isoformat(), time)
+    return start_minute
@@ -0,0 +1,36 @@
+import archive
+from repository import AppointmentRepo
+
+
+def all_pages(fetch, owner_id, limit, descending=False):
+    # (id, start_minute) of every row, read `limit` at a time with history
+    rows, after = [], None
+    while True:
+        page = fetch(owner_id, after=after, limit=limit, descending=descending, include_history=True)
+        rows.extend((row[0], row[4]) for row in page)
+        if len(page) < limit:
+            return rows
+        after = AppointmentRepo.page_key(page[-1])
+
+
+def test_archived_appointments_leave_the_live_table_but_stay_in_history(pool, people, future):
+    doctor_id, patient_id, _ = people
+    appointments = AppointmentRepo(pool)
+    # Booked out of order, so ids and times disagree on both sides of the cutoff
+    for days in (3, -400, 1, -398, 2, -402, -399):
+        appointments.book(patient_id, doctor_id, future(days))
+    ordered = pool.connection().execute(
+        "SELECT id, start_minute FROM appointments ORDER BY start_minute, id"
+    ).fetchall()
+
+    report = archive.archive(pool, archive.cutoff_minute(365), batch_size=2)
+    assert report.appointments == 4
+    assert pool.connection().execute(
+        "SELECT id, start_minute FROM main.appointments ORDER BY start_minute, id"
+    ).fetchall() == ordered[4:]
+    assert [(row[0], row[4]) for row in appointments.page_for_patient(patient_id)] == ordered[4:]
+
+    for fetch, owner_id in ((appointments.page_for_patient, patient_id), (appointments.page_for_doctor, doctor_id)):
+        for limit in (1, 3, 100):
+            assert all_pages(fetch, owner_id, limit) == ordered
+            assert all_pages(fetch, owner_id, limit, descending=True) == ordered[::-1]
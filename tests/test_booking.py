@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from availability import decode
+from repository import AppointmentRepo, ConnectionPool, SeriesConflictError, SlotTakenError
+
+BOOKERS = 8
+
+
+def test_concurrent_bookings_of_one_slot_make_one_appointment(pool, people, future):
+    # Every booker has a pool of its own, as separate app instances would
+    doctor_id, patient_id, _ = people
+    start_minute = future(30)
+    pools = [ConnectionPool(pool.path, size=1) for _ in range(BOOKERS)]
+    for other in pools:
+        # Open (and migrate) up front, then hand back for the thread
+        other.connection()
+        other.release()
+    barrier = threading.Barrier(BOOKERS)
+    outcomes = []
+
+    def book(other):
+        barrier.wait()
+        try:
+            outcomes.append(AppointmentRepo(other).book(patient_id, doctor_id, start_minute))
+        except SlotTakenError as error:
+            outcomes.append(error)
+
+    threads = [threading.Thread(target=book, args=(other,)) for other in pools]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for other in pools:
+        other.close()
+
+    booked = [outcome for outcome in outcomes if not isinstance(outcome, SlotTakenError)]
+    assert len(booked) == 1
+    assert len(outcomes) == BOOKERS
+    rows = pool.connection().execute("SELECT id FROM appointments WHERE doctor_id = ?", (doctor_id,)).fetchall()
+    assert rows == [(booked[0],)]
+
+
+def test_booking_a_taken_slot_raises(pool, people, future):
+    doctor_id, patient_id, other_patient_id = people
+    appointments = AppointmentRepo(pool)
+    appointments.book(patient_id, doctor_id, future(30))
+    with pytest.raises(SlotTakenError):
+        appointments.book(other_patient_id, doctor_id, future(30, '09:15 AM'))
+
+
+def test_a_series_with_one_clash_books_nothing(pool, people, future):
+    doctor_id, patient_id, other_patient_id = people
+    appointments = AppointmentRepo(pool)
+    series = [future(30 + 7 * week) for week in range(4)]
+    appointments.book(other_patient_id, doctor_id, series[2] + 10)  # inside the third occurrence's slot
+    with pytest.raises(SeriesConflictError) as raised:
+        appointments.book_series(patient_id, doctor_id, series)
+    assert raised.value.conflicts == [decode(series[2])]
+    assert pool.connection().execute(
+        "SELECT count(*) FROM appointments WHERE patient_id = ?", (patient_id,)
+    ).fetchone()[0] == 0
+
+    # Unless asked to book around it
+    booked = appointments.book_series(patient_id, doctor_id, series, skip_conflicts=True)
+    assert booked == [decode(minute) for minute in series[:2] + series[3:]]
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+
+import bulk
+from availability import encode
+from repository import ConnectionPool, StatsRepo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KILLED_LOAD = '''
+import os, sys
+import bulk
+from availability import encode
+from repository import ConnectionPool
+path, patient_id, doctor_id = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+conn = ConnectionPool(path, size=1).connection()
+with bulk.deferred_indexes(conn, ['appointments']), bulk.deferred_statistics(conn):
+    with conn:
+        bulk._insert_appointments(conn, [(patient_id, doctor_id, '2030-01-07', '09:00 AM',
+                                          encode('2030-01-07', '09:00 AM'), None)], bulk.ImportReport())
+    os._exit(3)
+'''
+
+
+def schema(pool):
+    return pool.connection().execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name"
+    ).fetchall()
+
+
+def test_imported_appointments_show_their_start_minute(pool, people):
+    doctor_id, patient_id, _ = people
+    records = [(2, {'patient_id': str(patient_id), 'doctor_id': str(doctor_id), 'date': '2030-1-7', 'time': '9:00 am'})]
+    report = bulk.import_appointments(pool.connection(), records)
+    assert report.loaded == 1 and not report.rejected
+    row = pool.connection().execute("SELECT date, time, start_minute FROM appointments").fetchone()
+    assert row == ('2030-01-07', '09:00 AM', encode('2030-01-07', '09:00 AM'))
+
+
+def test_a_load_that_dies_is_put_right_on_next_open(pool, people):
+    # A load killed between its batches never reaches the finally blocks
+    # that restore the indexes and statistics triggers
+    doctor_id, patient_id, _ = people
+    before = schema(pool)
+    pool.close()
+    killed = subprocess.run([sys.executable, '-c', KILLED_LOAD, pool.path, str(patient_id), str(doctor_id)],
+                            cwd=ROOT)
+    assert killed.returncode == 3
+
+    reopened = ConnectionPool(pool.path, size=1)
+    try:
+        assert schema(reopened) == before
+        assert reopened.connection().execute("SELECT count(*) FROM suspended_schema").fetchone()[0] == 0
+        assert StatsRepo(reopened).by_day(doctor_id, '2030-01-07', '2030-01-07')[0][1] == 1
+    finally:
+        reopened.close()
@@ -0,0 +1,88 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from auth import hash_password
+from repository import AppointmentRepo, NotificationRepo, UserRepo, WaitlistRepo
+
+
+def day(days):
+    return (date.today() + timedelta(days=days)).isoformat()
+
+
+def snapshot(pool):
+    # Everything a cancellation writes to
+    conn = pool.connection()
+    return {
+        table: conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2").fetchall()
+        for table in ('appointments', 'cancellations', 'notifications', 'waitlist', 'daily_stats', 'outbox')
+    }
+
+
+def fail_notifying(pool, recipient_id):
+    # Makes the notification to recipient_id, and so the whole statement
+    # that sends it, fail
+    with pool.transaction() as conn:
+        conn.execute(f'''
+            CREATE TRIGGER fail_notification BEFORE INSERT ON notifications
+            WHEN new.recipient_id = {recipient_id} BEGIN
+                SELECT RAISE(ABORT, 'notification failed');
+            END
+        ''')
+
+
+def test_cancel_writes_nothing_when_the_backfill_fails(pool, people, future):
+    # The freed slot goes to the waitlisted patient, and telling them, the
+    # last step of the cancellation, fails: the appointment, cancellation,
+    # the doctor's notification and the backfill must all be undone
+    doctor_id, patient_id, waiting_id = people
+    appointments = AppointmentRepo(pool)
+    appointment_id = appointments.book(patient_id, doctor_id, future(30))
+    WaitlistRepo(pool).join(waiting_id, doctor_id, day(29), day(31))
+    fail_notifying(pool, waiting_id)
+    before = snapshot(pool)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        appointments.cancel(appointment_id, "Travelling", patient_id)
+    assert snapshot(pool) == before
+
+    # And with nothing failing, all of it happens
+    with pool.transaction() as conn:
+        conn.execute("DROP TRIGGER fail_notification")
+    assert appointments.cancel(appointment_id, "Travelling", patient_id) is not None
+    after = snapshot(pool)
+    assert [row[1] for row in after['appointments']] == [waiting_id]
+    assert len(after['cancellations']) == 1
+    assert sorted(row[6] for row in after['notifications']) == sorted([doctor_id, waiting_id])
+    assert after['waitlist'] == []
+
+
+def test_cancel_range_writes_nothing_when_notifying_fails(pool, people, future):
+    doctor_id, patient_id, other_patient_id = people
+    appointments = AppointmentRepo(pool)
+    appointments.book(patient_id, doctor_id, future(30))
+    appointments.book(other_patient_id, doctor_id, future(31))
+    fail_notifying(pool, other_patient_id)
+    before = snapshot(pool)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        appointments.cancel_range(doctor_id, day(30), day(31), "Conference")
+    assert snapshot(pool) == before
+
+
+def test_a_cancelled_slot_goes_to_the_first_eligible_waiting_patient(pool, people, future):
+    doctor_id, patient_id, _ = people
+    users = UserRepo(pool)
+    too_late, first, second = (users.register(name, hash_password('secret'), 'patient') for name in ('late', 'first', 'second'))
+    appointments, waitlist = AppointmentRepo(pool), WaitlistRepo(pool)
+    appointment_id = appointments.book(patient_id, doctor_id, future(30))
+    waitlist.join(too_late, doctor_id, day(40), day(50))  # joined first, but the slot is outside their window
+    waitlist.join(first, doctor_id, day(29), day(31))
+    waitlist.join(second, doctor_id, day(30), day(30))
+
+    appointments.cancel(appointment_id, "Travelling", patient_id)
+    conn = pool.connection()
+    assert conn.execute("SELECT patient_id, start_minute FROM appointments").fetchall() == [(first, future(30))]
+    assert conn.execute("SELECT patient_id FROM waitlist ORDER BY id").fetchall() == [(too_late,), (second,)]
+    assert NotificationRepo(pool).recent(first)[0][1].startswith("A slot opened up")
@@ -0,0 +1,32 @@
+from auth import hash_password
+from availability import encode
+from repository import AppointmentRepo, ConnectionPool, DoctorDirectory, UserRepo
+
+
+def test_directory_reloads_only_when_doctors_change(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'directory.db'), size=2)
+    users = UserRepo(pool)
+    doctor_id = users.register('doc', hash_password('secret'), 'doctor', 'Cardiology')
+    patient_id = users.register('pat', hash_password('secret'), 'patient')
+    directory = DoctorDirectory(pool)
+    try:
+        assert directory.get(doctor_id) == (doctor_id, 'doc', 'Cardiology')
+        assert directory.loads == 1
+
+        # Commits to other tables leave the cache alone
+        AppointmentRepo(pool).book(patient_id, doctor_id, encode('2030-01-07', '09:00 AM'))
+        users.create_session(users.authenticate('pat', 'secret')[0])
+        assert directory.get(doctor_id) is not None
+        assert directory.loads == 1
+
+        # A doctor registering, from any connection, is picked up
+        other = ConnectionPool(pool.path, size=1)
+        second_id = UserRepo(other).register('doc2', hash_password('secret'), 'doctor', 'Dermatology')
+        other.close()
+        assert directory.get(second_id) == (second_id, 'doc2', 'Dermatology')
+        with pool.transaction() as conn:
+            conn.execute("UPDATE doctors SET speciality = 'Neurology' WHERE id = ?", (doctor_id,))
+        assert directory.get(doctor_id)[2] == 'Neurology'
+        assert directory.loads == 3
+    finally:
+        pool.close()
@@ -0,0 +1,163 @@
+import email
+import socketserver
+import threading
+import time
+
+import pytest
+
+import mailer
+from repository import OutboxRepo, UserRepo
+
+# The dispatcher against a local SMTP stand-in: just enough of the protocol
+# for smtplib, recording what it is sent and refusing the recipients it is
+# told to.
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost stand-in')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb in ('MAIL', 'RSET'):
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = command.partition(':')[2].strip().strip('<>')
+                code, text = self.server.refuse.get(address, (250, 'OK'))
+                if code == 250:
+                    recipients.append(address)
+                self.reply(f'{code} {text}')
+            elif verb == 'DATA':
+                self.reply('354 end with .')
+                lines = []
+                while (data := self.rfile.readline()) not in (b'.\r\n', b''):
+                    lines.append(data)
+                self.server.messages.append((recipients, email.message_from_bytes(b''.join(lines))))
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.messages = []
+        self.refuse = {}  # address -> (code, text)
+        self.connections = 0
+
+
+@pytest.fixture
+def smtp():
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher(pool, smtp):
+    dispatcher = mailer.OutboxDispatcher(pool, '127.0.0.1', smtp.server_address[1])
+    yield dispatcher
+    dispatcher.close()
+
+
+@pytest.fixture
+def outbox(pool):
+    # queue(address, message): a notification for a user with that address,
+    # which the outbox trigger turns into an outbox row
+    users = UserRepo(pool)
+
+    def queue(address, message):
+        user_id = users.register(address.partition('@')[0], 'x', 'patient', email=address)
+        with pool.transaction() as conn:
+            return conn.execute('''
+                INSERT INTO notifications (doctor_id, message, date, time, start_minute, recipient_id, created_at)
+                VALUES (0, ?, '2030-01-07', '09:00 AM', 0, ?, 0)
+            ''', (message, user_id)).lastrowid
+    return queue
+
+
+def rows(pool):
+    return pool.connection().execute('''
+        SELECT recipient, attempts, next_attempt_at, sent_at IS NOT NULL, failed_at IS NOT NULL, last_error
+        FROM outbox ORDER BY id
+    ''').fetchall()
+
+
+def test_sends_the_queue_over_one_connection(pool, smtp, dispatcher, outbox):
+    outbox('ann@example.com', "Appointment cancelled\nReason: Travelling")
+    outbox('bob@example.com', "A slot opened up")
+    assert dispatcher.drain() == 2
+    assert [(recipients, message['Subject']) for recipients, message in smtp.messages] == [
+        (['ann@example.com'], "Appointment cancelled"),
+        (['bob@example.com'], "A slot opened up"),
+    ]
+    assert smtp.messages[0][1]['Message-ID'] == mailer.message_id(1)
+    assert smtp.messages[0][1].get_payload().splitlines() == ["Appointment cancelled", "Reason: Travelling"]
+    assert smtp.connections == 1
+    assert [row[3] for row in rows(pool)] == [1, 1]
+    assert dispatcher.drain() == 0
+
+
+def test_a_temporary_refusal_is_retried_with_backoff(pool, smtp, dispatcher, outbox):
+    outbox('ann@example.com', "A slot opened up")
+    smtp.refuse['ann@example.com'] = (450, 'mailbox busy')
+    before = int(time.time())
+    dispatcher.drain()
+    (_, attempts, next_attempt_at, sent, failed, error), = rows(pool)
+    assert (attempts, sent, failed, error) == (1, 0, 0, '450 mailbox busy')
+    assert before + mailer.BACKOFF_SECONDS // 2 <= next_attempt_at <= int(time.time()) + mailer.BACKOFF_SECONDS
+    assert dispatcher.drain() == 0  # not due yet
+
+    del smtp.refuse['ann@example.com']
+    with pool.transaction() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = ?", (before,))  # the backoff has passed
+    assert dispatcher.drain() == 1
+    assert rows(pool)[0][1:5] == (2, before, 1, 0)
+    assert [recipients for recipients, _ in smtp.messages] == [['ann@example.com']]
+
+
+def test_a_permanent_refusal_gives_up(pool, smtp, dispatcher, outbox):
+    outbox('ann@example.com', "A slot opened up")
+    outbox('bob@example.com', "A slot opened up")
+    smtp.refuse['ann@example.com'] = (550, 'no such mailbox')
+    assert dispatcher.drain() == 2
+    assert [(row[0], row[3], row[4], row[5]) for row in rows(pool)] == [
+        ('ann@example.com', 0, 1, '550 no such mailbox'),
+        ('bob@example.com', 1, 0, None),
+    ]
+    with pool.transaction() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = 0")
+    assert dispatcher.drain() == 0
+    assert OutboxRepo(pool).counts() == {'pending': 0, 'sent': 1, 'failed': 1}
+
+
+def test_rows_leased_by_a_dispatcher_that_died_are_sent_once_the_lease_runs_out(pool, smtp, dispatcher, outbox):
+    outbox('ann@example.com', "A slot opened up")
+    assert len(OutboxRepo(pool).claim(10, mailer.LEASE_SECONDS)) == 1  # and then it died
+    assert dispatcher.drain() == 0
+    assert smtp.messages == []
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE outbox SET leased_until = ?", (int(time.time()) - 1,))  # the lease has run out
+    assert dispatcher.drain() == 1
+    assert [recipients for recipients, _ in smtp.messages] == [['ann@example.com']]
+    assert rows(pool)[0][3]
@@ -0,0 +1,32 @@
+import sqlite3
+
+from migrations import SCHEMA_VERSION, _create_tables, migrate
+
+
+def legacy_database(path, appointments):
+    # A database as the first builds of the app left it: user_version 0
+    conn = sqlite3.connect(path)
+    _create_tables(conn.cursor())
+    conn.execute("INSERT INTO users (id, username, password, role) VALUES (1, 'pat', 'x', 'patient')")
+    conn.execute("INSERT INTO users (id, username, password, role) VALUES (4, 'doc', 'x', 'doctor')")
+    conn.execute("INSERT INTO doctors (id, name, speciality) VALUES (4, 'doc', 'Cardiology')")
+    conn.executemany("INSERT INTO appointments (patient_id, doctor_id, date, time) VALUES (1, 4, ?, ?)", appointments)
+    conn.commit()
+    return conn
+
+
+def slots(conn):
+    return conn.execute("SELECT id, slot IS NOT NULL FROM appointments ORDER BY id").fetchall()
+
+
+def test_dates_written_differently_clash_on_start_minute(tmp_path):
+    conn = legacy_database(tmp_path / 'legacy.db', [('2025-1-5', '09:30 AM'), ('2025-01-05', '09:30 AM')])
+    assert migrate(conn) == SCHEMA_VERSION
+    assert slots(conn) == [(1, 1), (2, 0)]
+    assert conn.execute("SELECT count(*) FROM appointments").fetchone()[0] == 2
+
+
+def test_unparseable_dates_clash_at_minute_zero(tmp_path):
+    conn = legacy_database(tmp_path / 'legacy.db', [('soon', '09:30 AM'), ('later', '10:00 AM'), ('2025-01-05', '09:30 AM')])
+    assert migrate(conn) == SCHEMA_VERSION
+    assert slots(conn) == [(1, 1), (2, 0), (3, 1)]
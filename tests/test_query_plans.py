@@ -0,0 +1,78 @@
+import pytest
+
+from auth import hash_password
+from availability import encode
+from repository import AppointmentRepo, ConnectionPool, NotificationRepo, UserRepo
+
+# The hot lookups must be index searches. Each test records the SELECTs a
+# repository call issues (with their values bound in) and checks SQLite's
+# plan for them, so dropping or reshaping an index they rely on fails here.
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'plans.db'), size=1)
+    users = UserRepo(pool)
+    password = hash_password('secret')
+    doctor_id = users.register('doc', password, 'doctor', 'Cardiology')
+    patient_id = users.register('pat', password, 'patient')
+    appointments = AppointmentRepo(pool)
+    for day in range(1, 8):
+        appointments.book(patient_id, doctor_id, encode(f'2030-01-0{day}', '09:00 AM'))
+    appointments.cancel_range(doctor_id, '2030-01-01', '2030-01-02', "Away")
+    yield pool
+    pool.close()
+
+
+def plans(pool, call, *args):
+    # [(sql, [plan detail, ...])] for each SELECT that call(*args) runs
+    conn = pool.connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        call(*args)
+    finally:
+        conn.set_trace_callback(None)
+    return [
+        (sql, [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)])
+        for sql in statements if sql.lstrip().upper().startswith('SELECT')
+    ]
+
+
+def assert_uses(found, table, index, covering=False):
+    using = f"USING COVERING INDEX {index} " if covering else f"USING INDEX {index} "
+    assert found, "no queries ran"
+    for sql, details in found:
+        searches = [detail for detail in details if detail.startswith(f"SEARCH {table} ")]
+        if searches:
+            assert any(using in detail for detail in searches), (sql, details)
+            assert not any('TEMP B-TREE' in detail for detail in details), (sql, details)
+            return
+    pytest.fail(f"no query searched {table}: {found}")
+
+
+def user_id(pool, username):
+    return pool.connection().execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()[0]
+
+
+def test_login_searches_the_username_index(pool):
+    assert_uses(plans(pool, UserRepo(pool).authenticate, 'pat', 'secret'), 'users', 'sqlite_autoindex_users_1')
+
+
+def test_patient_list_uses_patient_index(pool):
+    found = plans(pool, AppointmentRepo(pool).page_for_patient, user_id(pool, 'pat'))
+    assert_uses(found, 'a', 'idx_appointments_patient')
+
+
+def test_doctor_list_uses_doctor_index(pool):
+    found = plans(pool, AppointmentRepo(pool).page_for_doctor, user_id(pool, 'doc'))
+    assert_uses(found, 'a', 'idx_appointments_doctor')
+
+
+def test_notification_queries_use_recipient_index(pool):
+    notifications = NotificationRepo(pool)
+    patient_id = user_id(pool, 'pat')
+    assert_uses(plans(pool, notifications.recent, patient_id, 50), 'notifications', 'idx_notifications_recipient')
+    assert_uses(plans(pool, notifications.since, patient_id, 0), 'notifications', 'idx_notifications_recipient')
+    assert_uses(plans(pool, notifications.unread_count, patient_id), 'notifications', 'idx_notifications_recipient',
+                covering=True)
@@ -0,0 +1,145 @@
+import asyncio
+import http.client
+import json
+import threading
+
+import pytest
+
+from auth import legacy_hash
+from repository import UserRepo
+from server import serve
+from shards import ShardRouter
+
+# The HTTP service end to end: started on a free local port, on an event
+# loop of its own, and called over real sockets.
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.token = None
+
+    def request(self, method, path, body=None):
+        # (status, decoded JSON body)
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        try:
+            conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def login(self, username, password='secret'):
+        status, payload = self.request('POST', '/login', {'username': username, 'password': password})
+        assert status == 200, payload
+        self.token = payload['token']
+        return payload['user']
+
+
+@pytest.fixture
+def service(pool, people):
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    started = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        started['task'] = loop.create_task(serve(pool, port=0, readers=2, ready=lambda port: (
+            started.update(port=port), ready.set())))
+        try:
+            loop.run_until_complete(started['task'])
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert ready.wait(10), "the service didn't start"
+    yield lambda: Client(started['port'])
+    loop.call_soon_threadsafe(started['task'].cancel)
+    thread.join(10)
+
+
+def book(client, doctor_id, date, time='09:00 AM'):
+    return client.request('POST', '/appointments', {'doctor_id': doctor_id, 'date': date, 'time': time})
+
+
+def test_login(service, people):
+    doctor_id, patient_id, _ = people
+    client = service()
+    assert client.login('pat') == {'id': patient_id, 'username': 'pat', 'role': 'patient'}
+    assert client.request('GET', '/doctors')[1]['doctors'] == [{'id': doctor_id, 'name': 'doc', 'speciality': 'Cardiology'}]
+
+    status, payload = service().request('POST', '/login', {'username': 'pat', 'password': 'wrong'})
+    assert status == 401
+    assert service().request('GET', '/appointments')[0] == 401
+
+
+def test_login_upgrades_a_legacy_hash(service, pool):
+    user_id = UserRepo(pool).register('old', legacy_hash('secret'), 'patient')
+    service().login('old')
+    stored = pool.connection().execute("SELECT password FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+    assert stored.startswith('scrypt$')
+
+
+def test_booking_and_clashes(service, people):
+    doctor_id, _, _ = people
+    first, second = service(), service()
+    first.login('pat')
+    second.login('pat2')
+
+    status, payload = book(first, doctor_id, '2030-01-07')
+    assert status == 201
+    assert payload == {'id': payload['id'], 'clinic': 0, 'date': '2030-01-07', 'time': '09:00 AM'}
+    status, payload = book(second, doctor_id, '2030-01-07', '09:10 AM')
+    assert status == 409
+    assert 'already booked' in payload['error']
+    assert book(second, doctor_id, '2030-01-07', '09:30 AM')[0] == 201
+    assert book(second, 999, '2030-01-07')[0] == 404
+    assert book(second, doctor_id, '2030-01-07', 'noon')[0] == 400
+
+
+def test_paging(service, people):
+    doctor_id, _, _ = people
+    client = service()
+    client.login('pat')
+    dates = [f'2030-01-{day:02d}' for day in range(7, 12)]
+    for date in reversed(dates):
+        assert book(client, doctor_id, date)[0] == 201
+
+    seen, after = [], None
+    while True:
+        path = '/appointments?limit=2' + (f'&after={after}' if after else '')
+        status, payload = client.request('GET', path)
+        assert status == 200
+        assert len(payload['appointments']) <= 2
+        seen.extend(row['date'] for row in payload['appointments'])
+        after = payload['next']
+        if after is None:
+            break
+    assert seen == dates
+
+    status, payload = client.request('GET', '/appointments?limit=2&descending=1')
+    assert [row['date'] for row in payload['appointments']] == dates[:-3:-1]
+
+
+def test_booking_at_a_clinic_shard(service, pool, people):
+    # A first booking at a clinic copies the patient there through the
+    # shard's and the catalog's writers
+    doctor_id, patient_id, _ = people
+    router = ShardRouter(pool, size=1, workers=1)
+    try:
+        router.assign(doctor_id, router.add_clinic('North', 'north.db'))
+    finally:
+        router.close()
+    client = service()
+    client.login('pat')
+    status, payload = book(client, doctor_id, '2030-01-07')
+    assert status == 201 and payload['clinic'] == 1
+    assert pool.connection().execute("SELECT * FROM patient_clinics").fetchall() == [(patient_id, 1)]
+    assert [row['clinic'] for row in client.request('GET', '/appointments')[1]['appointments']] == [1]
+    assert book(client, doctor_id, '2030-01-07')[0] == 409
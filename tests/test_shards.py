@@ -0,0 +1,103 @@
+import pytest
+
+import bulk
+from auth import hash_password
+from availability import encode
+from repository import SlotTakenError, UserRepo
+from shards import ShardRouter
+
+# Moving doctors between clinics, read back through the router as the app
+# and the service read them.
+
+
+@pytest.fixture
+def router(pool):
+    router = ShardRouter(pool, size=2, workers=2)
+    yield router
+    router.close()
+
+
+def day(n):
+    return f'2030-01-{n:02d}'
+
+
+def book(router, patient_id, doctor_id, n):
+    return router.book(patient_id, doctor_id, encode(day(n), '09:00 AM'))
+
+
+def dangling(router, clinic_id):
+    # Cancellations whose appointment id names an appointment still booked
+    return router.pool(clinic_id).connection().execute(
+        "SELECT count(*) FROM cancellations c JOIN appointments a ON a.id = c.appointment_id"
+    ).fetchone()[0]
+
+
+def test_a_moved_doctor_keeps_their_history_and_read_state(pool, people, router):
+    doctor_id, patient_id, patient2_id = people
+    other_id = UserRepo(pool).register('doc2', hash_password('secret'), 'doctor', 'Neurology')
+    _, first = book(router, patient_id, other_id, 1)
+    book(router, patient2_id, other_id, 5)
+    book(router, patient2_id, other_id, 6)
+    router.cancel(0, first, "Travelling", patient_id)
+    _, cancelled = book(router, patient_id, doctor_id, 2)
+    book(router, patient2_id, doctor_id, 4)
+    book(router, patient_id, doctor_id, 3)
+    router.cancel(0, cancelled, "Travelling", patient_id)
+    router.cancel_range(doctor_id, day(3), day(3), "Conference")
+    router.mark_seen(doctor_id, router.newest(doctor_id))
+    unread = {user_id: router.unread_count(user_id) for user_id in people + (other_id,)}
+    assert unread == {doctor_id: 0, patient_id: 1, patient2_id: 0, other_id: 1}
+
+    # The shard is busier than the main database by the second move, so the
+    # ids it brings along are already taken there
+    clinic_id = router.add_clinic('North', 'north.db')
+    router.assign(other_id, clinic_id)
+    for n in (8, 9, 10, 11):
+        book(router, patient2_id, other_id, n)
+    assert router.assign(doctor_id, clinic_id) == 1
+
+    assert {user_id: router.unread_count(user_id) for user_id in unread} == unread
+    assert dangling(router, clinic_id) == 0
+    shard = router.pool(clinic_id).connection()
+    assert shard.execute("SELECT count(DISTINCT appointment_id) FROM cancellations").fetchone()[0] == 3
+    assert pool.connection().execute("SELECT count(*) FROM appointments").fetchone()[0] == 0
+
+    assert [(row[2], row[5]) for row in router.page_for_patient(patient2_id)] == [
+        (day(n), clinic_id) for n in (4, 5, 6, 8, 9, 10, 11)
+    ]
+    assert [row[2] for row in router.page_for_doctor(doctor_id)] == [day(4)]
+    # New bookings never take an id a cancellation refers to
+    assert book(router, patient_id, doctor_id, 7)[0] == clinic_id
+    assert dangling(router, clinic_id) == 0
+
+    # Moving back to the main database puts the same links right there
+    router.assign(doctor_id, 0)
+    assert router.unread_count(doctor_id) == 0 and router.unread_count(patient_id) == 1
+    assert dangling(router, 0) == 0
+    assert [row[2] for row in router.page_for_doctor(doctor_id)] == [day(4), day(7)]
+
+
+def test_imports_load_into_the_doctors_clinic(pool, people, router):
+    doctor_id, patient_id, patient2_id = people
+    book(router, patient2_id, doctor_id, 4)
+    clinic_id = router.add_clinic('North', 'north.db')
+    router.assign(doctor_id, clinic_id)
+    other_id = UserRepo(pool).register('doc2', hash_password('secret'), 'doctor', 'Neurology')
+
+    records = enumerate([
+        {'patient_id': str(patient_id), 'doctor_id': str(doctor_id), 'date': day(7), 'time': '09:00 AM'},
+        {'patient_id': str(patient_id), 'doctor_id': str(doctor_id), 'date': day(4), 'time': '09:00 AM'},
+        {'patient_id': str(patient_id), 'doctor_id': str(other_id), 'date': day(7), 'time': '09:00 AM'},
+    ], start=2)
+    report = bulk.import_appointments(pool.connection(), records, router=router)
+    assert (report.loaded, report.clashes, report.rejected) == (3, 1, [])
+
+    assert [(row[2], row[5]) for row in router.page_for_patient(patient_id)] == [
+        (day(4), clinic_id), (day(7), 0), (day(7), clinic_id),
+    ]
+    assert pool.connection().execute(
+        "SELECT clinic_id FROM patient_clinics WHERE patient_id = ?", (patient_id,)
+    ).fetchall() == [(clinic_id,)]
+    assert router.stats(clinic_id).by_day(doctor_id, day(4), day(7))[-1][1] == 1
+    with pytest.raises(SlotTakenError):
+        book(router, patient2_id, doctor_id, 7)
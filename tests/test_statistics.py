@@ -0,0 +1,54 @@
+from datetime import date, timedelta
+
+import bulk
+from repository import AppointmentRepo, WaitlistRepo, rebuild_stats
+
+
+def day(days):
+    return (date.today() + timedelta(days=days)).isoformat()
+
+
+def counts(pool):
+    # daily_stats without rows that count nothing
+    return pool.connection().execute('''
+        SELECT * FROM daily_stats WHERE booked OR patient_cancelled OR doctor_cancelled ORDER BY doctor_id, day
+    ''').fetchall()
+
+
+def assert_recount_agrees(pool):
+    kept = counts(pool)
+    assert kept
+    with pool.transaction() as conn:
+        rebuild_stats(conn)
+    assert counts(pool) == kept
+
+
+def test_triggers_keep_the_counts_a_recount_gives(pool, people, future):
+    # Checked after each kind of change, as an import ends with a recount
+    # of its own that would hide drift from before it
+    doctor_id, patient_id, other_patient_id = people
+    appointments = AppointmentRepo(pool)
+
+    first = appointments.book(patient_id, doctor_id, future(30))
+    appointments.book(patient_id, doctor_id, future(30, '10:00 AM'))
+    appointments.book_series(other_patient_id, doctor_id, [future(31 + week * 7) for week in range(3)])
+    assert_recount_agrees(pool)
+
+    WaitlistRepo(pool).join(other_patient_id, doctor_id, day(30), day(30))
+    appointments.cancel(first, "Travelling", patient_id)  # and the waitlist backfills it
+    appointments.cancel_range(doctor_id, day(38), day(38), "Conference")
+    assert_recount_agrees(pool)
+
+    report = bulk.import_appointments(pool.connection(), [
+        (2, {'patient_id': patient_id, 'doctor_id': doctor_id, 'date': day(60), 'time': '09:00 AM'}),
+        (3, {'patient_id': patient_id, 'doctor_id': doctor_id, 'date': day(60), 'time': '09:00 AM'}),  # a clash
+        (4, {'patient_id': patient_id, 'doctor_id': doctor_id, 'date': day(61), 'time': '11:30 AM'}),
+    ])
+    assert report.loaded == 3 and report.clashes == 1
+    assert_recount_agrees(pool)
+
+    # The triggers are back after the import
+    second = appointments.book(patient_id, doctor_id, future(62))
+    appointments.cancel(second, "Feeling better", patient_id)
+    appointments.book(patient_id, doctor_id, future(63))
+    assert_recount_agrees(pool)
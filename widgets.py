@@ -0,0 +1,450 @@
+import tkinter as tk
+from tkinter import ttk
+
+from availability import time_of
+
+
+class PagedTreeview(ttk.Frame):
+    # A Treeview that streams rows in pages as the user scrolls instead of
+    # loading everything up front. At most `max_rows` rows are kept: scrolling
+    # down drops rows off the top and scrolling back up fetches them again, so
+    # memory and first paint stay flat however long the history is.
+    #
+    # fetch_page(after, limit, descending) runs on the TaskRunner's worker and
+    # must return rows in display order; key(row) gives the keyset cursor.
+    # Rows may carry trailing fields (e.g. sort keys) beyond the columns.
+    def __init__(self, parent, columns, tasks, key, page_size=100, max_rows=1000, sort_column=None):
+        super().__init__(parent)
+        self.tasks = tasks
+        self.key = key
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.fetch_page = None
+        self.descending = False
+
+        self.columns = columns
+        self.tree = ttk.Treeview(self, columns=columns, show="headings")
+        for column in columns:
+            self.tree.heading(column, text=column)
+        if sort_column is not None:
+            self.tree.heading(sort_column, command=self.toggle_sort)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.tree.pack(side="left", fill="both", expand=True)
+
+        self._keys = {}
+        self._generation = 0
+        self._reset_state()
+
+    def _reset_state(self):
+        self._loading = False
+        self._exhausted = False
+        self._trimmed_head = False
+
+    def reload(self, fetch_page=None):
+        if fetch_page is not None:
+            self.fetch_page = fetch_page
+        self._generation += 1
+        self.tree.delete(*self.tree.get_children())
+        self._keys.clear()
+        self._reset_state()
+        self.load_more()
+
+    def toggle_sort(self):
+        self.descending = not self.descending
+        self.reload()
+
+    # Treeview passthroughs used by the screens
+    def selection(self):
+        return self.tree.selection()
+
+    def item(self, iid, option=None):
+        return self.tree.item(iid, option)
+
+    def key_of(self, iid):
+        # The key() of the row shown as iid
+        return self._keys[iid]
+
+    def delete(self, *iids):
+        for iid in iids:
+            self._keys.pop(iid, None)
+        self.tree.delete(*iids)
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if float(last) >= 0.9:
+            self.load_more()
+        elif float(first) <= 0.1 and self._trimmed_head:
+            self.load_previous()
+
+    def load_more(self):
+        if self.fetch_page is None or self._loading or self._exhausted:
+            return
+        children = self.tree.get_children()
+        after = self._keys[children[-1]] if children else None
+        self._fetch(after, self.descending, self._append)
+
+    def load_previous(self):
+        if self._loading:
+            return
+        children = self.tree.get_children()
+        if not children:
+            return
+        self._fetch(self._keys[children[0]], not self.descending, self._prepend)
+
+    def _fetch(self, after, descending, on_page):
+        self._loading = True
+        generation = self._generation
+
+        # A reload() since this fetch started has moved on to another query;
+        # whatever this one brings back, rows or an error, no longer applies
+        def deliver(rows):
+            if generation == self._generation:
+                self._loading = False
+                on_page(rows)
+
+        def failed(error):
+            if generation == self._generation:
+                self._loading = False
+                self.report_callback_exception(type(error), error, error.__traceback__)
+
+        self.tasks.submit(self.fetch_page, after, self.page_size, descending, on_done=deliver, on_error=failed)
+
+    def _insert(self, index, row):
+        iid = self.tree.insert("", index, values=row[:len(self.columns)])
+        self._keys[iid] = self.key(row)
+
+    def _append(self, rows):
+        for row in rows:
+            self._insert(tk.END, row)
+        if len(rows) < self.page_size:
+            self._exhausted = True
+        children = self.tree.get_children()
+        excess = len(children) - self.max_rows
+        if excess > 0:
+            anchor = self.tree.identify_row(1)
+            self.delete(*children[:excess])
+            self._trimmed_head = True
+            self._keep_in_view(anchor)
+
+    def _prepend(self, rows):
+        # Rows arrive nearest-first, so each one goes above the previous.
+        anchor = self.tree.identify_row(1)
+        for row in rows:
+            self._insert(0, row)
+        if len(rows) < self.page_size:
+            self._trimmed_head = False
+        children = self.tree.get_children()
+        excess = len(children) - self.max_rows
+        if excess > 0:
+            self.delete(*children[-excess:])
+            self._exhausted = False
+        self._keep_in_view(anchor)
+
+    def _keep_in_view(self, iid):
+        # Adding or removing rows above the viewport would otherwise make the
+        # list jump; put the row that was at the top back at the top.
+        children = self.tree.get_children()
+        if iid and iid in self._keys and children:
+            self.tree.yview_moveto(self.tree.index(iid) / len(children))
+
+
+class DoctorPicker(ttk.Frame):
+    # Search-as-you-type doctor chooser: an entry with a short result list
+    # underneath. Keystrokes are debounced so that only the last one in a
+    # burst of typing reaches the database, and results for anything but the
+    # latest query are thrown away.
+    #
+    # search(text, limit) runs on the TaskRunner's worker and returns
+    # (id, name, speciality) rows.
+    def __init__(self, parent, tasks, search, limit=20, delay_ms=200, font=("Arial", 10)):
+        super().__init__(parent)
+        self.tasks = tasks
+        self.search = search
+        self.limit = limit
+        self.delay_ms = delay_ms
+        self.selected = None
+        self._results = []
+        self._after_id = None
+        self._query_id = 0
+
+        self.text_var = tk.StringVar()
+        self.entry = ttk.Entry(self, textvariable=self.text_var, font=font, width=40)
+        self.entry.pack(fill="x")
+        self.listbox = tk.Listbox(self, height=8, font=font, exportselection=False)
+        self.listbox.pack(fill="x")
+
+        self.entry.bind("<KeyRelease>", self.on_key)
+        self.entry.bind("<Down>", self.focus_results)
+        self.listbox.bind("<<ListboxSelect>>", self.on_pick)
+        self.listbox.bind("<Return>", self.on_pick)
+        self.query_now()
+
+    def on_key(self, event):
+        if event.keysym in ("Down", "Up", "Return", "Tab"):
+            return
+        self.selected = None
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+        self._after_id = self.after(self.delay_ms, self.query_now)
+
+    def query_now(self):
+        self._after_id = None
+        self._query_id += 1
+        query_id = self._query_id
+        self.tasks.submit(
+            self.search, self.text_var.get(), self.limit,
+            on_done=lambda rows: self.show_results(query_id, rows),
+        )
+
+    def show_results(self, query_id, rows):
+        if query_id != self._query_id:
+            return
+        self._results = rows
+        self.listbox.delete(0, tk.END)
+        for doctor in rows:
+            self.listbox.insert(tk.END, f"{doctor[1]} - {doctor[2]}")
+
+    def focus_results(self, event=None):
+        if self._results:
+            self.listbox.focus_set()
+            self.listbox.selection_set(0)
+
+    def on_pick(self, event=None):
+        picked = self.listbox.curselection()
+        if not picked:
+            return
+        self.selected = self._results[picked[0]]
+        self.text_var.set(f"{self.selected[1]} - {self.selected[2]}")
+
+    def clear(self):
+        self.selected = None
+        self.text_var.set("")
+        self.query_now()
+
+
+class NotificationFeed(ttk.Frame):
+    # Scrollable, newest-first list of notifications holding at most
+    # `max_items` rows; older ones fall off the bottom as new ones arrive.
+    # Rows are (clinic id, id, message, date, time), ids being per clinic
+    # (see shards.py); unread ones, above the clinic's last seen id in
+    # `last_seen` ({clinic id: id}), are shown in bold.
+    def __init__(self, parent, max_items=200, font=("Arial", 11)):
+        super().__init__(parent)
+        self.max_items = max_items
+        self.tree = ttk.Treeview(self, columns=("When", "Message"), show="headings")
+        self.tree.heading("When", text="When")
+        self.tree.heading("Message", text="Message")
+        self.tree.column("When", width=200, stretch=False)
+        self.tree.tag_configure("unread", font=(font[0], font[1], "bold"))
+        scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.empty_label = ttk.Label(self, text="No Notifications Found", font=font, foreground="#001F3F")
+
+    def add(self, rows, last_seen):
+        # rows are newest first
+        for clinic_id, notification_id, message, date, time in reversed(rows):
+            iid = f"{clinic_id}:{notification_id}"
+            if self.tree.exists(iid):
+                continue
+            tags = ("unread",) if notification_id > last_seen.get(clinic_id, 0) else ()
+            self.tree.insert("", 0, iid=iid, values=(f"{date} {time}", message.replace("\n", " | ")), tags=tags)
+        children = self.tree.get_children()
+        if len(children) > self.max_items:
+            self.tree.delete(*children[self.max_items:])
+        if children:
+            self.empty_label.place_forget()
+        else:
+            self.empty_label.place(relx=0.5, rely=0.1, anchor="n")
+
+    def mark_all_read(self):
+        for iid in self.tree.tag_has("unread"):
+            self.tree.item(iid, tags=())
+
+
+class CalendarCanvas(tk.Canvas):
+    # A doctor's week or month as a grid of slots (columns are days, rows
+    # are slots), all on one Canvas. The rectangles are created when the
+    # shape of the view changes (days shown, hours shown, window size);
+    # after that show() only recolours the cells whose state changed, so
+    # paging between weeks or refreshing after a cancellation touches a few
+    # items instead of rebuilding hundreds. Takes a schedule.ScheduleGrid
+    # (this module doesn't import it: NumPy stays out of app startup).
+    # Indexed by schedule's cell states: closed, free, booked, overbooked, off hours
+    COLOURS = ("#e9ecef", "#ffffff", "#9ec5fe", "#f1aeb5", "#ffe69c")
+    HEADER = 40
+    GUTTER = 70
+
+    def __init__(self, parent, on_select=None, font=("Arial", 9)):
+        super().__init__(parent, background="white", highlightthickness=0)
+        self.on_select = on_select
+        self.font = font
+        self.schedule = None
+        self._layout = None
+        self._cells = []
+        self._headers = []
+        self._state = None
+        self._texts = {}
+        self.bind("<Configure>", self.on_resize)
+        self.bind("<Button-1>", self.on_click)
+
+    def show(self, schedule):
+        self.schedule = schedule
+        layout = (schedule.days,) + schedule.slot_range() + (self.winfo_width(), self.winfo_height())
+        if layout != self._layout:
+            self._draw(layout)
+        else:
+            self._update()
+
+    def on_resize(self, event):
+        if self.schedule is not None and (event.width, event.height) != self._layout[3:]:
+            self.show(self.schedule)
+
+    def on_click(self, event):
+        if self.schedule is None or self.on_select is None:
+            return
+        days, first_slot, last_slot, width, height = self._layout
+        day = int((event.x - self.GUTTER) // self._cell_width)
+        row = int((event.y - self.HEADER) // self._cell_height)
+        if 0 <= day < days and 0 <= row < last_slot - first_slot:
+            self.on_select(self.schedule.cell_text(day, first_slot + row))
+
+    def _draw(self, layout):
+        days, first_slot, last_slot, width, height = layout
+        self._layout = layout
+        self.delete("all")
+        width, height = max(width, self.winfo_reqwidth()), max(height, self.winfo_reqheight())
+        self._cell_width = cell_width = (width - self.GUTTER) / days
+        self._cell_height = cell_height = (height - self.HEADER) / (last_slot - first_slot)
+        for row, slot in enumerate(range(first_slot, last_slot)):
+            self.create_text(self.GUTTER - 6, self.HEADER + row * cell_height + 2, text=time_of(slot),
+                             anchor="ne", font=self.font)
+        self._headers = [
+            self.create_text(self.GUTTER + (day + 0.5) * cell_width, self.HEADER / 2, justify="center", font=self.font)
+            for day in range(days)
+        ]
+        self._cells = [
+            [
+                self.create_rectangle(
+                    self.GUTTER + day * cell_width, self.HEADER + row * cell_height,
+                    self.GUTTER + (day + 1) * cell_width, self.HEADER + (row + 1) * cell_height,
+                    outline="#ced4da",
+                )
+                for row in range(last_slot - first_slot)
+            ]
+            for day in range(days)
+        ]
+        self._state = None
+        self._texts = {}
+        self._update()
+
+    def _update(self):
+        schedule = self.schedule
+        days, first_slot, last_slot = self._layout[:3]
+        state = schedule.state[:, first_slot:last_slot]
+        if self._state is None:
+            changed = zip(*(state >= 0).nonzero())
+        else:
+            changed = zip(*(state != self._state).nonzero())
+        for day, row in changed:
+            self.itemconfigure(self._cells[day][row], fill=self.COLOURS[state[day, row]])
+        self._state = state.copy()
+
+        # Month cells are too small for names: the week view labels its
+        # booked cells, the month view heads each day with its load only
+        for day, item in enumerate(self._headers):
+            date = schedule.date_of(day)
+            if days <= 7:
+                text = f"{date.strftime('%a %d')}\n{schedule.day_summary(day)}"
+            elif schedule.capacity[day]:
+                text = f"{date.day}\n{schedule.load[day]:.0%}"
+            else:
+                text = str(date.day)
+            self.itemconfigure(item, text=text)
+
+        labels = {}
+        for (day, slot), names in schedule.labels.items():
+            if first_slot <= slot < last_slot:
+                names = names.split(", ")
+                labels[day, slot - first_slot] = names[0] + (f" +{len(names) - 1}" if len(names) > 1 else "")
+        for cell in self._texts.keys() - labels.keys():
+            self.delete(self._texts.pop(cell))
+        for (day, row), text in labels.items():
+            item = self._texts.get((day, row))
+            if item is None:
+                x0, y0, x1, y1 = self.coords(self._cells[day][row])
+                self._texts[day, row] = self.create_text(x0 + 3, (y0 + y1) / 2, text=text, anchor="w",
+                                                         width=x1 - x0 - 6, font=self.font)
+            elif self.itemcget(item, "text") != text:
+                self.itemconfigure(item, text=text)
+
+
+class DebugPanel(tk.Toplevel):
+    # Live view of instrumentation.recorder: the costliest SQL statements,
+    # how long screens, actions and background tasks take, and the recent
+    # slow queries. Refreshes itself every `refresh_ms` while open.
+    def __init__(self, parent, recorder, refresh_ms=1000):
+        super().__init__(parent)
+        self.title("Debug")
+        self.geometry("1100x500")
+        self.recorder = recorder
+        self.refresh_ms = refresh_ms
+        self._after_id = None
+
+        buttons = ttk.Frame(self)
+        buttons.pack(fill="x")
+        self.pause_button = ttk.Button(buttons, text="Pause", command=self.toggle_recording)
+        self.pause_button.pack(side="left", padx=5, pady=5)
+        ttk.Button(buttons, text="Reset", command=self.reset).pack(side="left", padx=5, pady=5)
+
+        notebook = ttk.Notebook(self)
+        notebook.pack(fill="both", expand=True)
+        self.statements = self._table(notebook, "SQL", ("Statement", "Calls", "Total ms", "Max ms"))
+        self.actions = self._table(notebook, "Screens & actions", ("Name", "Calls", "Total ms", "Max ms"))
+        self.traced = self._table(notebook, "Statements run", ("Statement", "Runs"))
+        self.slow = self._table(notebook, f"Slow queries (>= {recorder.slow_ms:g} ms)", ("Thread", "ms", "Statement"))
+        self.refresh()
+
+    def _table(self, notebook, title, columns):
+        frame = ttk.Frame(notebook)
+        notebook.add(frame, text=title)
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=600 if column in ("Statement", "Name") else 90, stretch=column in ("Statement", "Name"))
+        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        tree.pack(side="left", fill="both", expand=True)
+        return tree
+
+    def _fill(self, tree, rows):
+        tree.delete(*tree.get_children())
+        for row in rows:
+            tree.insert("", tk.END, values=row)
+
+    def refresh(self):
+        snapshot = self.recorder.snapshot()
+        self._fill(self.statements, [(sql, n, f"{total:.1f}", f"{peak:.1f}") for sql, n, total, peak in snapshot['statements']])
+        self._fill(self.actions, [(name, n, f"{total:.1f}", f"{peak:.1f}") for name, n, total, peak in snapshot['actions']])
+        self._fill(self.traced, snapshot['traced'])
+        self._fill(self.slow, [(entry['thread'], entry['ms'], entry['sql']) for entry in reversed(snapshot['slow'])])
+        self._after_id = self.after(self.refresh_ms, self.refresh)
+
+    def destroy(self):
+        # A refresh still scheduled would fire on the destroyed widgets
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+            self._after_id = None
+        super().destroy()
+
+    def toggle_recording(self):
+        self.recorder.recording = not self.recorder.recording
+        self.pause_button.configure(text="Pause" if self.recorder.recording else "Resume")
+
+    def reset(self):
+        # The next refresh clears the tables
+        self.recorder.reset()